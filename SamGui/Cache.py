@@ -0,0 +1,632 @@
+import os
+import math
+import shutil
+import hashlib
+import logging
+import threading
+import numpy as np
+
+from PIL import Image
+from uuid import UUID
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+from SamGui.Data import AnchorLogits, BBox, BoxMask, ImageEmbedding
+from SamGui.Utils import create_thumbnail, read_image_size
+
+
+EMBEDDING_CACHE_DIR = "SamGui/Cache/embeddings"
+THUMBNAIL_CACHE_DIR = "SamGui/Cache/thumbnails"
+TILE_CACHE_DIR = "SamGui/Cache/tiles"
+
+# part of every embedding key, has to be bumped whenever the encoder input changes (see Inference.ImagePreprocessor)
+# so that embeddings computed from the previous preprocessing are not reused
+PREPROCESSING_VERSION = 2
+
+
+def file_signature(file_path: str) -> str:
+    """
+    Identifies a file by its absolute path, modification time and size, so that an edited or replaced image
+    on the same path doesn't resolve to a stale cache entry
+    """
+    stat = os.stat(file_path)
+    return f"{os.path.abspath(file_path)}|{stat.st_mtime_ns}|{stat.st_size}"
+
+
+_content_hashes: Dict[str, str] = {}
+_content_hash_lock = threading.Lock()
+
+
+def content_hash(file_path: str, chunk_size: int = 4 * 1024 * 1024) -> str:
+    """
+    Hash of the file content, memoized per file signature so that each file is only read once per session
+    """
+    signature = file_signature(file_path)
+
+    with _content_hash_lock:
+        if signature in _content_hashes:
+            return _content_hashes[signature]
+
+    sha = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+
+    with _content_hash_lock:
+        _content_hashes[signature] = sha.hexdigest()
+        return _content_hashes[signature]
+
+
+def model_hash(model_path: str) -> str:
+    return content_hash(model_path)
+
+
+def prune_directory(directory: str, suffix: str, max_bytes: int) -> None:
+    """
+    Deletes the least recently used files with the given suffix until the directory is below max_bytes
+    """
+    entries = []
+    total_size = 0
+
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.endswith(suffix):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+    if total_size <= max_bytes:
+        return
+
+    for _, size, path in sorted(entries):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+
+        total_size -= size
+        if total_size <= max_bytes:
+            return
+
+
+def prune_subdirectories(directory: str, max_bytes: int) -> None:
+    """
+    Same as prune_directory for caches that keep one subdirectory per entry
+    """
+    entries = []
+    total_size = 0
+
+    for entry in os.scandir(directory):
+        if entry.is_dir() and not entry.name.endswith(".tmp"):
+            size = sum(os.path.getsize(os.path.join(root, x)) for root, _, files in os.walk(entry.path) for x in files)
+            entries.append((entry.stat().st_mtime, size, entry.path))
+            total_size += size
+
+    for _, size, path in sorted(entries):
+        if total_size <= max_bytes:
+            return
+
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+
+
+class EmbeddingCache:
+    """
+    Keeps the encoder output per image so that repeated SAM runs on the same image only need the decoder.
+    Entries live in an in-memory LRU and are written through to disk, so evicted entries (and entries from
+    earlier sessions) can be reloaded without running the encoder again.
+    """
+    def __init__(self, max_items: int = 32, cache_dir: str = EMBEDDING_CACHE_DIR, max_disk_bytes: int = 4 * 1024 ** 3):
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._entries: OrderedDict[str, ImageEmbedding] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(image_path: str, model_path: str) -> str:
+        key = f"{file_signature(image_path)}|{model_hash(model_path)}|{PREPROCESSING_VERSION}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            if key in self._entries:
+                return True
+
+        return self.cache_dir is not None and os.path.isfile(self._disk_path(key))
+
+    def get(self, key: str) -> ImageEmbedding | None:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        embedding = self._read(key)
+
+        if embedding is not None:
+            self._insert(embedding)
+
+        return embedding
+
+    def put(self, embedding: ImageEmbedding) -> None:
+        self._insert(embedding)
+        self._write(embedding)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def _insert(self, embedding: ImageEmbedding) -> None:
+        with self._lock:
+            self._entries[embedding.key] = embedding
+            self._entries.move_to_end(embedding.key)
+
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def _read(self, key: str) -> ImageEmbedding | None:
+        if self.cache_dir is None:
+            return None
+
+        disk_path = self._disk_path(key)
+
+        if not os.path.isfile(disk_path):
+            return None
+
+        try:
+            with np.load(disk_path) as data:
+                orig_width, orig_height, resized_width, resized_height = data["sizes"].tolist()
+                embedding = ImageEmbedding(
+                    key=key,
+                    embeddings=data["embeddings"],
+                    orig_width=orig_width,
+                    orig_height=orig_height,
+                    resized_width=resized_width,
+                    resized_height=resized_height
+                )
+            os.utime(disk_path)  # keeps the on-disk pruning in LRU order
+            return embedding
+
+        except BaseException as e:
+            logging.error(f"Failed to read cached embedding {disk_path}: {e}")
+            return None
+
+    def _write(self, embedding: ImageEmbedding) -> None:
+        if self.cache_dir is None:
+            return
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            disk_path = self._disk_path(embedding.key)
+            tmp_path = f"{disk_path}.{threading.get_ident()}.tmp"
+            sizes = np.array(
+                [embedding.orig_width, embedding.orig_height, embedding.resized_width, embedding.resized_height],
+                dtype=np.int64
+            )
+
+            with open(tmp_path, "wb") as f:
+                np.savez(f, embeddings=embedding.embeddings, sizes=sizes)
+
+            os.replace(tmp_path, disk_path)
+            prune_directory(self.cache_dir, ".npz", self.max_disk_bytes)
+
+        except BaseException as e:
+            logging.error(f"Failed to write embedding to cache: {e}")
+
+_embedding_cache: EmbeddingCache | None = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    global _embedding_cache
+
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache()
+
+        return _embedding_cache
+
+
+class ThumbnailCache:
+    """
+    Content-addressed store of the image list thumbnails: entries are keyed by the hash of the image file, so copied
+    or renamed images reuse their thumbnail and edited ones get a new one. Hashing reads the file but never decodes it.
+    """
+    def __init__(
+            self,
+            size: int = 64,
+            cache_dir: str = THUMBNAIL_CACHE_DIR,
+            max_disk_bytes: int = 256 * 1024 ** 2,
+            prune_interval: int = 256):
+        self.size = size
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.prune_interval = prune_interval
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get_key(self, file_path: str) -> str:
+        return f"{content_hash(file_path)}_{self.size}"
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.jpg")
+
+    def get(self, file_path: str) -> Image.Image:
+        """
+        Returns the cached thumbnail of an image and creates it on a miss
+        """
+        key = self.get_key(file_path)
+        thumbnail = self._read(key)
+
+        if thumbnail is None:
+            thumbnail = create_thumbnail(file_path, self.size)
+            self._write(key, thumbnail)
+
+        return thumbnail
+
+    def _read(self, key: str) -> Image.Image | None:
+        disk_path = self._disk_path(key)
+
+        if not os.path.isfile(disk_path):
+            return None
+
+        try:
+            with Image.open(disk_path) as image:
+                thumbnail = image.convert("RGB")
+            os.utime(disk_path)
+            return thumbnail
+
+        except BaseException as e:
+            logging.error(f"Failed to read cached thumbnail {disk_path}: {e}")
+            return None
+
+    def _write(self, key: str, thumbnail: Image.Image) -> None:
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            disk_path = self._disk_path(key)
+            tmp_path = f"{disk_path}.{threading.get_ident()}.tmp"
+            thumbnail.save(tmp_path, format="JPEG", quality=85)
+            os.replace(tmp_path, disk_path)
+
+        except BaseException as e:
+            logging.error(f"Failed to write thumbnail to cache: {e}")
+            return
+
+        # scanning the directory on every write would be quadratic over a large import
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % self.prune_interval == 0
+
+        if prune:
+            prune_directory(self.cache_dir, ".jpg", self.max_disk_bytes)
+
+
+_thumbnail_cache: ThumbnailCache | None = None
+_thumbnail_cache_lock = threading.Lock()
+
+
+def get_thumbnail_cache() -> ThumbnailCache:
+    global _thumbnail_cache
+
+    with _thumbnail_cache_lock:
+        if _thumbnail_cache is None:
+            _thumbnail_cache = ThumbnailCache()
+
+        return _thumbnail_cache
+
+
+class ImageSizeCache:
+    """
+    Width and height of images by file signature, only the image header is read on a miss. An edited or replaced image
+    on the same path gets a new entry, so the size is never stale.
+    """
+    def __init__(self):
+        self._sizes: Dict[str, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, file_path: str) -> Tuple[int, int]:
+        key = file_signature(file_path)
+
+        with self._lock:
+            size = self._sizes.get(key)
+
+        if size is None:
+            size = read_image_size(file_path)
+
+            with self._lock:
+                self._sizes[key] = size
+
+        return size
+
+
+_image_size_cache: ImageSizeCache | None = None
+_image_size_cache_lock = threading.Lock()
+
+
+def get_image_size_cache() -> ImageSizeCache:
+    global _image_size_cache
+
+    with _image_size_cache_lock:
+        if _image_size_cache is None:
+            _image_size_cache = ImageSizeCache()
+
+        return _image_size_cache
+
+
+class DecodedImageCache:
+    """
+    Byte-bounded LRU of decoded images, which lets the canvas switch to an image that was shown or prefetched before
+    without decoding it again. The images are opaque to the cache, callers pass their decoded size along.
+    """
+    def __init__(self, max_bytes: int = 768 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, Tuple[Any, int]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(file_path: str) -> str:
+        return file_signature(file_path)
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            if key not in self._entries:
+                return None
+
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key: str, image: Any, nbytes: int) -> None:
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+
+            self._entries[key] = (image, nbytes)
+            self._size += nbytes
+
+            while self._size > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._size -= evicted_bytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+_decoded_image_cache: DecodedImageCache | None = None
+_decoded_image_cache_lock = threading.Lock()
+
+
+def get_decoded_image_cache() -> DecodedImageCache:
+    global _decoded_image_cache
+
+    with _decoded_image_cache_lock:
+        if _decoded_image_cache is None:
+            _decoded_image_cache = DecodedImageCache()
+
+        return _decoded_image_cache
+
+
+class BoxMaskCache:
+    """
+    Byte-bounded LRU of the masks decoded for single box prompts, keyed by the embedding and decoder they were decoded
+    with and the geometry of the box. A SAM re-run only decodes the boxes that were added or moved since the last one
+    and recomposes the union from the cached masks of the others. Masks upsampled from the low resolution output are
+    kept apart from the full resolution ones.
+    """
+    def __init__(self, max_bytes: int = 256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[Tuple, BoxMask] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(embedding_key: str, decoder_path: str, bbox: BBox, low_res: bool = False) -> Tuple:
+        return embedding_key, model_hash(decoder_path), low_res, bbox.x, bbox.y, bbox.w, bbox.h
+
+    @staticmethod
+    def get_size(box_mask: BoxMask) -> int:
+        return box_mask.crop.nbytes + (box_mask.logits.nbytes if box_mask.logits is not None else 0)
+
+    def get(self, key: Tuple) -> BoxMask | None:
+        with self._lock:
+            if key not in self._entries:
+                return None
+
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: Tuple, box_mask: BoxMask) -> None:
+        nbytes = self.get_size(box_mask)
+
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._size -= self.get_size(self._entries.pop(key))
+
+            self._entries[key] = box_mask
+            self._size += nbytes
+
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= self.get_size(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+_box_mask_cache: BoxMaskCache | None = None
+_box_mask_cache_lock = threading.Lock()
+
+
+def get_box_mask_cache() -> BoxMaskCache:
+    global _box_mask_cache
+
+    with _box_mask_cache_lock:
+        if _box_mask_cache is None:
+            _box_mask_cache = BoxMaskCache()
+
+        return _box_mask_cache
+
+
+class AnchorLogitsCache:
+    """
+    The low resolution logits of the last anchor-mode run per image, which the next run is refined from instead of
+    starting over. They are only fed back while anchors are added to the same prompts with the same embedding and
+    decoder, moving or removing an anchor starts a new mask.
+    """
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[UUID, AnchorLogits] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(embedding_key: str, decoder_path: str) -> Tuple:
+        return embedding_key, model_hash(decoder_path)
+
+    def get_mask_input(
+            self,
+            image_guid: UUID,
+            key: Tuple,
+            prompts: List[Tuple[float, float, int]]) -> np.ndarray | None:
+        with self._lock:
+            entry = self._entries.get(image_guid)
+
+            if entry is None or entry.key != key:
+                return None
+
+            self._entries.move_to_end(image_guid)
+
+            if entry.prompts == prompts:
+                # a repeated run starts from the same logits as the last one, which gives the same mask
+                return entry.mask_input
+
+            if len(entry.prompts) < len(prompts) and prompts[:len(entry.prompts)] == entry.prompts:
+                return entry.logits
+
+            return None
+
+    def put(self, image_guid: UUID, anchor_logits: AnchorLogits) -> None:
+        with self._lock:
+            self._entries[image_guid] = anchor_logits
+            self._entries.move_to_end(image_guid)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+_anchor_logits_cache: AnchorLogitsCache | None = None
+_anchor_logits_cache_lock = threading.Lock()
+
+
+def get_anchor_logits_cache() -> AnchorLogitsCache:
+    global _anchor_logits_cache
+
+    with _anchor_logits_cache_lock:
+        if _anchor_logits_cache is None:
+            _anchor_logits_cache = AnchorLogitsCache()
+
+        return _anchor_logits_cache
+
+
+class ImagePyramid:
+    """
+    Multi-resolution tiles of an image on disk. Level 0 is the full resolution and every further level halves it
+    until the whole image fits into a single tile. The tiles are written once per image content, so the full
+    resolution image is only decoded when the pyramid is built.
+    """
+    def __init__(
+            self,
+            file_path: str,
+            tile_size: int = 512,
+            cache_dir: str = TILE_CACHE_DIR,
+            max_disk_bytes: int = 8 * 1024 ** 3):
+        self.file_path = file_path
+        self.tile_size = tile_size
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+
+        with Image.open(file_path) as image:
+            self.width, self.height = image.size  # only reads the header
+
+        self.levels = max(1, math.ceil(math.log2(max(self.width, self.height) / tile_size)) + 1)
+        self.directory = os.path.join(cache_dir, f"{content_hash(file_path)}_{tile_size}")
+
+    def level_size(self, level: int) -> Tuple[int, int]:
+        return math.ceil(self.width / 2 ** level), math.ceil(self.height / 2 ** level)
+
+    def tile_count(self, level: int) -> Tuple[int, int]:
+        width, height = self.level_size(level)
+        return math.ceil(width / self.tile_size), math.ceil(height / self.tile_size)
+
+    def level_for_scale(self, scale: float) -> int:
+        """
+        Returns the coarsest level that still has at least one tile pixel per screen pixel at the given view scale
+        """
+        if scale >= 1.0:
+            return 0
+
+        return min(self.levels - 1, int(math.floor(math.log2(1.0 / scale))))
+
+    def tile_path(self, level: int, column: int, row: int) -> str:
+        return os.path.join(self.directory, str(level), f"{column}_{row}.jpg")
+
+    def is_built(self) -> bool:
+        return os.path.isdir(self.directory)
+
+    def build(self) -> None:
+        if self.is_built():
+            os.utime(self.directory)  # keeps the pruning in LRU order
+            return
+
+        # tiles are written to a private directory which is renamed at the end, so a concurrent or interrupted
+        # build never leaves a partial pyramid behind
+        tmp_directory = f"{self.directory}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        try:
+            with Image.open(self.file_path) as image:
+                image.load()
+                level_image = image if image.mode == "RGB" else image.convert("RGB")
+
+            for level in range(self.levels):
+                if level > 0:
+                    level_image = level_image.reduce(2)
+
+                level_directory = os.path.join(tmp_directory, str(level))
+                os.makedirs(level_directory, exist_ok=True)
+                columns, rows = self.tile_count(level)
+
+                for column in range(columns):
+                    for row in range(rows):
+                        x = column * self.tile_size
+                        y = row * self.tile_size
+                        tile = level_image.crop((x, y, min(x + self.tile_size, level_image.width), min(y + self.tile_size, level_image.height)))
+                        tile.save(os.path.join(level_directory, f"{column}_{row}.jpg"), format="JPEG", quality=90)
+
+            del level_image
+            os.replace(tmp_directory, self.directory)
+            prune_subdirectories(self.cache_dir, self.max_disk_bytes)
+
+        except OSError:
+            if not self.is_built():
+                raise
+
+        finally:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
@@ -1,7 +1,10 @@
 from uuid import UUID
+from PySide6.QtGui import QImage
 from PySide6.QtCore import QObject, Signal
+from SamGui.Cache import ImagePyramid
 from SamGui.Data import Tool, Label, Anchor, AnchorState, BBox, BBoxState, BBoxLabel, \
-    SamResult, BatchSamResult, ZoomLevel, BBoxPosition, ErrorMessage
+    SamResult, BatchSamResult, ZoomLevel, BBoxPosition, AnchorPosition, ErrorMessage, EmbeddingStatus, PreviewResult, \
+    ThumbnailResult, ImportChunk
 
 
 class WorkerSignals(QObject):
@@ -10,6 +13,29 @@ class WorkerSignals(QObject):
     s_sam_result = Signal(SamResult)
     s_sam_batch_result = Signal(BatchSamResult)
 
+class EmbeddingSignals(QObject):
+    s_status = Signal(EmbeddingStatus)
+    s_finished = Signal(UUID)
+
+class PreviewSignals(QObject):
+    s_preview = Signal(PreviewResult)
+    s_finished = Signal()
+
+class ThumbnailSignals(QObject):
+    s_thumbnail = Signal(ThumbnailResult)
+    s_finished = Signal(UUID)
+
+class TileSignals(QObject):
+    s_pyramid = Signal(ImagePyramid)
+    s_tile = Signal(int, int, int, QImage)  # level, column, row, tile (null if it couldn't be read)
+
+class ImageSignals(QObject):
+    s_loaded = Signal(UUID, QImage)
+    s_finished = Signal(str)
+
+class ImportSignals(QObject):
+    s_chunk = Signal(ImportChunk)
+
 class HeaderController(QObject):
     s_new_project = Signal()
     s_import_images = Signal()
@@ -74,7 +100,7 @@ class CanvasController(QObject):
     s_add_anchor = Signal(Anchor)
     s_add_bbox = Signal(BBox)
     s_select_canvas_item = Signal(UUID)
-    s_update_anchor_position = Signal(Anchor)
+    s_update_anchor_position = Signal(AnchorPosition)
     s_update_bbox_position = Signal(BBoxPosition)
     s_update_anchor_class = Signal(tuple)  # [UUID, Label]
     s_update_bbox_label = Signal(BBoxLabel)
@@ -1,8 +1,9 @@
+import numpy.typing as npt
 from PIL import Image
 from enum import Enum
 from uuid import UUID
-from typing import Dict, List
-from dataclasses import dataclass
+from typing import Dict, List, Tuple
+from dataclasses import dataclass, field
 
 
 class AddOP(Enum):
@@ -20,6 +21,16 @@ class SAMMode(Enum):
     anchors = 0
     bbox = 1
 
+class EmbeddingState(Enum):
+    Pending = 0
+    Encoding = 1
+    Ready = 2
+    Failed = 3
+
+class AnnotationKind(Enum):
+    Anchor = 0
+    BBox = 1
+
 class Edge(Enum):
     Left = 0
     Right = 1
@@ -78,6 +89,12 @@ class AnchorPosition:
     x: int
     y: int
 
+@dataclass
+class AnnotationDelta:
+    image_guid: UUID
+    guid: UUID
+    kind: AnnotationKind
+
 @dataclass
 class CroppedExportData:
     file_name: str
@@ -112,12 +129,26 @@ class BBoxLabel:
     guid: UUID
     label: str
 
+@dataclass
+class PackedMask:
+    """
+    A binary mask bit-packed (np.packbits) and cropped to the bounds of its set pixels
+    """
+    width: int
+    height: int
+    x: int  # origin and size of the packed crop within the full mask
+    y: int
+    crop_width: int
+    crop_height: int
+    bits: bytes
+
+
 @dataclass
 class Mask:
     guid: UUID
     x: int
     y: int
-    image: Image.Image | None
+    packed: PackedMask | None
 
 
 @dataclass
@@ -131,6 +162,8 @@ class SegmentationData:
     bboxes: List[BBox]
     mask: Mask | None
     zoom: float
+    width: int | None = None  # size of the image, read from its header on import
+    height: int | None = None
 
 
 @dataclass
@@ -160,7 +193,7 @@ class YoloAnnotations:
 @dataclass
 class SamResult:
     image_guid: UUID
-    mask: Image.Image
+    mask: PackedMask
     bbox: BBox | None
     anchors: List[Anchor] | None
 
@@ -168,9 +201,83 @@ class SamResult:
 @dataclass
 class BatchSamResult:
     image_guid: UUID
-    mask: Image.Image
+    mask: PackedMask
     bboxes: List[BBox]
 
+@dataclass
+class ImageEmbedding:
+    key: str
+    embeddings: npt.NDArray
+    orig_width: int
+    orig_height: int
+    resized_width: int
+    resized_height: int
+
+@dataclass
+class BoxMask:
+    """
+    The mask decoded for a single box prompt, cropped to the bounds of its set pixels
+    """
+    width: int  # of the image
+    height: int
+    x: int
+    y: int
+    crop: npt.NDArray  # uint8, 0 or 255
+    bbox: Tuple[float, float, float, float] | None = None  # x, y, w, h of the fitted box, set once it is corrected
+    logits: npt.NDArray | None = None  # 256x256 float32, kept for masks upsampled from the low resolution output
+
+@dataclass
+class AnchorLogits:
+    """
+    The low resolution logits of the last anchor-mode run on an image and the prompts they were decoded for
+    """
+    key: Tuple  # of the embedding and decoder
+    prompts: List[Tuple[float, float, int]]  # x, y and label of every anchor, in the order they were placed
+    mask_input: npt.NDArray | None  # the logits this run was refined from
+    logits: npt.NDArray  # 256x256 float32
+
+@dataclass
+class EmbeddingStatus:
+    image_guid: UUID
+    state: EmbeddingState
+
+@dataclass
+class SessionConfig:
+    intra_op_threads: int = 0  # 0 lets onnxruntime pick the number of physical cores
+    inter_op_threads: int = 0
+    graph_optimization_level: str = "all"  # disabled, basic, extended or all
+    optimized_model_dir: str | None = "SamGui/Cache/optimized"
+    providers: List[str] = field(default_factory=lambda: ["CUDAExecutionProvider", "CPUExecutionProvider"])
+
+@dataclass
+class PreviewRequest:
+    image_guid: UUID
+    file_path: str
+    mode: SAMMode
+    anchors: List[Anchor]
+    bboxes: List[BBox]
+    x: int
+    y: int
+
+@dataclass
+class PreviewResult:
+    image_guid: UUID
+    sequence: int
+    mask: Image.Image
+    x: int
+    y: int
+
+@dataclass
+class ThumbnailResult:
+    image_guid: UUID
+    image: Image.Image
+
+@dataclass
+class ImportChunk:
+    index: int
+    data: Dict[UUID, SegmentationData]
+    failed: List[str]  # files that could not be read
+
 @dataclass
 class ZoomLevel:
     image_guid: UUID
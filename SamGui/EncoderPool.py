@@ -0,0 +1,284 @@
+import os
+import queue
+import signal
+import logging
+import threading
+import numpy as np
+import multiprocessing as mp
+
+from PIL import Image
+from dataclasses import replace
+from multiprocessing import shared_memory
+from typing import List, Set
+from SamGui.Data import SessionConfig, ImageEmbedding
+
+
+# every SAM variant returns a 1x256x64x64 float32 embedding
+EMBEDDING_SHAPE = (1, 256, 64, 64)
+EMBEDDING_BYTES = int(np.prod(EMBEDDING_SHAPE)) * 4
+
+
+def get_core_sets(processes: int) -> List[Set[int]]:
+    """
+    Splits the cores available to this process into contiguous, non-overlapping sets, one per worker process
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+
+    if processes >= len(cores):
+        return [{cores[i % len(cores)]} for i in range(processes)]
+
+    chunk = len(cores) // processes
+    return [set(cores[i * chunk:(i + 1) * chunk]) for i in range(processes)]
+
+
+def default_process_count() -> int:
+    """
+    Below 16 cores a single session with all threads is as fast as splitting the machine
+    """
+    return max(1, (os.cpu_count() or 1) // 8)
+
+
+def _encoder_worker(
+        encoder_path: str,
+        config: SessionConfig,
+        cores: Set[int],
+        shm_name: str,
+        tasks: mp.Queue,
+        results: mp.Queue,
+        max_image_pixels: int | None):
+    """
+    Entry point of a worker process: owns one encoder session and writes each embedding into its shared memory slot.
+    Only the image sizes travel back through the result queue.
+    """
+    from SamGui.Inference import SessionManager, encode_image
+
+    # a spawned worker doesn't inherit the limit the parent might have raised (see allow_large_images)
+    Image.MAX_IMAGE_PIXELS = max_image_pixels
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # shutdown is driven by the parent
+
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cores)
+        except OSError as e:
+            logging.warning(f"Failed to pin encoder worker to cores {sorted(cores)}: {e}")
+
+    shm = shared_memory.SharedMemory(name=shm_name)  # spawned workers share the parent's resource tracker
+    slot = np.ndarray(EMBEDDING_SHAPE, dtype=np.float32, buffer=shm.buf)
+    session_manager = SessionManager(config)
+
+    try:
+        while True:
+            file_path = tasks.get()
+
+            if file_path is None:
+                break
+
+            try:
+                encoder = session_manager.get_session(encoder_path)
+                image_embedding = encode_image(encoder, file_path, key=file_path)
+
+                if image_embedding.embeddings.shape != EMBEDDING_SHAPE:
+                    raise ValueError(f"Unexpected embedding shape: {image_embedding.embeddings.shape}")
+
+                slot[...] = image_embedding.embeddings
+                results.put((
+                    None,
+                    image_embedding.orig_width,
+                    image_embedding.orig_height,
+                    image_embedding.resized_width,
+                    image_embedding.resized_height
+                ))
+
+            except BaseException as e:
+                results.put((f"{type(e).__name__}: {e}", 0, 0, 0, 0))
+    finally:
+        del slot
+        session_manager.release()
+        shm.close()
+
+
+class EncoderWorker:
+    def __init__(self, process: mp.Process, shm: shared_memory.SharedMemory, tasks: mp.Queue, results: mp.Queue):
+        self.process = process
+        self.shm = shm
+        self.tasks = tasks
+        self.results = results
+
+
+class EncoderPool:
+    """
+    Runs the SAM encoder in several spawned worker processes, each with its own onnxruntime session whose threads are
+    pinned to a separate set of cores. On machines with many cores this scales better than one session with a large
+    intra-op thread pool. Embeddings are returned through one shared memory slot per worker instead of being pickled.
+
+    encode() blocks until a worker is free and is safe to call from several threads, so a thread pool with as many
+    threads as processes keeps every worker busy. The processes are started on the first call.
+
+    close() doesn't block by default: the workers finish their current image and exit, then the last running encode()
+    or a background thread joins them and releases the shared memory.
+    """
+    def __init__(self, encoder_path: str, processes: int, config: SessionConfig | None = None):
+        self.encoder_path = encoder_path
+        self.processes = max(1, processes)
+        self.config = config if config is not None else SessionConfig()
+
+        self._context = mp.get_context("spawn")
+        self._workers: List[EncoderWorker] = []
+        self._idle: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+        self._closed = False
+        self._active = 0
+        self._timeout = 5.0
+        self._released = threading.Event()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+
+            if self._closed:
+                raise RuntimeError("EncoderPool is closed")
+
+            for index, cores in enumerate(get_core_sets(self.processes)):
+                # concurrent workers writing the same optimized model file would corrupt it
+                config = replace(
+                    self.config,
+                    intra_op_threads=self.config.intra_op_threads if self.config.intra_op_threads > 0 else len(cores),
+                    inter_op_threads=1,
+                    optimized_model_dir=None
+                )
+                shm = shared_memory.SharedMemory(create=True, size=EMBEDDING_BYTES)
+                tasks = self._context.Queue()
+                results = self._context.Queue()
+                process = self._context.Process(
+                    target=_encoder_worker,
+                    args=(self.encoder_path, config, cores, shm.name, tasks, results, Image.MAX_IMAGE_PIXELS),
+                    name=f"SamEncoder-{index}",
+                    daemon=True
+                )
+                process.start()
+                self._workers.append(EncoderWorker(process, shm, tasks, results))
+                self._idle.put(index)
+
+            self._started = True
+
+    def is_running(self) -> bool:
+        return self._started and not self._closed
+
+    def _alive_count(self) -> int:
+        return sum(1 for x in self._workers if x.process.is_alive())
+
+    def _acquire(self) -> int:
+        while True:
+            if self._closed:
+                raise RuntimeError("EncoderPool is closed")
+
+            try:
+                return self._idle.get(timeout=1.0)
+            except queue.Empty:
+                if self._alive_count() == 0:
+                    raise RuntimeError("All encoder worker processes have exited")
+
+    def encode(self, file_path: str, key: str) -> ImageEmbedding:
+        self.start()
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("EncoderPool is closed")
+
+            self._active += 1
+
+        try:
+            return self._encode(file_path, key)
+        finally:
+            with self._lock:
+                self._active -= 1
+                release = self._closed and self._active == 0
+
+            if release:
+                self._release()
+
+    def _encode(self, file_path: str, key: str) -> ImageEmbedding:
+        index = self._acquire()
+        worker = self._workers[index]
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("EncoderPool is closed")
+
+            worker.tasks.put(file_path)
+
+        while True:
+            try:
+                error, orig_width, orig_height, resized_width, resized_height = worker.results.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if not worker.process.is_alive():
+                    # the worker is not returned to the idle queue, the remaining ones take over
+                    raise RuntimeError(f"Encoder worker {index} exited with code {worker.process.exitcode}")
+
+        try:
+            if error is not None:
+                raise RuntimeError(error)
+
+            embeddings = np.ndarray(EMBEDDING_SHAPE, dtype=np.float32, buffer=worker.shm.buf).copy()
+        finally:
+            self._idle.put(index)
+
+        return ImageEmbedding(
+            key=key,
+            embeddings=embeddings,
+            orig_width=orig_width,
+            orig_height=orig_height,
+            resized_width=resized_width,
+            resized_height=resized_height
+        )
+
+    def close(self, timeout: float = 5.0, wait: bool = False) -> None:
+        """
+        Stops the workers after their current image, with wait the processes are joined before returning
+        """
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._timeout = timeout
+
+                for worker in self._workers:
+                    if worker.process.is_alive():
+                        worker.tasks.put(None)
+
+                if self._active == 0:
+                    # not a daemon, so the interpreter waits for the shared memory to be unlinked
+                    threading.Thread(target=self._release, name="SamEncoderPoolRelease").start()
+
+        if wait:
+            self._released.wait()
+
+    def _release(self) -> None:
+        """
+        Joins the worker processes and releases their shared memory, once no encode() is running anymore
+        """
+        for worker in self._workers:
+            worker.process.join(self._timeout)
+
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+
+            worker.shm.close()
+            worker.shm.unlink()
+
+        self._workers.clear()
+        self._released.set()
+
+    def __enter__(self) -> "EncoderPool":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close(wait=True)
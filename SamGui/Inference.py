@@ -0,0 +1,498 @@
+import os
+import cv2
+import logging
+import weakref
+import threading
+import numpy as np
+import onnxruntime as ort
+import numpy.typing as npt
+
+from PIL import Image
+from typing import TYPE_CHECKING, Dict, Iterator, List, Tuple
+from SamGui.Cache import EmbeddingCache, model_hash, get_embedding_cache
+from SamGui.Data import SessionConfig, ImageEmbedding, BBox
+from SamGui.Utils import pad_roi
+
+if TYPE_CHECKING:
+    from SamGui.EncoderPool import EncoderPool
+
+
+ENCODER_PATH = "SamGui/Models/sam_vit_b_encoder.onnx"
+DECODER_PATH = "SamGui/Models/sam_vit_b_decoder.onnx"
+
+PIXEL_MEAN = np.array([123.675, 116.28, 103.53], dtype=np.float32)
+PIXEL_STD = np.array([58.395, 57.12, 57.375], dtype=np.float32)
+
+INPUT_SIZE = 1024  # of the padded encoder input
+LOW_RES_SIZE = 256  # of the low resolution logits returned by the decoder, which cover the padded input
+
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disabled": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+class SessionManager:
+    """
+    Owns the onnxruntime sessions for the SAM encoder and decoder, so that the weights are loaded and
+    graph-optimized once per process instead of once per SAM run. Sessions are created lazily on first use and
+    shared between all runners, InferenceSession.run() is safe to call from multiple threads.
+    """
+    def __init__(self, config: SessionConfig | None = None):
+        self.config = config if config is not None else SessionConfig()
+        self._sessions: Dict[str, ort.InferenceSession] = {}
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+
+    def configure(self, config: SessionConfig) -> None:
+        """
+        Applies new session options, already loaded sessions are dropped and rebuilt on their next use
+        """
+        with self._lock:
+            if config != self.config:
+                self.config = config
+                self._sessions.clear()
+
+    def get_providers(self) -> List[str]:
+        available = ort.get_available_providers()
+        providers = [x for x in self.config.providers if x in available]
+
+        if len(providers) == 0:
+            providers = ["CPUExecutionProvider"]
+
+        return providers
+
+    def get_optimization_level(self) -> str:
+        if self.config.graph_optimization_level not in GRAPH_OPTIMIZATION_LEVELS:
+            logging.warning(f"Unknown graph optimization level: {self.config.graph_optimization_level}, using 'all'")
+            return "all"
+
+        return self.config.graph_optimization_level
+
+    def get_serialized_level(self) -> str:
+        """
+        The layout optimizations of 'all' are specific to the machine they ran on, so a serialized graph is only
+        optimized up to 'extended' and the rest is applied in memory when it is loaded
+        """
+        level = self.get_optimization_level()
+        return "extended" if level == "all" else level
+
+    def build_session_options(self, level: str | None = None) -> ort.SessionOptions:
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.config.intra_op_threads
+        options.inter_op_num_threads = self.config.inter_op_threads
+        options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[level or self.get_optimization_level()]
+
+        return options
+
+    def get_optimized_model_path(self, model_path: str, providers: List[str]) -> str | None:
+        """
+        The optimized graph depends on the source model, the optimization level and the execution providers
+        """
+        if self.config.optimized_model_dir is None:
+            return None
+
+        provider_tag = "_".join(x.replace("ExecutionProvider", "").lower() for x in providers)
+        model_name = os.path.splitext(os.path.basename(model_path))[0]
+        file_name = f"{model_name}_{model_hash(model_path)[:12]}_{self.get_serialized_level()}_{provider_tag}.onnx"
+
+        return os.path.join(self.config.optimized_model_dir, file_name)
+
+    def load_optimized_model(self, optimized_path: str, providers: List[str]) -> ort.InferenceSession:
+        # the cached graph is already optimized up to the serialized level, only what is left of 'all' runs again
+        level = "all" if self.get_optimization_level() == "all" else "disabled"
+        options = self.build_session_options(level)
+
+        return ort.InferenceSession(optimized_path, sess_options=options, providers=providers)
+
+    def create_session(self, model_path: str) -> ort.InferenceSession:
+        providers = self.get_providers()
+        optimized_path = self.get_optimized_model_path(model_path, providers)
+
+        if optimized_path is None:
+            return ort.InferenceSession(model_path, sess_options=self.build_session_options(), providers=providers)
+
+        if os.path.isfile(optimized_path):
+            try:
+                return self.load_optimized_model(optimized_path, providers)
+            except BaseException as e:
+                logging.error(f"Failed to load optimized model {optimized_path}, rebuilding it: {e}")
+
+        os.makedirs(os.path.dirname(optimized_path), exist_ok=True)
+        options = self.build_session_options(self.get_serialized_level())
+        options.optimized_model_filepath = optimized_path
+        session = ort.InferenceSession(model_path, sess_options=options, providers=providers)
+
+        if self.get_serialized_level() == self.get_optimization_level():
+            return session
+
+        del session
+        return self.load_optimized_model(optimized_path, providers)
+
+    def get_session(self, model_path: str) -> ort.InferenceSession:
+        with self._lock:
+            if model_path in self._sessions:
+                return self._sessions[model_path]
+
+            load_lock = self._load_locks.setdefault(model_path, threading.Lock())
+
+        # loading can take a few seconds, so only runners waiting for the same model are blocked
+        with load_lock:
+            with self._lock:
+                if model_path in self._sessions:
+                    return self._sessions[model_path]
+
+            session = self.create_session(model_path)
+
+            with self._lock:
+                self._sessions[model_path] = session
+
+            return session
+
+    def is_loaded(self, model_path: str) -> bool:
+        with self._lock:
+            return model_path in self._sessions
+
+    def release(self) -> None:
+        with self._lock:
+            self._sessions.clear()
+
+
+_session_manager: SessionManager | None = None
+_session_manager_lock = threading.Lock()
+
+
+def get_session_manager() -> SessionManager:
+    global _session_manager
+
+    with _session_manager_lock:
+        if _session_manager is None:
+            _session_manager = SessionManager()
+
+        return _session_manager
+
+
+def get_resized_shape(orig_width: int, orig_height: int, target_size: int = INPUT_SIZE) -> Tuple[int, int]:
+    if orig_width > orig_height:
+        resized_width = target_size
+        resized_height = int(target_size / orig_width * orig_height)
+    else:
+        resized_height = target_size
+        resized_width = int(target_size / orig_height * orig_width)
+
+    return resized_width, resized_height
+
+
+class ImagePreprocessor:
+    """
+    Prepares the encoder input without intermediate float64 copies: JPEGs are decoded at reduced scale when possible,
+    the resized pixels are converted straight into a preallocated float32 NCHW tensor and normalized in place.
+    The returned tensor is reused by the next call, so an instance must not be shared between threads
+    (see get_preprocessor) and callers must not keep the tensor around.
+    """
+    def __init__(self, target_size: int = INPUT_SIZE):
+        self.target_size = target_size
+        self.input_tensor = np.zeros((1, 3, target_size, target_size), dtype=np.float32)
+        self.scale = (1.0 / PIXEL_STD)[:, None, None]
+        self.offset = (PIXEL_MEAN / PIXEL_STD)[:, None, None]
+
+    def __call__(self, file_path: str) -> Tuple[npt.NDArray, int, int, int, int]:
+        with Image.open(file_path) as img:
+            orig_width, orig_height = img.size
+            resized_width, resized_height = get_resized_shape(orig_width, orig_height, self.target_size)
+
+            # lets the JPEG decoder skip detail that is thrown away by the resize anyway
+            img.draft("RGB", (resized_width, resized_height))
+            img = img.convert("RGB")
+
+            if img.size != (resized_width, resized_height):
+                img = img.resize((resized_width, resized_height), Image.Resampling.BILINEAR)
+
+            pixels = np.asarray(img)
+
+        tensor = self.input_tensor[0]
+        region = tensor[:, :resized_height, :resized_width]
+        np.copyto(region, pixels.transpose(2, 0, 1), casting="unsafe")
+        region *= self.scale
+        region -= self.offset
+
+        # the padding has to be zero again if the previous image covered a larger area
+        tensor[:, resized_height:, :] = 0
+        tensor[:, :resized_height, resized_width:] = 0
+
+        return self.input_tensor, orig_width, orig_height, resized_width, resized_height
+
+
+_preprocessors = threading.local()
+
+
+def get_preprocessor() -> ImagePreprocessor:
+    if not hasattr(_preprocessors, "preprocessor"):
+        _preprocessors.preprocessor = ImagePreprocessor()
+
+    return _preprocessors.preprocessor
+
+
+def preprocess_image(file_path: str) -> Tuple[npt.NDArray, int, int, int, int]:
+    return get_preprocessor()(file_path)
+
+
+def encode_image(encoder: ort.InferenceSession, file_path: str, key: str) -> ImageEmbedding:
+    input_tensor, orig_width, orig_height, resized_width, resized_height = preprocess_image(file_path)
+    outputs = encoder.run(None, {"images": input_tensor})
+
+    return ImageEmbedding(
+        key=key,
+        embeddings=outputs[0],
+        orig_width=orig_width,
+        orig_height=orig_height,
+        resized_width=resized_width,
+        resized_height=resized_height
+    )
+
+
+def get_image_embedding(
+        file_path: str,
+        encoder_path: str,
+        session_manager: SessionManager | None = None,
+        cache: EmbeddingCache | None = None,
+        encoder_pool: "EncoderPool | None" = None) -> ImageEmbedding:
+    """
+    Returns the cached encoder output for an image and only runs the encoder on a cache miss,
+    in one of the pool's worker processes if an encoder_pool is given
+    """
+    session_manager = session_manager if session_manager is not None else get_session_manager()
+    cache = cache if cache is not None else get_embedding_cache()
+
+    key = cache.get_key(file_path, encoder_path)
+    image_embedding = cache.get(key)
+
+    if image_embedding is None:
+        if encoder_pool is not None:
+            image_embedding = encoder_pool.encode(file_path, key)
+        else:
+            image_embedding = encode_image(session_manager.get_session(encoder_path), file_path, key)
+
+        cache.put(image_embedding)
+
+    return image_embedding
+
+
+def decode_points(
+        decoder: ort.InferenceSession,
+        image_embedding: ImageEmbedding,
+        points: List[List[float]],
+        labels: List[int]) -> npt.NDArray:
+    """
+    Runs the decoder for a set of foreground/background point prompts and returns a single binary uint8 mask
+    """
+    return refine_points(decoder, image_embedding, points, labels)[0]
+
+
+def refine_points(
+        decoder: ort.InferenceSession,
+        image_embedding: ImageEmbedding,
+        points: List[List[float]],
+        labels: List[int],
+        mask_input: npt.NDArray | None = None) -> Tuple[npt.NDArray, npt.NDArray]:
+    """
+    Runs the decoder for a set of point prompts, starting from the low resolution logits of a previous run if
+    mask_input is given. Returns the binary uint8 mask and the low resolution logits to refine the next run from.
+    """
+    orig_width = image_embedding.orig_width
+    orig_height = image_embedding.orig_height
+
+    # the padding point marks the end of the prompt, since there is no box
+    coords = np.array(list(points) + [[0.0, 0.0]], dtype=np.float64)[None, :, :]
+    coords[..., 0] *= image_embedding.resized_width / orig_width
+    coords[..., 1] *= image_embedding.resized_height / orig_height
+    onnx_label = np.array(list(labels) + [-1], dtype=np.float32)[None, :]
+
+    if mask_input is not None:
+        onnx_mask_input = mask_input.astype(np.float32, copy=False).reshape(1, 1, LOW_RES_SIZE, LOW_RES_SIZE)
+        onnx_has_mask_input = np.ones(1, dtype=np.float32)
+    else:
+        onnx_mask_input = np.zeros((1, 1, LOW_RES_SIZE, LOW_RES_SIZE), dtype=np.float32)
+        onnx_has_mask_input = np.zeros(1, dtype=np.float32)
+
+    outputs = decoder.run(None, {
+        "image_embeddings": image_embedding.embeddings,
+        "point_coords": coords.astype(np.float32),
+        "point_labels": onnx_label,
+        "mask_input": onnx_mask_input,
+        "has_mask_input": onnx_has_mask_input,
+        "orig_im_size": np.array([orig_height, orig_width], dtype=np.float32),
+    })
+
+    return (outputs[0][0][0] > 0).astype(np.uint8) * 255, outputs[2][0][0]
+
+
+# keyed by the session itself, a rebuilt session (see SessionManager.configure) is probed again
+_batch_support: "weakref.WeakKeyDictionary[ort.InferenceSession, bool]" = weakref.WeakKeyDictionary()
+
+
+def decoder_supports_batch(decoder: ort.InferenceSession) -> bool:
+    """
+    The reference SAM export fixes the prompt batch dimension to 1, a decoder exported with a dynamic batch axis
+    can decode several box prompts against the same embedding in a single run
+    """
+    if decoder not in _batch_support:
+        supports_batch = False
+
+        for decoder_input in decoder.get_inputs():
+            if decoder_input.name == "point_coords":
+                batch_dim = decoder_input.shape[0]
+                supports_batch = not isinstance(batch_dim, int) or batch_dim > 1
+
+        _batch_support[decoder] = supports_batch
+
+    return _batch_support[decoder]
+
+
+def decode_bboxes(
+        decoder: ort.InferenceSession,
+        image_embedding: ImageEmbedding,
+        bboxes: List[BBox],
+        batch_size: int = 8,
+        low_res: bool = False) -> List[npt.NDArray]:
+    """
+    Runs the decoder for a list of box prompts and returns one binary uint8 mask (or low resolution logits) per box
+    """
+    return list(iter_decode_bboxes(decoder, image_embedding, bboxes, batch_size, low_res))
+
+
+def iter_decode_bboxes(
+        decoder: ort.InferenceSession,
+        image_embedding: ImageEmbedding,
+        bboxes: List[BBox],
+        batch_size: int = 8,
+        low_res: bool = False) -> Iterator[npt.NDArray]:
+    """
+    Runs the decoder for a list of box prompts and yields one binary uint8 mask per box, in the order of the boxes.
+    The prompts are stacked into batches of batch_size if the decoder accepts it, otherwise each box is decoded on its
+    own. Batches are bounded since every prompt returns a full resolution float mask, and the masks are yielded
+    as each batch arrives, so callers that consume them one by one never hold all of them at once.
+
+    With low_res the decoder only upsamples to the resized input instead of the original image and the 256x256
+    float32 low resolution logits of every box are yielded, see upsample_box_logits.
+    """
+    if len(bboxes) == 0:
+        return
+
+    orig_width = image_embedding.orig_width
+    orig_height = image_embedding.orig_height
+    assert orig_width != 0 and orig_height != 0
+
+    coords = np.array([[[x.x, x.y], [x.x + x.w, x.y + x.h]] for x in bboxes], dtype=np.float64)
+    coords[..., 0] *= image_embedding.resized_width / orig_width
+    coords[..., 1] *= image_embedding.resized_height / orig_height
+    onnx_coord = coords.astype(np.float32)
+    onnx_label = np.tile(np.array([[2, 3]], dtype=np.float32), (len(bboxes), 1))
+
+    # the empty mask prompt is broadcast over the batch
+    onnx_mask_input = np.zeros((1, 1, 256, 256), dtype=np.float32)
+    onnx_has_mask_input = np.zeros(1, dtype=np.float32)
+
+    if low_res:
+        # the full resolution output isn't used, this keeps the upsampling inside the decoder at most 1024x1024
+        onnx_orig_im_size = np.array([image_embedding.resized_height, image_embedding.resized_width], dtype=np.float32)
+    else:
+        onnx_orig_im_size = np.array([orig_height, orig_width], dtype=np.float32)
+
+    step = batch_size if decoder_supports_batch(decoder) else 1
+    start = 0
+
+    while start < len(bboxes):
+        try:
+            outputs = decoder.run(None, {
+                "image_embeddings": image_embedding.embeddings,
+                "point_coords": onnx_coord[start:start + step],
+                "point_labels": onnx_label[start:start + step],
+                "mask_input": onnx_mask_input,
+                "has_mask_input": onnx_has_mask_input,
+                "orig_im_size": onnx_orig_im_size,
+            })
+
+        except BaseException as e:
+            if step == 1:
+                raise
+
+            logging.warning(f"Decoder rejected a batch of {step} prompts, decoding boxes one by one: {e}")
+            _batch_support[decoder] = False
+            step = 1
+            continue
+
+        start += step
+
+        if low_res:
+            for logits in outputs[2]:
+                yield logits[0].copy()
+
+            del outputs
+            continue
+
+        batch = outputs[0]
+        del outputs
+
+        for idx in range(len(batch)):
+            # thresholding into a bool array and scaling it in place avoids two full resolution temporaries
+            mask = np.greater(batch[idx, 0], 0).view(np.uint8)
+            mask *= 255
+            yield mask
+
+
+def upsample_logits(
+        logits: npt.NDArray,
+        image_embedding: ImageEmbedding,
+        region: Tuple[int, int, int, int]) -> npt.NDArray:
+    """
+    Upsamples low resolution logits bilinearly, like the decoder does, but only for the region x0, y0, x1, y1 of the
+    original image, and returns the binary uint8 mask of that region
+    """
+    x0, y0, x1, y1 = region
+    scale_x = image_embedding.resized_width / image_embedding.orig_width * LOW_RES_SIZE / INPUT_SIZE
+    scale_y = image_embedding.resized_height / image_embedding.orig_height * LOW_RES_SIZE / INPUT_SIZE
+
+    # maps the pixel centers of the region to the logits, the same alignment as an upsampling without aligned corners
+    transform = np.array([
+        [scale_x, 0.0, (x0 + 0.5) * scale_x - 0.5],
+        [0.0, scale_y, (y0 + 0.5) * scale_y - 0.5]
+    ], dtype=np.float64)
+
+    region_logits = cv2.warpAffine(
+        logits, transform, (x1 - x0, y1 - y0),
+        flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+        borderMode=cv2.BORDER_REPLICATE
+    )
+
+    mask = np.greater(region_logits, 0).view(np.uint8)
+    mask *= 255
+    return mask
+
+
+def upsample_box_logits(
+        logits: npt.NDArray,
+        image_embedding: ImageEmbedding,
+        roi: Tuple[float, float, float, float]) -> Tuple[int, int, npt.NDArray]:
+    """
+    Upsamples the low resolution logits of the box x, y, w, h only around the padded box and returns x0, y0 and the
+    binary uint8 mask of that region. If the mask reaches an edge of the padded box that isn't an edge of the image
+    it would be clipped there, so the logits are upsampled for the whole image instead.
+    """
+    width, height = image_embedding.orig_width, image_embedding.orig_height
+    x0, y0, x1, y1 = pad_roi(roi, width, height)
+    mask = upsample_logits(logits, image_embedding, (x0, y0, x1, y1))
+
+    if mask.size == 0:
+        return x0, y0, mask
+
+    clipped = (x0 > 0 and mask[:, 0].any()) or (y0 > 0 and mask[0].any()) or \
+        (x1 < width and mask[:, -1].any()) or (y1 < height and mask[-1].any())
+
+    if clipped:
+        return 0, 0, upsample_logits(logits, image_embedding, (0, 0, width, height))
+
+    return x0, y0, mask
@@ -0,0 +1,180 @@
+"""
+Write-ahead journal of the changes made since the project was last saved, opened or created. The journal is a
+project file whose index also names the project file it was started from, so after a crash the session is restored by
+loading that file and replaying the journal on top of it.
+"""
+
+import os
+import logging
+import threading
+
+from uuid import UUID
+from typing import Dict, Iterable, List, Set, Tuple
+from SamGui.Data import PackedMask, ProjectData
+from SamGui.Project import PROJECT_EXTENSION, ProjectFile, encode_entry, encode_project
+
+
+AUTOSAVE_DIR = "SamGui/Autosave"
+
+
+class ProjectJournal:
+    """
+    Changes are handed over as detached records, a background thread appends them to the journal with one fsync per
+    batch. While the thread is busy new changes queue up and are coalesced into the next batch, so that an entry
+    which changed many times (e.g. a dragged box) is only written in its latest state.
+    """
+    def __init__(self, directory: str = AUTOSAVE_DIR, max_segments: int = 512):
+        self.directory = directory
+        self.file_path = os.path.join(directory, f"journal{PROJECT_EXTENSION}")
+        self.journal_file = ProjectFile(self.file_path, max_segments, rebind_masks=False)
+        self.base_path: str | None = None
+        self._pending: List[Tuple] = []
+        self._condition = threading.Condition()
+        self._thread: threading.Thread | None = None
+
+    def has_recovery(self) -> bool:
+        return os.path.isfile(self.file_path)
+
+    def recover(self) -> Tuple[ProjectData, ProjectFile | None, Set[UUID]]:
+        """
+        Loads the project file the journal was started from and replays the journal on top of it, returns the project,
+        the opened project file (if any) and the guids of the images that changed since it was saved
+        """
+        project, entries, deleted = self.journal_file.read_changes()
+        self.base_path = project.get("base")
+
+        # the restored masks must not point into the journal, which is rewritten on the next save
+        self.journal_file.detach_masks([x.mask.packed for x in entries if x.mask is not None and x.mask.packed])
+        base_file = None
+
+        if self.base_path is not None and os.path.isfile(self.base_path):
+            base_file = ProjectFile(self.base_path)
+            data = base_file.load().data
+        else:
+            if self.base_path is not None:
+                logging.error(f"The project {self.base_path} of the journal is missing, restoring the changes only")
+
+            self.base_path = None
+            data = {}
+
+        for guid in deleted:
+            data.pop(guid, None)
+
+        for entry in entries:
+            data[entry.guid] = entry
+
+        restored = ProjectData(
+            guid=UUID(project["guid"]),
+            name=project["name"],
+            classes=project["classes"],
+            data=data
+        )
+
+        return restored, base_file, {x.guid for x in entries} | deleted
+
+    def discard(self) -> None:
+        self.journal_file.close()
+
+        if os.path.isfile(self.file_path):
+            os.remove(self.file_path)
+
+    def start(self, project: ProjectData, base_path: str | None) -> None:
+        """
+        Restarts the journal on top of a project that was just saved, opened or created. The journal file is only
+        written once there are changes, so a session without any doesn't leave a journal to restore behind.
+        """
+        self.base_path = base_path
+        self.submit(("start", [], [], self.encode_project(project)))
+
+    def record(self, project: ProjectData, dirty: Iterable[UUID], deleted: Set[UUID]) -> None:
+        """
+        Encodes the changed entries on the calling thread, which owns the project, and queues them for the writer.
+        The dirty guids are expected in the order they first changed, which keeps added images in project order.
+        """
+        records = [encode_entry(project.data[x]) for x in dirty if x in project.data]
+
+        if len(records) == 0 and len(deleted) == 0:
+            return
+
+        self.submit(("append", records, [str(x) for x in deleted if x not in project.data], self.encode_project(project)))
+
+    def close(self, discard: bool) -> None:
+        """
+        Writes the queued changes and stops the writer, the journal is removed with discard
+        """
+        if self._thread is not None:
+            self.submit(("close", [], [], None))
+            self._thread.join()
+            self._thread = None
+
+        if discard:
+            self.discard()
+
+    def encode_project(self, project: ProjectData) -> dict:
+        encoded = encode_project(project)
+        encoded["base"] = self.base_path
+        return encoded
+
+    def submit(self, operation: Tuple) -> None:
+        with self._condition:
+            self._pending.append(operation)
+            self._condition.notify()
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="ProjectJournal", daemon=True)
+            self._thread.start()
+
+    def run(self) -> None:
+        while True:
+            with self._condition:
+                while len(self._pending) == 0:
+                    self._condition.wait()
+
+                operations = self._pending
+                self._pending = []
+
+            for kind, records, deleted, project in self.coalesce(operations):
+                if kind == "close":
+                    return
+
+                try:
+                    self.write(kind, records, deleted, project)
+                except OSError as e:
+                    logging.error(f"Failed to write the journal {self.file_path}: {e}")
+
+    @staticmethod
+    def coalesce(operations: List[Tuple]) -> List[Tuple]:
+        """
+        Merges runs of appends, later records of an entry replace the earlier ones
+        """
+        merged = []
+
+        for operation in operations:
+            kind, records, deleted, project = operation
+
+            if kind == "append" and len(merged) > 0 and merged[-1][0] in ["start", "append"]:
+                _, pending_records, pending_deleted, _ = merged[-1]
+                by_guid: Dict[str, Tuple[dict, PackedMask | None]] = {x[0]["guid"]: x for x in pending_records}
+                by_guid.update({x[0]["guid"]: x for x in records})
+                deleted = [x for x in pending_deleted if x not in by_guid] + deleted
+                by_guid = {k: v for k, v in by_guid.items() if k not in deleted}
+                merged[-1] = (merged[-1][0], list(by_guid.values()), deleted, project)
+            else:
+                merged.append(operation)
+
+        return merged
+
+    def write(self, kind: str, records: List[Tuple[dict, PackedMask | None]], deleted: List[str], project: dict) -> None:
+        if kind == "start" or not self.journal_file.is_open():
+            if len(records) == 0 and len(deleted) == 0:
+                self.discard()
+                return
+
+            os.makedirs(self.directory, exist_ok=True)
+            self.journal_file.rewrite(records, deleted, project)
+            return
+
+        self.journal_file.append(records, deleted, project)
+
+        if self.journal_file.needs_compaction():
+            self.journal_file.compact()
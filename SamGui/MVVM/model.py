@@ -1,12 +1,22 @@
+import gc
 from uuid import UUID
 from PIL import Image
-from typing import Dict, List
-from SamGui.Utils import generate_uuid
+from typing import Dict, List, Set, Tuple
+from SamGui.Utils import generate_uuid, pack_mask
+from SamGui.Project import ProjectFile
+from SamGui.Journal import ProjectJournal
 from SamGui.Data import Anchor, BBox, Mask, SegmentationData, ProjectData, BBoxState, SamResult, \
-    BatchSamResult, ZoomLevel, BBoxPosition, AnchorPosition, ImagePosition, MaskPosition
+    BatchSamResult, ZoomLevel, BBoxPosition, AnchorPosition, ImagePosition, MaskPosition, AnnotationKind
 
 
 class DataModel:
+    """
+    Holds the project and a set of indexes over it, so that lookups by file path, image guid, annotation guid or
+    mask guid don't scan the whole project. The indexes reference the same Anchor and BBox objects that are stored in
+    the lists of each SegmentationData and are updated by every method that mutates the project.
+    The same methods mark the changed images dirty, so that a save only writes what changed since the last one and
+    the journal only records what changed since its last batch.
+    """
     def __init__(self):
         self.project = ProjectData(
             guid=generate_uuid(),
@@ -14,6 +24,172 @@ class DataModel:
             classes=[],
             data={}
         )
+        self.project_file: ProjectFile | None = None
+        self.journal: ProjectJournal | None = None
+        self.reset_index()
+        self.reset_changes()
+        self.reset_journal_changes()
+
+    def reset_index(self) -> None:
+        self._file_paths: Set[str] = set()
+        self._annotations: Dict[UUID, Tuple[UUID, AnnotationKind]] = {}  # annotation guid -> (image guid, kind)
+        self._anchors: Dict[UUID, Dict[UUID, Anchor]] = {}  # image guid -> anchor guid -> anchor
+        self._bboxes: Dict[UUID, Dict[UUID, BBox]] = {}  # image guid -> bbox guid -> bbox
+        self._masks: Dict[UUID, UUID] = {}  # mask guid -> image guid
+        self._order: List[UUID] = []  # image guids in project order, deleted ones are only dropped on compaction
+        self._positions: Dict[UUID, int] = {}  # image guid -> position in _order
+
+    def rebuild_index(self) -> None:
+        self.reset_index()
+
+        for entry in self.project.data.values():
+            self._index_entry(entry)
+
+    def _index_entry(self, entry: SegmentationData) -> None:
+        self._file_paths.add(entry.file_path)
+        self._positions[entry.guid] = len(self._order)
+        self._order.append(entry.guid)
+        self._anchors[entry.guid] = {}
+        self._bboxes[entry.guid] = {}
+
+        for anchor in entry.anchors:
+            self._index_anchor(entry.guid, anchor)
+
+        for bbox in entry.bboxes:
+            self._index_bbox(entry.guid, bbox)
+
+        if entry.mask is not None:
+            self._masks[entry.mask.guid] = entry.guid
+
+    def _unindex_entry(self, entry: SegmentationData) -> None:
+        self._file_paths.discard(entry.file_path)
+        self._unindex_annotations(entry.guid)
+        self._anchors.pop(entry.guid, None)
+        self._bboxes.pop(entry.guid, None)
+
+        if entry.mask is not None:
+            self._masks.pop(entry.mask.guid, None)
+
+        self._positions.pop(entry.guid, None)
+
+        # the order is compacted once most of it are deleted images, which keeps deletes O(1) amortized
+        if len(self._order) > 2 * len(self._positions) + 64:
+            self._order = [x for x in self._order if x in self._positions]
+            self._positions = {x: idx for idx, x in enumerate(self._order)}
+
+    def _unindex_annotations(self, image_guid: UUID) -> None:
+        for guid in self._anchors.get(image_guid, {}):
+            self._annotations.pop(guid, None)
+
+        for guid in self._bboxes.get(image_guid, {}):
+            self._annotations.pop(guid, None)
+
+        self._anchors[image_guid] = {}
+        self._bboxes[image_guid] = {}
+
+    def _index_anchor(self, image_guid: UUID, anchor: Anchor) -> None:
+        self._anchors[image_guid][anchor.guid] = anchor
+        self._annotations[anchor.guid] = (image_guid, AnnotationKind.Anchor)
+
+    def _index_bbox(self, image_guid: UUID, bbox: BBox) -> None:
+        self._bboxes[image_guid][bbox.guid] = bbox
+        self._annotations[bbox.guid] = (image_guid, AnnotationKind.BBox)
+
+    def reset_changes(self) -> None:
+        self._dirty: Dict[UUID, None] = {}  # image guids changed since the last save, in the order they first changed
+        self._deleted: Set[UUID] = set()  # image guids deleted since the last save
+
+    def reset_journal_changes(self) -> None:
+        self._journal_dirty: Dict[UUID, None] = {}
+        self._journal_deleted: Set[UUID] = set()
+
+    def mark_dirty(self, image_guid: UUID) -> None:
+        self._dirty[image_guid] = None
+        self._journal_dirty[image_guid] = None
+
+    def mark_deleted(self, image_guid: UUID) -> None:
+        for dirty, deleted in [(self._dirty, self._deleted), (self._journal_dirty, self._journal_deleted)]:
+            dirty.pop(image_guid, None)
+            deleted.add(image_guid)
+
+    def has_changes(self) -> bool:
+        return len(self._dirty) > 0 or len(self._deleted) > 0
+
+    def save_project(self, file_path: str) -> None:
+        if self.project_file is None or self.project_file.file_path != file_path:
+            self.project_file = ProjectFile(file_path)
+
+        self.project_file.save(self.project, self._dirty, self._deleted)
+        self.reset_changes()
+        self.restart_journal()
+
+    def load_project(self, file_path: str) -> None:
+        project_file = ProjectFile(file_path)
+
+        # a loaded project has no reference cycles, collecting while its objects are created would only
+        # rescan the growing project over and over
+        gc.disable()
+
+        try:
+            project = project_file.load()
+            self.project = project
+            self.project_file = project_file
+            self.rebuild_index()
+        finally:
+            gc.enable()
+
+        self.reset_changes()
+        self.restart_journal()
+
+    def attach_journal(self, journal: ProjectJournal) -> None:
+        self.journal = journal
+        self.restart_journal()
+
+    def restart_journal(self) -> None:
+        self.reset_journal_changes()
+
+        if self.journal is not None:
+            self.journal.start(self.project, self.project_file.file_path if self.project_file is not None else None)
+
+    def journal_changes(self) -> None:
+        if self.journal is not None:
+            self.journal.record(self.project, self._journal_dirty, self._journal_deleted)
+            self.reset_journal_changes()
+
+    def recover_project(self, journal: ProjectJournal) -> None:
+        """
+        Restores the project of a journal that was left behind and keeps journaling into it
+        """
+        gc.disable()
+
+        try:
+            project, project_file, changed = journal.recover()
+            self.project = project
+            self.project_file = project_file
+            self.rebuild_index()
+        finally:
+            gc.enable()
+
+        # the restored changes are not saved yet
+        self._dirty = {x: None for x in self.project.data if x in changed}
+        self._deleted = changed - self._dirty.keys()
+        self.journal = journal
+        self.reset_journal_changes()
+
+    def close_journal(self) -> None:
+        """
+        Flushes the journal, it is only kept for the next start if the project has unsaved changes
+        """
+        if self.journal is not None:
+            self.journal_changes()
+            self.journal.close(discard=not self.has_changes())
+            self.journal = None
+
+    def get_anchor(self, image_guid: UUID, anchor_guid: UUID) -> Anchor | None:
+        return self._anchors.get(image_guid, {}).get(anchor_guid)
+
+    def get_bbox(self, image_guid: UUID, bbox_guid: UUID) -> BBox | None:
+        return self._bboxes.get(image_guid, {}).get(bbox_guid)
 
     def flush(self) -> None:
         self.project = ProjectData(
@@ -22,94 +198,150 @@ class DataModel:
             classes=[],
             data={}
         )
+        self.project_file = None
+        self.reset_index()
+        self.reset_changes()
+        self.restart_journal()
 
     def image_exists(self, file_path: str) -> bool:
-        for k, seg_data in self.project.data.items():
-            if seg_data.file_path == file_path:
-                return True
-        return False
+        return file_path in self._file_paths
 
     def get_data(self):
         return self.project
 
-    def add_item(self, data: Dict[UUID, SegmentationData]) -> None:
-        for guid, new_entry in data.items():
-            if not self.image_exists(new_entry.file_path):
-                self.project.data[new_entry.guid] = new_entry
+    def add_item(self, data: Dict[UUID, SegmentationData]) -> List[SegmentationData]:
+        return self.add(data)
+
+    def add(self, data: Dict[UUID, SegmentationData]) -> List[SegmentationData]:
+        """
+        Returns the entries that were actually added, images that are already in the project are skipped
+        """
+        added = []
 
-    def add(self, data: Dict[UUID, SegmentationData]) -> None:
         for guid, new_entry in data.items():
             if not self.image_exists(new_entry.file_path):
                 self.project.data[new_entry.guid] = new_entry
+                self._index_entry(new_entry)
+                self.mark_dirty(new_entry.guid)
+                added.append(new_entry)
+
+        return added
 
 
     def set_classes(self, classes: List[str]):
         self.project.classes = classes
 
     def get_data_by_guid(self, guid: UUID) -> SegmentationData | None:
-        for _guid, _data in self.project.data.items():
-            if guid == _guid:
-                return _data
+        return self.project.data.get(guid)
+
+    def get_neighbours(self, guid: UUID, count: int) -> List[SegmentationData]:
+        """
+        Returns up to count images after and before the given one in project order, closest first
+        """
+        position = self._positions.get(guid)
+
+        if position is None:
+            return []
+
+        after = self._get_live_guids(position, 1, count)
+        before = self._get_live_guids(position, -1, count)
+        neighbours = []
+
+        for distance in range(count):
+            for guids in [after, before]:
+                if distance < len(guids):
+                    neighbours.append(self.project.data[guids[distance]])
 
-        return None
+        return neighbours
+
+    def _get_live_guids(self, position: int, step: int, count: int) -> List[UUID]:
+        """
+        Walks the project order from position in the direction of step and returns up to count images that still exist
+        """
+        guids = []
+        position += step
+
+        while 0 <= position < len(self._order) and len(guids) < count:
+            guid = self._order[position]
+
+            if self._positions.get(guid) == position:
+                guids.append(guid)
+
+            position += step
+
+        return guids
 
     def add_mask_data(self, image_guid: UUID, mask: Image.Image):
         _mask = Mask(
             guid=generate_uuid(),
             x=self.project.data[image_guid].x,
             y=self.project.data[image_guid].y,
-            image=mask)
+            packed=pack_mask(mask))
 
         # zero-ing out the main image as well since an automatically resized bbox can cause offsets when trying to move it back to the original position
         self.project.data[image_guid].x = 0
         self.project.data[image_guid].y = 0
-        self.project.data[image_guid].mask.image = mask
+        self.project.data[image_guid].mask.packed = _mask.packed
+        self.mark_dirty(image_guid)
 
     def get_mask_data(self, image_guid: UUID) -> Mask | None:
-        for guid, entry in self.project.data.items():
-            if image_guid == guid:
-                return entry.mask
-        return None
+        entry = self.project.data.get(image_guid)
+        return entry.mask if entry is not None else None
 
     def add_anchor(self, image_guid: UUID, anchor: Anchor):
-        for guid, entry in self.project.data.items():
-            if image_guid == guid:
-                entry.anchors.append(anchor)
+        entry = self.project.data.get(image_guid)
+
+        if entry is not None:
+            entry.anchors.append(anchor)
+            self._index_anchor(image_guid, anchor)
+            self.mark_dirty(image_guid)
 
     def remove_anchor(self, image_guid: UUID, anchor: Anchor):
-        for guid, entry in self.project.data.items():
-            if image_guid == guid:
-                if anchor in entry.anchors:
-                    entry.anchors.remove(anchor)
-                else:
-                    print(f"WARNING: Tried to remove a non-existing anchor")
+        entry = self.project.data.get(image_guid)
+
+        if entry is not None:
+            if anchor.guid in self._anchors[image_guid]:
+                entry.anchors.remove(self._anchors[image_guid].pop(anchor.guid))
+                self._annotations.pop(anchor.guid, None)
+                self.mark_dirty(image_guid)
+            else:
+                print(f"WARNING: Tried to remove a non-existing anchor")
 
     def add_bbox(self, image_guid: UUID, bbox: BBox):
-        for guid, entry in self.project.data.items():
-            if image_guid == guid:
-                entry.bboxes.append(bbox)
+        entry = self.project.data.get(image_guid)
+
+        if entry is not None:
+            entry.bboxes.append(bbox)
+            self._index_bbox(image_guid, bbox)
+            self.mark_dirty(image_guid)
 
     def remove_bbox(self, image_guid: UUID, bbox: BBox):
-        for guid, entry in self.project.data.items():
-            if image_guid == guid:
-                if bbox in entry.bboxes:
-                    entry.bboxes.remove(bbox)
-                else:
-                    print(f"WARNING: Tried to remove a non-existing BBox")
+        entry = self.project.data.get(image_guid)
+
+        if entry is not None:
+            if bbox.guid in self._bboxes[image_guid]:
+                entry.bboxes.remove(self._bboxes[image_guid].pop(bbox.guid))
+                self._annotations.pop(bbox.guid, None)
+                self.mark_dirty(image_guid)
+            else:
+                print(f"WARNING: Tried to remove a non-existing BBox")
 
     def update_bbox_state(self, image_guid: UUID, state: BBoxState):
-        for _bbox in self.project.data[image_guid].bboxes:
-            if _bbox.guid == state.guid:
-                _bbox.active = state.active
+        _bbox = self.get_bbox(image_guid, state.guid)
+
+        if _bbox is not None:
+            _bbox.active = state.active
+            self.mark_dirty(image_guid)
 
     def update_bbox_label(self, image_guid: UUID, bbox_guid: UUID, label: str):
-        for _bbox in self.project.data[image_guid].bboxes:
-            if _bbox.guid == bbox_guid:
-                _bbox.name = label
-                if not label in self.project.classes:
-                    self.project.classes.append(label)
-                    self.cleanup_classes()
-                return
+        _bbox = self.get_bbox(image_guid, bbox_guid)
+
+        if _bbox is not None:
+            _bbox.name = label
+            self.mark_dirty(image_guid)
+            if not label in self.project.classes:
+                self.project.classes.append(label)
+                self.cleanup_classes()
 
     def cleanup_classes(self):
         """
@@ -125,118 +357,142 @@ class DataModel:
         self.project.classes = _classes
 
     def update_image_position(self, image_position: ImagePosition):
-        if self.project.data is None or len(self.project.data) == 0:
-            return
+        _data = self.project.data.get(image_position.guid)
 
-        for _guid, _data in self.project.data.items():
-            if _guid == image_position.guid:
-                _data.x = image_position.x
-                _data.y = image_position.y
+        if _data is not None:
+            _data.x = image_position.x
+            _data.y = image_position.y
+            self.mark_dirty(_data.guid)
 
 
     def update_mask_position(self, mask_position: MaskPosition):
-        for _guid, _data in self.project.data.items():
-            if _data.mask.guid == mask_position.guid:
-                _data.mask.x = mask_position.x
-                _data.mask.y = mask_position.y
+        _data = self.project.data.get(self._masks.get(mask_position.guid))
+
+        if _data is not None:
+            _data.mask.x = mask_position.x
+            _data.mask.y = mask_position.y
+            self.mark_dirty(_data.guid)
 
 
     def update_bbox_position(self, image_guid: UUID, bbox_position: BBoxPosition):
-        if self.project.data is None or len(self.project.data) == 0:
-            return
+        _bbox = self.get_bbox(image_guid, bbox_position.guid)
 
-        for _bbox in self.project.data[image_guid].bboxes:
-            if _bbox.guid == bbox_position.guid:
-                _bbox.x = bbox_position.x
-                _bbox.y = bbox_position.y
-                _bbox.w = bbox_position.w
-                _bbox.h = bbox_position.h
+        if _bbox is not None:
+            _bbox.x = bbox_position.x
+            _bbox.y = bbox_position.y
+            _bbox.w = bbox_position.w
+            _bbox.h = bbox_position.h
+            self.mark_dirty(image_guid)
 
     def update_anchor_position(self, image_guid: UUID, anchor_position: AnchorPosition):
-        if self.project.data is None or len(self.project.data) == 0:
-            return
+        _anchor = self.get_anchor(image_guid, anchor_position.guid)
 
-        for _anchor in self.project.data[image_guid].anchors:
-            if _anchor.guid == anchor_position.guid:
-                _anchor.x = anchor_position.x
-                _anchor.y = anchor_position.y
+        if _anchor is not None:
+            _anchor.x = anchor_position.x
+            _anchor.y = anchor_position.y
+            self.mark_dirty(image_guid)
 
     def update_sam_result(self, result: SamResult):
-        for _guid, _data in self.project.data.items():
-            if result.image_guid == _guid:
-                if result.bbox is not None:
-                    for _bbox in _data.bboxes:
-                        if result.bbox.guid == _bbox.guid:
-                            _bbox.x = result.bbox.x
-                            _bbox.y = result.bbox.y
-                            _bbox.w = result.bbox.w
-                            _bbox.h = result.bbox.h
-
-                if result.anchors is not None:
-                    for _project_anchor in _data.anchors:
-                        for _result_anchor in result.anchors:
-                            if _result_anchor.guid == _project_anchor.guid:
-                                _project_anchor.x = _result_anchor.x
-                                _project_anchor.y = _result_anchor.y
-
-                _data.mask.x = 0
-                _data.mask.y = 0
-                _data.mask.image = result.mask
-
-                # zero-ing out the original image and mask to avoid offsets, maybe change that later
-                _data.x = 0
-                _data.y = 0
+        _data = self.project.data.get(result.image_guid)
+
+        if _data is None:
+            return
+
+        if result.bbox is not None:
+            _bbox = self.get_bbox(result.image_guid, result.bbox.guid)
+
+            if _bbox is not None:
+                _bbox.x = result.bbox.x
+                _bbox.y = result.bbox.y
+                _bbox.w = result.bbox.w
+                _bbox.h = result.bbox.h
+
+        if result.anchors is not None:
+            for _result_anchor in result.anchors:
+                _project_anchor = self.get_anchor(result.image_guid, _result_anchor.guid)
+
+                if _project_anchor is not None:
+                    _project_anchor.x = _result_anchor.x
+                    _project_anchor.y = _result_anchor.y
+
+        _data.mask.x = 0
+        _data.mask.y = 0
+        _data.mask.packed = result.mask
+
+        # zero-ing out the original image and mask to avoid offsets, maybe change that later
+        _data.x = 0
+        _data.y = 0
+        self.mark_dirty(_data.guid)
 
     def update_sam_batch_result(self, result: BatchSamResult):
-        for _guid, _data in self.project.data.items():
-            if result.image_guid == _guid:
-                for _bbox in _data.bboxes:
-                    for _result_bbox in result.bboxes:
-                        if _result_bbox.guid == _bbox.guid:
-                            _bbox.x = _result_bbox.x
-                            _bbox.y = _result_bbox.y
-                            _bbox.w = _result_bbox.w
-                            _bbox.h = _result_bbox.h
-
-                # zero-ing out the original image and mask to avoid offsets, maybe change that later
-                _data.mask.x = 0
-                _data.mask.y = 0
-                _data.mask.image = result.mask
-
-                _data.x = 0
-                _data.y = 0
+        _data = self.project.data.get(result.image_guid)
+
+        if _data is None:
+            return
+
+        for _result_bbox in result.bboxes:
+            _bbox = self.get_bbox(result.image_guid, _result_bbox.guid)
+
+            if _bbox is not None:
+                _bbox.x = _result_bbox.x
+                _bbox.y = _result_bbox.y
+                _bbox.w = _result_bbox.w
+                _bbox.h = _result_bbox.h
+
+        # zero-ing out the original image and mask to avoid offsets, maybe change that later
+        _data.mask.x = 0
+        _data.mask.y = 0
+        _data.mask.packed = result.mask
+
+        _data.x = 0
+        _data.y = 0
+        self.mark_dirty(_data.guid)
 
     def update_zoom_level(self, zoom_level: ZoomLevel):
         print(f"Updating ZoomLevel: {zoom_level.image_guid}, zoom level: {zoom_level.factor}")
-        for _guid, _data in self.project.data.items():
-            if _guid == zoom_level.image_guid:
-                _data.zoom = zoom_level.factor
-
-    def delete_item(self, guid: UUID):
-        for _guid, _data in self.project.data.items():
-            if _guid == guid:
-                self.project.data.pop(_guid)
-                return
-
-            for _anchor in _data.anchors:
-                if _anchor.guid == guid:
-                    _data.anchors.remove(_anchor)
-                    return
-
-            for _bbox in _data.bboxes:
-                if _bbox.guid == guid:
-                    _data.bboxes.remove(_bbox)
-                    return
+        _data = self.project.data.get(zoom_level.image_guid)
 
-    def delete_annotations(self, image_guid: UUID):
-        keys = list(self.project.data.keys())
+        if _data is not None:
+            _data.zoom = zoom_level.factor
+            self.mark_dirty(_data.guid)
 
-        if image_guid in keys:
+    def delete_item(self, guid: UUID) -> Tuple[UUID, AnnotationKind | None] | None:
+        """
+        Deletes an image or an annotation, returns the guid of the affected image and the kind of the deleted
+        annotation (None if the image itself was deleted), or None if nothing matched
+        """
+        if guid in self.project.data:
+            self._unindex_entry(self.project.data.pop(guid))
+            self.mark_deleted(guid)
+            return guid, None
+
+        if guid not in self._annotations:
+            return None
+
+        image_guid, kind = self._annotations.pop(guid)
+        _data = self.project.data[image_guid]
+
+        if kind == AnnotationKind.Anchor:
+            _data.anchors.remove(self._anchors[image_guid].pop(guid))
+        else:
+            _data.bboxes.remove(self._bboxes[image_guid].pop(guid))
+
+        self.mark_dirty(image_guid)
+        return image_guid, kind
+
+    def delete_annotations(self, image_guid: UUID):
+        if image_guid in self.project.data:
             self.project.data[image_guid].bboxes = []
             self.project.data[image_guid].anchors = []
+            self._unindex_annotations(image_guid)
+            self.mark_dirty(image_guid)
 
         else:
             print(f"WARNING: Tried to delete annotations for non-existing image guid: {image_guid}")
 
     def delete_all_images(self):
-        self.project.data = {}
\ No newline at end of file
+        for guid in self.project.data:
+            self.mark_deleted(guid)
+
+        self.project.data = {}
+        self.reset_index()
@@ -3,17 +3,23 @@ import shutil
 
 from PIL import Image
 from uuid import UUID
+from typing import List
+from copy import deepcopy
 from SamGui.Styles import DARK_STYLE
 from SamGui.MVVM.viewmodel import SamViewModel
 from SamGui.Controller import HeaderController
+from SamGui.Runners import EmbeddingScheduler, PreviewScheduler, YoloImportScheduler
 from SamGui.Utils import get_filename, generate_uuid, create_dir
+from SamGui.Project import PROJECT_EXTENSION
+from SamGui.Journal import ProjectJournal
 from SamGui.Data import SegmentationData, Anchor, BBox, Mask, SAMMode, YoloAnnotations, SamResult, BatchSamResult, \
-    CroppedExportData, MaskExportData, ProjectData, BBoxPosition, AnchorPosition, ErrorMessage
+    CroppedExportData, MaskExportData, ProjectData, BBoxPosition, AnchorPosition, ErrorMessage, PreviewRequest, \
+    ImportChunk
 from SamGui.Widgets.Layout import Header, MainHierarchy, CanvasPanel
 from SamGui.Widgets.Dialogs import SamDialog, NotificationWindow, SettingsWindow, ImportProjectDialog, \
-    PickDirectoryDialog
+    PickDirectoryDialog, ConfirmationWindow
 
-from PySide6.QtCore import QThreadPool
+from PySide6.QtCore import QThreadPool, QTimer
 from PySide6.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QFileDialog, QPushButton, QLabel, \
     QTableWidget, QLineEdit, QTableWidgetItem
 
@@ -202,10 +208,15 @@ class AppView(QWidget):
         self.setWindowTitle("SamGui 1.0")
         self.debug_view = None
         self.threadpool = QThreadPool()
+        self.embedding_scheduler = EmbeddingScheduler(parent=self)
+        self.preview_scheduler = PreviewScheduler(parent=self)
+        self.import_scheduler = YoloImportScheduler(parent=self)
         # create controllers
         self.header_controller = HeaderController()
         self.sam_mode = SAMMode.bbox
         self.adjust_bbox = True
+        self.live_preview = False
+        self.low_res = False
         self.current_guid = None
 
         # create main widgets
@@ -220,16 +231,36 @@ class AppView(QWidget):
         self.header_controller.s_import_images.connect(self.import_images)
         self.header_controller.s_import_project.connect(self.import_project)
         self.header_controller.s_export_project.connect(self.batch_export_yolo)
+        self.header_controller.s_save_annotations.connect(self.save_project)
+        self.header_controller.s_import_annotations.connect(self.open_project)
         self.header_controller.s_run_sam.connect(self.run_sam)
         self.header_controller.s_open_sam_settings.connect(self.show_sam_settings)
         self.header_controller.s_toggle_debug.connect(self.toggle_debug_view)
 
         self.view_model.s_dataSelected.connect(self.handle_data_selection)
+        self.view_model.s_imagesAdded.connect(self.precompute_embeddings)
+        self.view_model.s_imagesRemoved.connect(self.handle_images_removed)
+        self.view_model.s_dataCleared.connect(self.handle_data_cleared)
         self.view_model.s_exportMasKData.connect(self.export_full_mask)
         self.view_model.s_exportCroppedData.connect(self.export_cropped_data)
         self.view_model.s_export_yolo_data.connect(self.export_annotations)
         self.view_model.s_error.connect(self.handle_error)
 
+        self.embedding_scheduler.s_status.connect(self.main_hierarchy.image_list.set_embedding_state)
+        self.embedding_scheduler.s_progress.connect(self.main_hierarchy.image_list.set_embedding_progress)
+        self.main_hierarchy.image_list.s_cancel_embeddings.connect(self.embedding_scheduler.cancel)
+
+        self.import_scheduler.s_chunk.connect(self.handle_import_chunk)
+        self.import_scheduler.s_progress.connect(self.main_hierarchy.image_list.set_import_progress)
+        self.import_scheduler.s_finished.connect(self.handle_import_finished)
+        self.main_hierarchy.image_list.s_cancel_import.connect(self.import_scheduler.cancel)
+
+        # connected after the CanvasPanel, so the model already holds the moved prompt when the preview is requested
+        self.canvas_panel.canvas_controller.s_update_bbox_position.connect(self.request_preview)
+        self.canvas_panel.canvas_controller.s_update_anchor_position.connect(self.request_preview)
+        self.preview_scheduler.s_preview.connect(self.canvas_panel.canvas.show_preview)
+        self.view_model.s_maskUpdated.connect(self.handle_mask_updated)
+
         # build layout
         self.main_layout = QVBoxLayout()
         self.right_panel = QVBoxLayout()
@@ -246,12 +277,125 @@ class AppView(QWidget):
 
         self.setStyleSheet(DARK_STYLE)
 
+        # changes are handed to the journal once per interval, so a drag only marks its image dirty
+        self.journal_timer = QTimer(self)
+        self.journal_timer.setInterval(1000)
+        self.journal_timer.timeout.connect(self.view_model.journal_changes)
+        self.journal_timer.start()
+        QTimer.singleShot(0, self.restore_session)
+
+    def closeEvent(self, event):
+        self.journal_timer.stop()
+        self.import_scheduler.cancel()
+        self.view_model.close_journal()
+        self.embedding_scheduler.shutdown()
+        super().closeEvent(event)
+
+    def restore_session(self):
+        journal = ProjectJournal()
+
+        if journal.has_recovery():
+            dialog = ConfirmationWindow(
+                "Restore Session",
+                "The last session was not saved. Do you want to restore its annotations?"
+            )
+
+            if dialog.exec():
+                self.view_model.recover_session(journal)
+                return
+
+        self.view_model.attach_journal(journal)
+
     def set_new_project(self):
+        self.import_scheduler.cancel()
+        self.embedding_scheduler.clear()
         self.view_model.clear_project()
         self.canvas_panel.canvas_controller.clear_data()
 
+    def save_project(self):
+        file_path = self.view_model.get_project_path()
+
+        if file_path is None:
+            file_path, _ = QFileDialog.getSaveFileName(
+                self, "Save Project", "", f"SamGui Project (*{PROJECT_EXTENSION})"
+            )
+
+            if file_path == "":
+                return
+
+            if not file_path.endswith(PROJECT_EXTENSION):
+                file_path += PROJECT_EXTENSION
+
+        self.view_model.save_project(file_path)
+
+    def open_project(self):
+        file_path, _ = QFileDialog.getOpenFileName(
+            self, "Open Project", "", f"SamGui Project (*{PROJECT_EXTENSION})"
+        )
+
+        if file_path == "":
+            return
+
+        self.import_scheduler.cancel()
+        self.embedding_scheduler.clear()
+        self.canvas_panel.canvas_controller.clear_data()
+        self.view_model.open_project(file_path)
+
     def handle_data_selection(self, data: SegmentationData):
         self.current_guid = data.guid
+        self.preview_scheduler.cancel()
+        self.embedding_scheduler.prioritize(data.guid)
+
+    def handle_mask_updated(self, image_guid: UUID):
+        # a preview that is still pending or running would hide the new SAM result once it arrives
+        if image_guid == self.canvas_panel.current_image_guid:
+            self.preview_scheduler.cancel()
+
+    def request_preview(self, _position):
+        if not self.live_preview:
+            return
+
+        current_image_guid = self.canvas_panel.current_image_guid
+        data = self.view_model.get_data_by_guid(current_image_guid) if current_image_guid is not None else None
+
+        if data is None:
+            return
+
+        # the runner reads the prompts on another thread while the drag keeps changing them
+        request = PreviewRequest(
+            image_guid=data.guid,
+            file_path=data.file_path,
+            mode=self.sam_mode,
+            anchors=deepcopy(data.anchors),
+            bboxes=deepcopy(data.bboxes),
+            x=data.x,
+            y=data.y
+        )
+        self.preview_scheduler.request(request)
+
+    def precompute_embeddings(self, images: List[SegmentationData]):
+        if not self.embedding_scheduler.is_available():
+            return
+
+        images = {data.guid: data.file_path for data in images}
+        self.embedding_scheduler.enqueue(images)
+
+        if self.current_guid is not None:
+            self.embedding_scheduler.prioritize(self.current_guid)
+
+    def handle_images_removed(self, guids: List[UUID]):
+        for guid in guids:
+            self.embedding_scheduler.remove(guid)
+
+        if self.current_guid in guids:
+            self.preview_scheduler.cancel()
+            self.current_guid = None
+
+    def handle_data_cleared(self):
+        self.import_scheduler.cancel()
+        self.embedding_scheduler.cancel()
+        self.preview_scheduler.cancel()
+        self.current_guid = None
 
     def import_images(self):
         dialog = QFileDialog(self)
@@ -279,7 +423,7 @@ class AppView(QWidget):
                             guid=generate_uuid(),
                             x=0,
                             y=0,
-                            image=None
+                            packed=None
                         ),
                         zoom=1.0
                     )
@@ -296,18 +440,42 @@ class AppView(QWidget):
         labels = import_dialog.labels
         classes = import_dialog.classes
 
-        self.view_model.import_yolo_data(images, labels, classes)
+        if len(images) == 0:
+            return
+
+        # the images are added chunk by chunk while the rest of the dataset is read in the background
+        self.import_scheduler.start(images, labels, classes)
+
+    def handle_import_chunk(self, chunk: ImportChunk):
+        self.view_model.import_data(chunk.data, self.import_scheduler.classes)
+
+    def handle_import_finished(self, failed: List[str]):
+        if len(failed) == 0:
+            return
+
+        names = ", ".join(get_filename(x) for x in failed[:10])
+        more = f" and {len(failed) - 10} more" if len(failed) > 10 else ""
+        error_msg = ErrorMessage(
+            "Import incomplete",
+            f"{len(failed)} images or their labels could not be read: {names}{more}"
+        )
+        self.handle_error(error_msg)
 
 
     def toggle_debug_view(self):
         self.debug_view = DebugView("Debug View", self.current_guid, self.view_model)
 
     def show_sam_settings(self):
-        dialog = SettingsWindow(self.sam_mode, self.adjust_bbox)
+        dialog = SettingsWindow(self.sam_mode, self.adjust_bbox, self.live_preview, self.low_res)
 
         if dialog.exec():
             self.sam_mode = dialog.current_mode
             self.adjust_bbox = dialog.adjust_bbox
+            self.live_preview = dialog.live_preview
+            self.low_res = dialog.low_res
+
+            if not self.live_preview:
+                self.preview_scheduler.cancel()
 
     def run_sam(self):
         project_data = self.view_model.get_data()
@@ -336,11 +504,16 @@ class AppView(QWidget):
             return
 
         else:
-            dialog = SamDialog(_data, self.sam_mode, self.adjust_bbox, self.threadpool, self)
+            dialog = SamDialog(_data, self.sam_mode, self.adjust_bbox, self.threadpool, self.low_res, self)
             dialog.sign_result.connect(self.save_generated_mask)
             dialog.sign_sam_result.connect(self.handle_sam_result)
             dialog.sign_batch_result.connect(self.handle_sam_batch_result)
             dialog.s_error.connect(self.handle_error)
+            dialog.finished.connect(self.embedding_scheduler.resume)
+
+            # keep the background encoding from competing with the interactive run
+            self.preview_scheduler.cancel()
+            self.embedding_scheduler.pause()
             dialog.exec()
 
 
@@ -3,7 +3,9 @@ from PIL import Image
 from PySide6.QtCore import QObject, Signal
 from typing import Dict, List, Tuple
 from SamGui.MVVM.model import DataModel
-from SamGui.Utils import create_crop_image, generate_uuid, get_filename
+from SamGui.Journal import ProjectJournal
+from SamGui.Cache import get_image_size_cache
+from SamGui.Utils import create_crop_image, unpack_mask_image
 from SamGui.Data import (
     Mask,
     SegmentationData,
@@ -15,16 +17,24 @@ from SamGui.Data import (
     ProjectData,
     YoloAnnotation,
     YoloAnnotations, SamResult, BatchSamResult, ZoomLevel, MaskExportData, CroppedExportData, ImagePosition,
-    MaskPosition, ErrorMessage
+    MaskPosition, ErrorMessage, AnnotationDelta, AnnotationKind
 )
 
 
 class SamViewModel(QObject):
-    s_dataAdded = Signal(ProjectData)
-    s_dataChanged = Signal(ProjectData)
+    """
+    Changes to the project are announced as deltas that carry the guids of what changed, so that the views can patch
+    their state instead of rebuilding it from the whole project.
+    """
+    s_imagesAdded = Signal(list)  # List[SegmentationData] of the newly added images
+    s_imagesRemoved = Signal(list)  # List[UUID]
     s_dataSelected = Signal(SegmentationData)
-    s_dataRemoved = Signal(SegmentationData)
     s_dataCleared = Signal()
+    s_annotationAdded = Signal(AnnotationDelta)
+    s_annotationMoved = Signal(AnnotationDelta)
+    s_annotationRemoved = Signal(AnnotationDelta)
+    s_annotationsCleared = Signal(UUID)  # image guid
+    s_maskUpdated = Signal(UUID)  # image guid
     s_maskSelected = Signal(Mask)
     s_exportMasKData = Signal(MaskExportData)
     s_exportCroppedData = Signal(CroppedExportData)
@@ -43,24 +53,91 @@ class SamViewModel(QObject):
 
     def clear_project(self):
         self.model.flush()
-        self.s_dataChanged.emit(self.model.get_data())
+        self.s_dataCleared.emit()
 
     def add_data(self, data: Dict[UUID, SegmentationData]):
-        self.model.add(data)
-        # TODO: check again the difference between dataAdded and dataChanged events, maybe one is enough
-        self.s_dataAdded.emit(self.model.project)
-        self.s_dataChanged.emit(self.model.project)
+        added = self.model.add(data)
+
+        if len(added) > 0:
+            self.s_imagesAdded.emit(added)
 
     def import_data(self, data: Dict[UUID, SegmentationData], classes: List[str]):
-        self.model.add(data)
+        added = self.model.add(data)
         self.model.set_classes(classes)
-        # TODO: check again the difference between dataAdded and dataChanged events, maybe one is enough
-        self.s_dataAdded.emit(self.model.project)
-        self.s_dataChanged.emit(self.model.project)
+
+        if len(added) > 0:
+            self.s_imagesAdded.emit(added)
+
+    def save_project(self, file_path: str):
+        try:
+            self.model.save_project(file_path)
+
+        except OSError as e:
+            error_msg = ErrorMessage(
+                "Failed to save project",
+                f"The project could not be saved to {file_path}: {e}"
+            )
+            self.s_error.emit(error_msg)
+
+    def open_project(self, file_path: str):
+        try:
+            self.model.load_project(file_path)
+
+        except (OSError, ValueError, KeyError) as e:
+            error_msg = ErrorMessage(
+                "Failed to open project",
+                f"{file_path} could not be opened: {e}"
+            )
+            self.s_error.emit(error_msg)
+            return
+
+        self.s_dataCleared.emit()
+
+        if len(self.model.project.data) > 0:
+            self.s_imagesAdded.emit(list(self.model.project.data.values()))
+
+    def attach_journal(self, journal: ProjectJournal):
+        self.model.attach_journal(journal)
+
+    def recover_session(self, journal: ProjectJournal):
+        try:
+            self.model.recover_project(journal)
+
+        except (OSError, ValueError, KeyError) as e:
+            error_msg = ErrorMessage(
+                "Failed to restore session",
+                f"The journal {journal.file_path} could not be restored: {e}"
+            )
+            self.s_error.emit(error_msg)
+            self.model.attach_journal(journal)
+            return
+
+        self.s_dataCleared.emit()
+
+        if len(self.model.project.data) > 0:
+            self.s_imagesAdded.emit(list(self.model.project.data.values()))
+
+    def journal_changes(self):
+        self.model.journal_changes()
+
+    def close_journal(self):
+        self.model.close_journal()
+
+    def get_project_path(self) -> str | None:
+        return self.model.project_file.file_path if self.model.project_file is not None else None
 
     def delete_item_by_guid(self, guid: UUID):
-        self.model.delete_item(guid)
-        self.s_dataChanged.emit(self.model.project)
+        deleted = self.model.delete_item(guid)
+
+        if deleted is None:
+            return
+
+        image_guid, kind = deleted
+
+        if kind is None:
+            self.s_imagesRemoved.emit([image_guid])
+        else:
+            self.s_annotationRemoved.emit(AnnotationDelta(image_guid, guid, kind))
 
     def select_data_by_guid(self, guid: UUID):
         self.s_dataSelected.emit(guid)
@@ -73,14 +150,16 @@ class SamViewModel(QObject):
 
     def add_mask(self, image_guid: UUID, mask: Image.Image):
         self.model.add_mask_data(image_guid, mask)
-        self.s_dataChanged.emit(self.model.project)
+        self.s_maskUpdated.emit(image_guid)
 
     def add_anchor(self, image_guid: UUID, anchor: Anchor):
         self.model.add_anchor(image_guid, anchor)
+        self.s_annotationAdded.emit(AnnotationDelta(image_guid, anchor.guid, AnnotationKind.Anchor))
         self.s_debugUpdate.emit(self.model.project)
 
     def add_bbox(self, image_guid: UUID, bbox: BBox):
         self.model.add_bbox(image_guid, bbox)
+        self.s_annotationAdded.emit(AnnotationDelta(image_guid, bbox.guid, AnnotationKind.BBox))
         self.s_debugUpdate.emit(self.model.project)
 
     def remove_bbox(self, image_guid: UUID, bbox: BBox):
@@ -94,7 +173,7 @@ class SamViewModel(QObject):
 
     def update_bbox_state(self, mask_guid: UUID, state: BBoxState):
         self.model.update_bbox_state(mask_guid, state)
-        self.s_dataChanged.emit(self.model.project)
+        self.s_debugUpdate.emit(self.model.project)
 
     def update_bbox_label(self, image_guid: UUID, bbox_guid: UUID, label: str):
         self.model.update_bbox_label(image_guid, bbox_guid, label)
@@ -103,19 +182,33 @@ class SamViewModel(QObject):
 
     def update_anchor_position(self, image_guid: UUID, position: AnchorPosition):
         self.model.update_anchor_position(image_guid, position)
+        self.s_annotationMoved.emit(AnnotationDelta(image_guid, position.guid, AnnotationKind.Anchor))
         self.s_debugUpdateAnchor.emit(position)
 
     def update_bbox_position(self, image_guid: UUID, position: BBoxPosition):
         self.model.update_bbox_position(image_guid, position)
+        self.s_annotationMoved.emit(AnnotationDelta(image_guid, position.guid, AnnotationKind.BBox))
         self.s_debugUpdateBBoxData.emit(position)
 
     def update_sam_result(self, result: SamResult):
         self.model.update_sam_result(result)
-        self.s_dataChanged.emit(self.model.project)
+
+        if result.bbox is not None:
+            self.s_annotationMoved.emit(AnnotationDelta(result.image_guid, result.bbox.guid, AnnotationKind.BBox))
+
+        if result.anchors is not None:
+            for anchor in result.anchors:
+                self.s_annotationMoved.emit(AnnotationDelta(result.image_guid, anchor.guid, AnnotationKind.Anchor))
+
+        self.s_maskUpdated.emit(result.image_guid)
 
     def update_sam_batch_result(self, result: BatchSamResult):
         self.model.update_sam_batch_result(result)
-        self.s_dataChanged.emit(self.model.project)
+
+        for bbox in result.bboxes:
+            self.s_annotationMoved.emit(AnnotationDelta(result.image_guid, bbox.guid, AnnotationKind.BBox))
+
+        self.s_maskUpdated.emit(result.image_guid)
 
     def update_zoom_level(self, zoom_level: ZoomLevel):
         self.model.update_zoom_level(zoom_level)
@@ -126,20 +219,38 @@ class SamViewModel(QObject):
     def get_data_by_guid(self, guid: UUID):
         return self.model.get_data_by_guid(guid)
 
+    def get_neighbours(self, guid: UUID, count: int) -> List[SegmentationData]:
+        return self.model.get_neighbours(guid, count)
+
+    def get_anchor(self, image_guid: UUID, anchor_guid: UUID) -> Anchor | None:
+        return self.model.get_anchor(image_guid, anchor_guid)
+
+    def get_bbox(self, image_guid: UUID, bbox_guid: UUID) -> BBox | None:
+        return self.model.get_bbox(image_guid, bbox_guid)
+
     def delete_images(self):
         self.model.delete_all_images()
-        self.s_dataChanged.emit(self.model.get_data())
+        self.s_dataCleared.emit()
 
     def delete_annotations(self, image_guid: UUID):
         self.model.delete_annotations(image_guid)
-        self.s_dataChanged.emit(self.model.get_data())
+        self.s_annotationsCleared.emit(image_guid)
+
+    @staticmethod
+    def get_image_size(data: SegmentationData) -> Tuple[int, int]:
+        """
+        Returns the size recorded on import, images that were imported without one are looked up by their header
+        """
+        if data.width is not None and data.height is not None:
+            return data.width, data.height
+
+        return get_image_size_cache().get(data.file_path)
 
     def build_yolo_annotations(self, data: SegmentationData) -> YoloAnnotations | None:
         if len(data.bboxes) > 0:
             _yolo_annotations = []
             project_classes = self.model.project.classes
-            image = Image.open(data.file_path).convert("RGB")
-            width, height = image.size
+            width, height = self.get_image_size(data)
 
             for bbox in data.bboxes:
                 if bbox.name not in project_classes:
@@ -163,8 +274,6 @@ class SamViewModel(QObject):
                     width_norm,
                     height_norm
                 )
-                print(f"Incoming BBox => x: {bbox.x}, y: {bbox.y}, w: {bbox.w}, h: {bbox.h}")
-                print(f"Exporting Yolo annotation => x_center: {yolo_annotation.center_x}, y_center: {yolo_annotation.center_y}, bbox_w: {yolo_annotation.width}, bbox_h: {yolo_annotation.height}")
 
                 _yolo_annotations.append(yolo_annotation)
 
@@ -177,78 +286,6 @@ class SamViewModel(QObject):
 
         return None
 
-    def import_yolo_data(self, images: List[str], labels: List[str], classes: List[str]):
-        segmentation_data = {}
-
-        for _image, _label in zip(images, labels):
-            guid = generate_uuid()
-            file_name = get_filename(_image)
-
-            try:
-                image = Image.open(_image).convert("RGB")
-
-            except IOError as e:
-                print(f"Import Error: {e}")
-                continue
-
-            width, height = image.size
-            _bboxes = []
-
-            with open(_label, "r") as f:
-                _label_data = f.readlines()
-
-                for _lbl in _label_data:
-                    class_idx, yolo_center_x, yolo_center_y, yolo_bbox_w, yolo_bbox_h = _lbl.split(" ")
-
-                    if len(classes) == 0:
-                        class_name = "BBox"
-
-                    elif class_idx == "999":
-                        class_name = "BBox"
-
-                    else:
-                        class_name = classes[int(class_idx)]
-
-                    bbox_width = float(yolo_bbox_w) * width
-                    bbox_height = float(yolo_bbox_h) * height
-                    x_center = float(yolo_center_x) * width
-                    y_center = float(yolo_center_y) * height
-
-                    x = x_center - (bbox_width / 2)
-                    y = y_center - (bbox_height / 2)
-
-                    bbox = BBox(
-                        guid=generate_uuid(),
-                        name=class_name,
-                        active=True,
-                        x = x,
-                        y = y,
-                        w = bbox_width,
-                        h = bbox_height,
-                    )
-
-                    _bboxes.append(bbox)
-
-            data = SegmentationData(
-                guid=guid,
-                file_path=_image,
-                file_name=file_name,
-                x=0,
-                y=0,
-                anchors=[],
-                bboxes=_bboxes,
-                mask=Mask(
-                    guid=generate_uuid(),
-                    x=0,
-                    y=0,
-                    image=None
-                ),
-                zoom=1.0
-            )
-
-            segmentation_data[guid] = data
-        self.import_data(segmentation_data, classes)
-
     def export_yolo_annotations(self, image_guid: UUID):
         data = self.model.get_data()
         segmentation_data = data.data[image_guid]
@@ -269,8 +306,8 @@ class SamViewModel(QObject):
         segmentation_data = project_data.data[image_guid]
         mask_data = segmentation_data.mask
 
-        if mask_data is not None and mask_data.image is not None:
-            mask_image = mask_data.image
+        if mask_data is not None and mask_data.packed is not None:
+            mask_image = unpack_mask_image(mask_data.packed)
             export_data = MaskExportData(
                 file_name=segmentation_data.file_name,
                 masks=[mask_image]
@@ -300,17 +337,18 @@ class SamViewModel(QObject):
         image_path = segmentation_data.file_path
         image = Image.open(image_path)
 
-        if mask_data is not None and mask_data.image is not None and image_path is not None:
+        if mask_data is not None and mask_data.packed is not None and image_path is not None:
             if len(segmentation_data.bboxes) > 0:
                 crop_imgs = []
                 crop_masks = []
+                mask_image = unpack_mask_image(mask_data.packed)
 
                 for bbox in segmentation_data.bboxes:
                     x_pos = segmentation_data.x
                     y_pos = segmentation_data.y
 
                     crop_img = create_crop_image(image, bbox, x_pos, y_pos)
-                    crop_mask = create_crop_image(mask_data.image, bbox, x_pos, y_pos)
+                    crop_mask = create_crop_image(mask_image, bbox, x_pos, y_pos)
                     crop_imgs.append(crop_img)
                     crop_masks.append(crop_mask)
 
@@ -0,0 +1,354 @@
+"""
+The native project file. It starts with a fixed size header, followed by segments that each hold the mask blobs
+and a JSON index of the entries that changed since the previous save:
+
+    header | blobs, index | blobs, index | ...
+
+Every index links to the previous one and the header points to the latest. An entry, or its deletion, in a newer
+index shadows the older ones. A save appends a segment and only then rewrites the header, so an interrupted save
+leaves the previous state readable. Once the superseded data outweighs the live data, the file is rewritten
+as a single segment.
+"""
+
+import os
+import json
+import mmap
+import struct
+
+from uuid import UUID
+from typing import Dict, Iterable, List, Set, Tuple
+from SamGui.Data import Anchor, BBox, Mask, PackedMask, ProjectData, SegmentationData
+
+
+PROJECT_EXTENSION = ".samgui"
+PROJECT_MAGIC = b"SAMGUIPJ"
+PROJECT_VERSION = 1
+PROJECT_HEADER = struct.Struct("<8sIIQQ")  # magic, version, reserved, offset and length of the latest index
+
+
+def encode_project(project: ProjectData) -> dict:
+    return {
+        "guid": str(project.guid),
+        "name": project.name,
+        "classes": list(project.classes)
+    }
+
+
+def encode_entry(entry: SegmentationData) -> Tuple[dict, PackedMask | None]:
+    """
+    Returns the index record of an entry and its packed mask. The record is detached from the entry and
+    the position of the mask blob is only added once the blob is written.
+    """
+    mask = None
+    packed = None
+
+    if entry.mask is not None:
+        packed = entry.mask.packed
+        blob = None
+
+        if packed is not None:
+            blob = [packed.width, packed.height, packed.x, packed.y, packed.crop_width, packed.crop_height]
+
+        mask = [str(entry.mask.guid), entry.mask.x, entry.mask.y, blob]
+
+    record = {
+        "guid": str(entry.guid),
+        "file_path": entry.file_path,
+        "file_name": entry.file_name,
+        "x": entry.x,
+        "y": entry.y,
+        "zoom": entry.zoom,
+        "width": entry.width,
+        "height": entry.height,
+        "anchors": [[str(x.guid), x.class_id, x.active, x.x, x.y] for x in entry.anchors],
+        "bboxes": [[str(x.guid), x.name, x.active, x.x, x.y, x.w, x.h] for x in entry.bboxes],
+        "mask": mask
+    }
+
+    return record, packed
+
+
+class ProjectFile:
+    """
+    Reads and writes a project file. The file is memory-mapped on load and the bits of every loaded mask are a view
+    into the mapping, so masks are only paged in once they are unpacked for display or export.
+    With rebind_masks the masks of a rewritten file are pointed to the new mapping as well, which is only safe for
+    the thread that owns the project.
+    """
+    def __init__(self, file_path: str, max_segments: int = 256, rebind_masks: bool = True):
+        self.file_path = file_path
+        self.max_segments = max_segments
+        self.rebind_masks = rebind_masks
+        self._mmap: mmap.mmap | None = None
+        self._view: memoryview | None = None
+        self._retired: List[mmap.mmap] = []  # previous mappings that masks still pointed into when they were replaced
+        self._index: Tuple[int, int] | None = None  # offset and length of the latest index in the file
+        self._segments = 0
+        self._blobs: Dict[str, Tuple[PackedMask, int, int]] = {}  # image guid -> stored mask, offset, length
+        self._blob_bytes = 0  # bytes of the blobs that are still referenced
+        self._file_size = 0
+
+    def is_open(self) -> bool:
+        return self._index is not None
+
+    def read_index(self) -> Tuple[dict, Dict[str, dict], Set[str]]:
+        """
+        Replays the indexes of the file, returns the project metadata, the latest record of every entry and the
+        guids of the entries that were deleted
+        """
+        self.map()
+
+        if len(self._mmap) < PROJECT_HEADER.size:
+            raise ValueError(f"{self.file_path} is not a SamGui project")
+
+        magic, version, _, offset, length = PROJECT_HEADER.unpack_from(self._mmap, 0)
+
+        if magic != PROJECT_MAGIC:
+            raise ValueError(f"{self.file_path} is not a SamGui project")
+
+        if version > PROJECT_VERSION:
+            raise ValueError(f"{self.file_path} was written by a newer version of SamGui (format {version})")
+
+        self._index = (offset, length)
+        indexes = []
+
+        while offset > 0:
+            index = json.loads(self._mmap[offset:offset + length])
+            indexes.append(index)
+            offset, length = index["previous"]
+
+        if len(indexes) == 0:
+            raise ValueError(f"{self.file_path} contains no project index")
+
+        self._segments = len(indexes)
+        entries: Dict[str, dict] = {}
+        deleted: Set[str] = set()
+
+        # replaying from the oldest index keeps the project order of the entries
+        for index in reversed(indexes):
+            for guid in index["deleted"]:
+                entries.pop(guid, None)
+                deleted.add(guid)
+
+            for entry in index["entries"]:
+                entries[entry["guid"]] = entry
+                deleted.discard(entry["guid"])
+
+        return indexes[0]["project"], entries, deleted
+
+    def read_changes(self) -> Tuple[dict, List[SegmentationData], Set[UUID]]:
+        project, entries, deleted = self.read_index()
+        self._blobs = {}
+        self._blob_bytes = 0
+
+        return project, [self.read_entry(x) for x in entries.values()], {UUID(x) for x in deleted}
+
+    def load(self) -> ProjectData:
+        project, entries, _ = self.read_changes()
+
+        return ProjectData(
+            guid=UUID(project["guid"]),
+            name=project["name"],
+            classes=project["classes"],
+            data={x.guid: x for x in entries}
+        )
+
+    def save(self, project: ProjectData, dirty: Iterable[UUID], deleted: Set[UUID]) -> None:
+        """
+        Appends the dirty entries to the file this instance was loaded from or saved to before,
+        otherwise (or once the file is mostly superseded data) writes the whole project
+        """
+        if not self.is_open() or not os.path.isfile(self.file_path) or self.needs_compaction():
+            self.rewrite([encode_entry(x) for x in project.data.values()], [], encode_project(project))
+            return
+
+        # in the order the images first changed, so that newly added images keep their position on load
+        records = [encode_entry(project.data[x]) for x in dirty if x in project.data]
+        self.append(records, [str(x) for x in deleted if x not in project.data], encode_project(project))
+
+    def append(self, records: List[Tuple[dict, PackedMask | None]], deleted: List[str], project: dict) -> None:
+        with open(self.file_path, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            entries = [self.write_record(f, record, packed) for record, packed in records]
+
+            for guid in deleted:
+                self.release_blob(guid)
+
+            self._index = self.write_index(f, project, entries, deleted)
+            self._segments += 1
+
+    def rewrite(self, records: List[Tuple[dict, PackedMask | None]], deleted: List[str], project: dict) -> None:
+        tmp_path = f"{self.file_path}.tmp"
+        previous = [x[0] for x in self._blobs.values()]
+        self._index = None
+        self._blobs = {}
+        self._blob_bytes = 0
+
+        with open(tmp_path, "wb") as f:
+            f.write(PROJECT_HEADER.pack(PROJECT_MAGIC, PROJECT_VERSION, 0, 0, 0))
+            entries = [self.write_record(f, record, packed) for record, packed in records]
+            self._index = self.write_index(f, project, entries, deleted)
+
+        # a mapped file can't be replaced on Windows, so the masks are copied out of the mapping before it is closed
+        self.detach_masks(previous + [x[0] for x in self._blobs.values()])
+        self.unmap()
+        os.replace(tmp_path, self.file_path)
+        self._segments = 1
+        self.map()
+
+        if self.rebind_masks:
+            for packed, offset, length in self._blobs.values():
+                packed.bits = self._view[offset:offset + length]
+
+    def compact(self) -> None:
+        """
+        Rewrites the file from its own content as a single segment
+        """
+        project, entries, deleted = self.read_index()
+        records = []
+
+        for guid, entry in entries.items():
+            packed = None
+
+            if entry["mask"] is not None and entry["mask"][3] is not None:
+                *blob, offset, length = entry["mask"][3]
+                stored = self._blobs.get(guid)
+                packed = stored[0] if stored is not None else PackedMask(*blob, self._view[offset:offset + length])
+                entry["mask"][3] = blob
+
+            records.append((entry, packed))
+
+        self.rewrite(records, list(deleted), project)
+
+    def needs_compaction(self) -> bool:
+        return self._segments >= self.max_segments or self._file_size > 2 * self._blob_bytes + 64 * 1024 ** 2
+
+    def close(self) -> None:
+        """
+        Forgets the state of the file and closes its mapping, masks that were loaded from it are copied out first
+        """
+        self.detach_masks([x[0] for x in self._blobs.values()])
+        self.unmap()
+        self._index = None
+        self._segments = 0
+        self._blobs = {}
+        self._blob_bytes = 0
+        self._file_size = 0
+
+    def detach_masks(self, masks: Iterable[PackedMask]) -> None:
+        mappings = self._retired + ([self._mmap] if self._mmap is not None else [])
+
+        for packed in masks:
+            if isinstance(packed.bits, memoryview) and any(packed.bits.obj is x for x in mappings):
+                packed.bits = bytes(packed.bits)
+
+    def unmap(self) -> None:
+        """
+        Closes the current and any retired mapping. A mapping that something else still holds a view of can't be
+        closed yet, it is retired and closed by a later call (or once the last view is released).
+        """
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+
+        mappings = self._retired + ([self._mmap] if self._mmap is not None else [])
+        self._mmap = None
+        self._retired = []
+
+        for mapping in mappings:
+            try:
+                mapping.close()
+            except BufferError:
+                self._retired.append(mapping)
+
+    def map(self) -> None:
+        self.unmap()
+
+        with open(self.file_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+
+        self._file_size = len(self._mmap)
+
+    def write_record(self, f, record: dict, packed: PackedMask | None) -> dict:
+        """
+        Writes the mask blob of a record unless the same mask was stored before, and adds its position to the record
+        """
+        guid = record["guid"]
+
+        if packed is None or record["mask"] is None:
+            self.release_blob(guid)
+            return record
+
+        stored = self._blobs.get(guid)
+
+        if stored is not None and stored[0] is packed:
+            _, offset, length = stored
+        else:
+            self.release_blob(guid)
+            offset, length = f.tell(), len(packed.bits)
+            f.write(packed.bits)
+            self._blobs[guid] = (packed, offset, length)
+            self._blob_bytes += length
+
+        record["mask"][3] = record["mask"][3] + [offset, length]
+        return record
+
+    def read_entry(self, entry: dict) -> SegmentationData:
+        mask = None
+
+        if entry["mask"] is not None:
+            mask_guid, mask_x, mask_y, blob = entry["mask"]
+            packed = None
+
+            if blob is not None:
+                width, height, x, y, crop_width, crop_height, offset, length = blob
+                packed = PackedMask(width, height, x, y, crop_width, crop_height,
+                                    self._view[offset:offset + length])
+                self._blobs[entry["guid"]] = (packed, offset, length)
+                self._blob_bytes += length
+
+            mask = Mask(UUID(mask_guid), mask_x, mask_y, packed)
+
+        return SegmentationData(
+            guid=UUID(entry["guid"]),
+            file_path=entry["file_path"],
+            file_name=entry["file_name"],
+            x=entry["x"],
+            y=entry["y"],
+            anchors=[Anchor(UUID(x[0]), *x[1:]) for x in entry["anchors"]],
+            bboxes=[BBox(UUID(x[0]), *x[1:]) for x in entry["bboxes"]],
+            mask=mask,
+            zoom=entry["zoom"],
+            width=entry.get("width"),  # not recorded by older versions
+            height=entry.get("height")
+        )
+
+    def release_blob(self, guid: str) -> None:
+        stored = self._blobs.pop(guid, None)
+
+        if stored is not None:
+            self._blob_bytes -= stored[2]
+
+    def write_index(self, f, project: dict, entries: List[dict], deleted: List[str]) -> Tuple[int, int]:
+        index = {
+            "previous": list(self._index) if self._index is not None else [0, 0],
+            "project": project,
+            "entries": entries,
+            "deleted": deleted
+        }
+        payload = json.dumps(index, separators=(",", ":")).encode("utf-8")
+        offset = f.tell()
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+
+        # the header is only switched to the new index once the index is on disk
+        f.seek(0)
+        f.write(PROJECT_HEADER.pack(PROJECT_MAGIC, PROJECT_VERSION, 0, offset, len(payload)))
+        f.flush()
+        os.fsync(f.fileno())
+
+        self._file_size = offset + len(payload)
+
+        return offset, len(payload)
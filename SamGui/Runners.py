@@ -1,6 +1,6 @@
 import os
-import cv2
 import sys
+import logging
 import traceback
 import numpy as np
 
@@ -8,165 +8,148 @@ import onnxruntime as ort
 import numpy.typing as npt
 
 from PIL import Image
-from copy import deepcopy
-from typing import List
-from PySide6.QtCore import QRunnable
-from SamGui.Controller import WorkerSignals
-from SamGui.Data import SegmentationData, SAMMode, Anchor, Label, SamResult, BBox, BatchSamResult, ErrorMessage
+from uuid import UUID
+from typing import Dict, List, Set, Tuple
+from collections import OrderedDict
+from PySide6.QtGui import QImage, QImageReader
+from PySide6.QtCore import QObject, QRunnable, QThread, QThreadPool, QTimer, Signal
+from SamGui.Cache import ImagePyramid, DecodedImageCache, get_embedding_cache, get_thumbnail_cache, \
+    get_decoded_image_cache, get_image_size_cache, get_box_mask_cache, get_anchor_logits_cache
+from SamGui.Utils import MaskCompositor, generate_uuid, get_filename, get_mask_bbox, crop_mask, pack_mask, \
+    read_yolo_labels
+from SamGui.Controller import WorkerSignals, EmbeddingSignals, PreviewSignals, ThumbnailSignals, TileSignals, \
+    ImageSignals, ImportSignals
+from SamGui.EncoderPool import EncoderPool, default_process_count
+from SamGui.Inference import ENCODER_PATH, DECODER_PATH, get_session_manager, get_image_embedding, decode_bboxes, \
+    iter_decode_bboxes, decode_points, refine_points, upsample_box_logits
+from SamGui.Data import SegmentationData, SAMMode, Anchor, Label, SamResult, BBox, BatchSamResult, ErrorMessage, \
+    ImageEmbedding, EmbeddingState, EmbeddingStatus, PreviewRequest, PreviewResult, ThumbnailResult, Mask, ImportChunk, \
+    BoxMask, PackedMask, AnchorLogits
 
 
 class SAMRunner(QRunnable):
-    def __init__(self, data: SegmentationData, mode: SAMMode, adjust_bbox: bool, encoder_path: str, decoder_path: str):
+    def __init__(
+            self,
+            data: SegmentationData,
+            mode: SAMMode,
+            adjust_bbox: bool,
+            encoder_path: str,
+            decoder_path: str,
+            low_res: bool = False):
         super(SAMRunner, self).__init__()
         self.data = data
         self.mode = mode
         self.adjust_bbox = adjust_bbox
+        self.low_res = low_res
         self.signals = WorkerSignals()
 
-        self.providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
         self.encoder_path = encoder_path
         self.decoder_path = decoder_path
 
-        self.encoder = ort.InferenceSession(self.encoder_path)
-        self.decoder = ort.InferenceSession(self.decoder_path)
-
-        
-
-    def process_anchors(self,
-                        embeddings: npt.NDArray,
-                        input_pts: List[List[int]],
-                        input_labels: List[Label],
-                        resized_width: int,
-                        resized_height: int,
-                        orig_width: int,
-                        orig_height: int) -> Image.Image:
-
-        input_point = np.array(input_pts)
-        input_label = np.array(input_labels)
-
-        onnx_coord = np.concatenate([input_point, np.array([[0.0, 0.0]])], axis=0)[
-                     None, :, :
-                     ]
-        onnx_label = np.concatenate([input_label, np.array([-1])])[None, :].astype(
-            np.float32
-        )
-
-        coords = deepcopy(onnx_coord).astype(float)
-        coords[..., 0] = coords[..., 0] * (resized_width / orig_width)
-        coords[..., 1] = coords[..., 1] * (resized_height / orig_height)
-
-        onnx_coord = coords.astype("float32")
-        onnx_mask_input = np.zeros((1, 1, 256, 256), dtype=np.float32)
-        onnx_has_mask_input = np.zeros(1, dtype=np.float32)
-
-        outputs = self.decoder.run(
-            None,
-            {
-                "image_embeddings": embeddings,
-                "point_coords": onnx_coord,
-                "point_labels": onnx_label,
-                "mask_input": onnx_mask_input,
-                "has_mask_input": onnx_has_mask_input,
-                "orig_im_size": np.array(
-                    [orig_height, orig_width], dtype=np.float32
-                )
-            },
-        )
-        masks = outputs[0]
+        self.session_manager = get_session_manager()
+        self.cache = get_embedding_cache()
+        self.box_mask_cache = get_box_mask_cache()
+        self.anchor_logits_cache = get_anchor_logits_cache()
+        self._image_embedding: ImageEmbedding | None = None
 
-        mask = masks[0][0]
-        mask = (mask > 0).astype("uint8") * 255
-        mask = Image.fromarray(mask)
+    @property
+    def encoder(self) -> ort.InferenceSession:
+        return self.session_manager.get_session(self.encoder_path)
 
-        return mask
+    @property
+    def decoder(self) -> ort.InferenceSession:
+        return self.session_manager.get_session(self.decoder_path)
 
-    def process_bbox(self,
-                     embeddings: npt.NDArray,
-                     bbox: BBox,
-                     resized_width: int,
-                     resized_height: int,
-                     orig_width: int,
-                     orig_height: int):
-        coords = [bbox.x, bbox.y, bbox.x + bbox.w, bbox.y + bbox.h]
-        input_box = np.array(coords).reshape(2, 2)
-        box_labels = np.array([2, 3])
-
-        onnx_coord = np.array([input_box], dtype=np.float32)
-        onnx_label = box_labels[None, :].astype(np.float32)
-
-        assert orig_width != 0 and orig_height != 0
-
-        coords = deepcopy(onnx_coord).astype(float)
-        coords[..., 0] *= resized_width / orig_width
-        coords[..., 1] *= resized_height / orig_height
-        onnx_coord = np.array(coords, dtype=np.float32)
-
-        onnx_mask_input = np.zeros((1, 1, 256, 256), dtype=np.float32)
-        onnx_has_mask_input = np.zeros(1, dtype=np.float32)
-
-        outputs = self.decoder.run(None, {
-            "image_embeddings": embeddings,
-            "point_coords": onnx_coord,
-            "point_labels": onnx_label,
-            "mask_input": onnx_mask_input,
-            "has_mask_input": onnx_has_mask_input,
-            "orig_im_size": np.array([orig_height, orig_width], dtype=np.float32),
-        })
-
-        masks = outputs[0]
-        mask = masks[0][0]
-        mask = (mask > 0).astype('uint8') * 255
+    def process_anchors(self, input_pts: List[List[int]], input_labels: List[Label]) -> npt.NDArray:
+        """
+        Refines the mask of the previous anchor-mode run on this image if anchors were only added since then
+        """
+        embedding_key = self.cache.get_key(self.data.file_path, self.encoder_path)
+        key = self.anchor_logits_cache.get_key(embedding_key, self.decoder_path)
+        prompts = [(float(x), float(y), int(label)) for (x, y), label in zip(input_pts, input_labels)]
+        mask_input = self.anchor_logits_cache.get_mask_input(self.data.guid, key, prompts)
 
-        return mask
+        mask, logits = refine_points(self.decoder, self.get_embeddings(), input_pts, input_labels, mask_input)
+        self.anchor_logits_cache.put(self.data.guid, AnchorLogits(key, prompts, mask_input, logits))
 
-    @staticmethod
-    def correct_bbox(mask: npt.NDArray):
-        contours, _ = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        area_sizes = [cv2.contourArea(x) for x in contours]
-        biggest_contour = contours[area_sizes.index(max(area_sizes))]
-        x, y, w, h = cv2.boundingRect(biggest_contour)
+        return mask
 
-        return x, y, w, h
+    def process_bbox(self, bbox: BBox) -> BoxMask:
+        return self.process_bboxes([bbox])[0]
+
+    def process_bboxes(self, bboxes: List[BBox]) -> List[BoxMask]:
+        """
+        Returns the mask of every box, only the boxes that weren't decoded with the same embedding before are decoded.
+        The embedding isn't even loaded if all of them were.
+        In low resolution mode only the padded region around each box is upsampled from the decoder's logits, so a
+        mask never extends further than that.
+        """
+        embedding_key = self.cache.get_key(self.data.file_path, self.encoder_path)
+        keys = [self.box_mask_cache.get_key(embedding_key, self.decoder_path, x, self.low_res) for x in bboxes]
+        box_masks = [self.box_mask_cache.get(x) for x in keys]
+        missing = [idx for idx, x in enumerate(box_masks) if x is None]
+
+        if len(missing) > 0:
+            image_embedding = self.get_embeddings()
+            width, height = image_embedding.orig_width, image_embedding.orig_height
+
+            # each full resolution mask is cropped as soon as it is decoded and released before the next one
+            masks = iter_decode_bboxes(
+                self.decoder, image_embedding, [bboxes[idx] for idx in missing], low_res=self.low_res
+            )
 
+            for idx, mask in zip(missing, masks):
+                if self.low_res:
+                    bbox = bboxes[idx]
+                    x0, y0, region = upsample_box_logits(mask, image_embedding, (bbox.x, bbox.y, bbox.w, bbox.h))
+                    x, y, crop = crop_mask(region)
+                    box_masks[idx] = BoxMask(width, height, x0 + x, y0 + y, crop.copy(), logits=mask)
+                else:
+                    x, y, crop = crop_mask(mask)
+                    box_masks[idx] = BoxMask(width, height, x, y, crop.copy())
 
-    def run(self):
-        assert os.path.isfile(self.data.file_path)
+                self.box_mask_cache.put(keys[idx], box_masks[idx])
 
-        try:
-            img = Image.open(self.data.file_path).convert("RGB")
-            orig_width, orig_height = img.size
+        return box_masks
 
-            if orig_width > orig_height:
-                resized_width = 1024
-                resized_height = int(1024 / orig_width * orig_height)
+    @staticmethod
+    def correct_bbox(box_mask: BoxMask, bbox: BBox) -> Tuple[float, float, float, float]:
+        """
+        Fits the prompt box to the largest region of its mask around it, a box whose mask is empty keeps its geometry
+        """
+        if box_mask.bbox is None:
+            roi = (bbox.x - box_mask.x, bbox.y - box_mask.y, bbox.w, bbox.h)  # relative to the crop
+            region = get_mask_bbox(box_mask.crop, roi)
+
+            if region is None:
+                box_mask.bbox = (bbox.x, bbox.y, bbox.w, bbox.h)
             else:
-                resized_height = 1024
-                resized_width = int(1024 / orig_height * orig_width)
+                x, y, w, h = region
+                box_mask.bbox = (box_mask.x + x, box_mask.y + y, w, h)
+
+        return box_mask.bbox
+
+    @staticmethod
+    def compose_masks(box_masks: List[BoxMask]) -> PackedMask:
+        compositor = MaskCompositor(box_masks[0].width, box_masks[0].height)
 
-            img = img.resize((resized_width, resized_height), Image.Resampling.BILINEAR)
+        for box_mask in box_masks:
+            compositor.add_crop(box_mask.x, box_mask.y, box_mask.crop)
 
-            input_tensor = np.array(img)
-            mean = np.array([123.675, 116.28, 103.53])
-            std = np.array([[58.395, 57.12, 57.375]])
-            input_tensor = (input_tensor - mean) / std
+        return compositor.pack()
 
-            # Transpose input tensor to shape BxCxHxW
-            input_tensor = input_tensor.transpose(2, 0, 1)[None, :, :, :].astype(
-                np.float32
+    def get_embeddings(self) -> ImageEmbedding:
+        if self._image_embedding is None:
+            self._image_embedding = get_image_embedding(
+                self.data.file_path, self.encoder_path, self.session_manager, self.cache
             )
 
-            if resized_height < resized_width:
-                input_tensor = np.pad(
-                    input_tensor, ((0, 0), (0, 0), (0, 1024 - resized_height), (0, 0))
-                )
-            else:
-                input_tensor = np.pad(
-                    input_tensor, ((0, 0), (0, 0), (0, 0), (0, 1024 - resized_width))
-                )
+        return self._image_embedding
 
-            outputs = self.encoder.run(None, {"images": input_tensor})
-            embeddings = outputs[0]
+    def run(self):
+        assert os.path.isfile(self.data.file_path)
 
+        try:
             x_delta = self.data.x * -1
             y_delta = self.data.y * -1
 
@@ -201,19 +184,11 @@ class SAMRunner(QRunnable):
                     _norm_bboxes.append(_n_box)
 
             if self.mode == SAMMode.anchors:
-                mask = self.process_anchors(
-                    embeddings,
-                    _input_pts,
-                    _input_lbls,
-                    resized_width,
-                    resized_height,
-                    orig_width,
-                    orig_height
-                )
+                mask = self.process_anchors(_input_pts, _input_lbls)
 
                 sam_result = SamResult(
                     image_guid=self.data.guid,
-                    mask=mask,
+                    mask=pack_mask(mask),
                     bbox=None,
                     anchors=_norm_anchors
                 )
@@ -228,10 +203,11 @@ class SAMRunner(QRunnable):
                     _x = _bbox.x + x_delta
                     _y = _bbox.y + y_delta
                     norm_bbox = BBox(_bbox.guid, _bbox.name, _bbox.active, _x, _y, _bbox.w, _bbox.h)
-                    mask = self.process_bbox(embeddings, norm_bbox, resized_width, resized_height, orig_width, orig_height)
+                    box_mask = self.process_bbox(norm_bbox)
+                    packed = self.compose_masks([box_mask])
 
                     if self.adjust_bbox:
-                        x, y, w, h = self.correct_bbox(mask)
+                        x, y, w, h = self.correct_bbox(box_mask, norm_bbox)
 
                         bbox = BBox(
                             guid=_bbox.guid,
@@ -242,45 +218,38 @@ class SAMRunner(QRunnable):
                             w=w,
                             h=h
                         )
-                        mask = Image.fromarray(mask)
                         sam_result = SamResult(
                             image_guid=self.data.guid,
-                            mask=mask,
+                            mask=packed,
                             bbox=bbox,
                             anchors=_norm_anchors
                         )
 
                         self.signals.s_sam_result.emit(sam_result)
                     else:
-                        mask = Image.fromarray(mask)
                         sam_result = SamResult(
                             image_guid=self.data.guid,
-                            mask=mask,
+                            mask=packed,
                             bbox=_bbox,
                             anchors=_norm_anchors
                         )
                         self.signals.s_sam_result.emit(sam_result) # returns everything with (0,0) origin
 
                 if len(self.data.bboxes) > 1:
-                    results = []
+                    all_boxes = []
+                    norm_bboxes = []
 
                     for _bbox in self.data.bboxes:
                         _x = _bbox.x + x_delta
                         _y = _bbox.y + y_delta
-                        norm_bbox = BBox(_bbox.guid, _bbox.name, _bbox.active, _x, _y, _bbox.w, _bbox.h)
-
-                        mask = self.process_bbox(
-                            embeddings,
-                            norm_bbox,
-                            resized_width,
-                            resized_height,
-                            orig_width,
-                            orig_height
-                        )
+                        norm_bboxes.append(BBox(_bbox.guid, _bbox.name, _bbox.active, _x, _y, _bbox.w, _bbox.h))
+
+                    # the boxes that changed go through the decoder in as few calls as the model allows
+                    box_masks = self.process_bboxes(norm_bboxes)
 
+                    for _bbox, norm_bbox, box_mask in zip(self.data.bboxes, norm_bboxes, box_masks):
                         if self.adjust_bbox:
-                            x, y, w, h = self.correct_bbox(mask)
-                            mask = Image.fromarray(mask)
+                            x, y, w, h = self.correct_bbox(box_mask, norm_bbox)
 
                             bbox = BBox(
                                 guid=_bbox.guid,
@@ -291,37 +260,13 @@ class SAMRunner(QRunnable):
                                 w=w,
                                 h=h
                             )
-
-                            sam_result = SamResult(
-                                image_guid=self.data.guid,
-                                mask=mask,
-                                bbox=bbox,
-                                anchors=_norm_anchors
-                            )
-
-                            results.append(sam_result)
+                            all_boxes.append(bbox)
                         else:
-                            sam_result = SamResult(
-                                image_guid=self.data.guid,
-                                mask=Image.fromarray(mask),
-                                bbox=norm_bbox,
-                                anchors=_norm_anchors
-                            )
-
-                            results.append(sam_result) # returns everything with (0,0) origin
-
-                    all_masks = [x.mask for x in results]
-                    all_masks = [np.array(x) for x in all_masks]
-                    stack = np.dstack(all_masks)
-                    concat_mask = np.sum(stack, axis=-1)
-                    all_boxes = [x.bbox for x in results]
-
-                    concat_mask = (concat_mask > 0).astype('uint8') * 255
-                    concat_mask = Image.fromarray(concat_mask, "L")
+                            all_boxes.append(norm_bbox) # returns everything with (0,0) origin
 
                     batch_result = BatchSamResult(
                         image_guid=self.data.guid,
-                        mask=concat_mask,
+                        mask=self.compose_masks(box_masks),
                         bboxes=all_boxes
                     )
                     self.signals.s_sam_batch_result.emit(batch_result) # returns everything with (0,0) origin
@@ -339,4 +284,745 @@ class SAMRunner(QRunnable):
         else:
             pass
         finally:
-            self.signals.s_finished.emit()
\ No newline at end of file
+            self.signals.s_finished.emit()
+
+
+class EmbeddingRunner(QRunnable):
+    def __init__(self, image_guid: UUID, file_path: str, encoder_path: str, encoder_pool: EncoderPool | None = None):
+        super(EmbeddingRunner, self).__init__()
+        self.image_guid = image_guid
+        self.file_path = file_path
+        self.encoder_path = encoder_path
+        self.encoder_pool = encoder_pool
+        self.signals = EmbeddingSignals()
+
+    def run(self):
+        self.signals.s_status.emit(EmbeddingStatus(self.image_guid, EmbeddingState.Encoding))
+
+        try:
+            get_image_embedding(self.file_path, self.encoder_path, encoder_pool=self.encoder_pool)
+            state = EmbeddingState.Ready
+
+        except BaseException as e:
+            logging.error(f"Failed to precompute embedding for {self.file_path}: {e}")
+            state = EmbeddingState.Failed
+
+        self.signals.s_status.emit(EmbeddingStatus(self.image_guid, state))
+        self.signals.s_finished.emit(self.image_guid)
+
+
+class EmbeddingScheduler(QObject):
+    """
+    Encodes imported images in the background so that their embeddings are already cached when SAM is run on them.
+    The queue is dispatched on its own low-priority thread pool, one image per free thread, which allows moving the
+    selected image to the front, pausing while an interactive SAM run is active and cancelling the remaining work.
+    Images that are already being encoded are finished when pausing or cancelling.
+
+    Large imports on a CPU-only machine with enough cores are handed to an EncoderPool instead: one thread per worker
+    process feeds the pool, which is shut down again once the queue has drained.
+    """
+    s_status = Signal(EmbeddingStatus)
+    s_progress = Signal(int, int)  # done, total
+
+    def __init__(
+            self,
+            encoder_path: str = ENCODER_PATH,
+            max_threads: int = 1,
+            pool_processes: int = default_process_count(),
+            pool_threshold: int = 64,
+            parent=None):
+        super(EmbeddingScheduler, self).__init__(parent)
+        self.encoder_path = encoder_path
+        self.max_threads = max_threads
+        self.pool_processes = pool_processes
+        self.pool_threshold = pool_threshold
+        self.encoder_pool: EncoderPool | None = None
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(max_threads)
+        self.pool.setThreadPriority(QThread.Priority.LowPriority)
+
+        self._queue: OrderedDict[UUID, str] = OrderedDict()
+        self._running: Dict[UUID, EmbeddingRunner] = {}
+        self._states: Dict[UUID, EmbeddingState] = {}
+        self._paused = False
+        self._done = 0
+        self._total = 0
+
+    def is_available(self) -> bool:
+        return os.path.isfile(self.encoder_path)
+
+    def get_state(self, image_guid: UUID) -> EmbeddingState | None:
+        return self._states.get(image_guid)
+
+    def enqueue(self, images: Dict[UUID, str]) -> None:
+        for guid, file_path in images.items():
+            if guid in self._states and self._states[guid] != EmbeddingState.Failed:
+                continue
+
+            self._queue[guid] = file_path
+            self._total += 1
+            self._set_state(guid, EmbeddingState.Pending)
+
+        self._emit_progress()
+        self._start_encoder_pool()
+        self._dispatch()
+
+    def prioritize(self, image_guid: UUID) -> None:
+        if image_guid in self._queue:
+            self._queue.move_to_end(image_guid, last=False)
+            self._dispatch()
+
+    def remove(self, image_guid: UUID) -> None:
+        if image_guid in self._queue:
+            self._queue.pop(image_guid)
+            self._total -= 1
+            self._emit_progress()
+
+        self._states.pop(image_guid, None)
+
+    def pause(self) -> None:
+        self._paused = True
+
+    def resume(self) -> None:
+        self._paused = False
+        self._dispatch()
+
+    def cancel(self) -> None:
+        for guid in self._queue.keys():
+            self._states.pop(guid, None)
+
+        self._total -= len(self._queue)
+        self._queue.clear()
+        self._emit_progress()
+
+    def shutdown(self) -> None:
+        """
+        Drops the queue and closes the encoder pool without waiting, its workers exit after their current image
+        """
+        self.cancel()
+        self._stop_encoder_pool()
+
+    def clear(self) -> None:
+        self.cancel()
+        self._states = {guid: EmbeddingState.Encoding for guid in self._running.keys()}
+
+    def _set_state(self, image_guid: UUID, state: EmbeddingState) -> None:
+        self._states[image_guid] = state
+        self.s_status.emit(EmbeddingStatus(image_guid, state))
+
+    def _start_encoder_pool(self) -> None:
+        if self.encoder_pool is not None or self.pool_processes < 2 or len(self._queue) < self.pool_threshold:
+            return
+
+        session_manager = get_session_manager()
+
+        if session_manager.get_providers() != ["CPUExecutionProvider"]:
+            return  # a single GPU session is faster than several CPU processes
+
+        # the worker processes are spawned by the first runner, so the UI thread doesn't wait for them
+        self.encoder_pool = EncoderPool(self.encoder_path, self.pool_processes, session_manager.config)
+        self.pool.setMaxThreadCount(self.pool_processes)
+
+    def _stop_encoder_pool(self) -> None:
+        if self.encoder_pool is None:
+            return
+
+        self.encoder_pool.close()
+        self.encoder_pool = None
+        self.pool.setMaxThreadCount(self.max_threads)
+
+    def _emit_progress(self) -> None:
+        if len(self._queue) == 0 and len(self._running) == 0:
+            self._done = 0
+            self._total = 0
+            self._stop_encoder_pool()
+
+        self.s_progress.emit(self._done, self._total)
+
+    def _dispatch(self) -> None:
+        while not self._paused and len(self._queue) > 0 and len(self._running) < self.pool.maxThreadCount():
+            guid, file_path = self._queue.popitem(last=False)
+            runner = EmbeddingRunner(guid, file_path, self.encoder_path, self.encoder_pool)
+            runner.signals.s_status.connect(self.handle_status)
+            runner.signals.s_finished.connect(self.handle_finished)
+            self._running[guid] = runner
+            self.pool.start(runner)
+
+    def handle_status(self, status: EmbeddingStatus) -> None:
+        if status.image_guid in self._states:
+            self._set_state(status.image_guid, status.state)
+
+    def handle_finished(self, image_guid: UUID) -> None:
+        self._running.pop(image_guid, None)
+        self._done += 1
+        self._emit_progress()
+        self._dispatch()
+
+
+class PreviewRunner(QRunnable):
+    """
+    Decodes a live preview mask for the current prompts. Only images whose embedding is already cached are previewed,
+    the encoder is never run here.
+    """
+    def __init__(self, sequence: int, request: PreviewRequest, encoder_path: str, decoder_path: str):
+        super(PreviewRunner, self).__init__()
+        self.sequence = sequence
+        self.request = request
+        self.encoder_path = encoder_path
+        self.decoder_path = decoder_path
+        self.signals = PreviewSignals()
+
+    def decode(self, image_embedding: ImageEmbedding) -> npt.NDArray | None:
+        decoder = get_session_manager().get_session(self.decoder_path)
+        x_delta = self.request.x * -1
+        y_delta = self.request.y * -1
+
+        if self.request.mode == SAMMode.anchors:
+            if len(self.request.anchors) == 0:
+                return None
+
+            points = [[x.x + x_delta, x.y + y_delta] for x in self.request.anchors]
+            labels = [x.class_id for x in self.request.anchors]
+
+            return decode_points(decoder, image_embedding, points, labels)
+
+        bboxes = [
+            BBox(x.guid, x.name, x.active, x.x + x_delta, x.y + y_delta, x.w, x.h)
+            for x in self.request.bboxes if x.active
+        ]
+
+        if len(bboxes) == 0:
+            return None
+
+        masks = decode_bboxes(decoder, image_embedding, bboxes)
+        union_mask = masks[0]
+
+        for mask in masks[1:]:
+            np.bitwise_or(union_mask, mask, out=union_mask)
+
+        return union_mask
+
+    def run(self):
+        try:
+            cache = get_embedding_cache()
+            image_embedding = cache.get(cache.get_key(self.request.file_path, self.encoder_path))
+
+            if image_embedding is not None:
+                mask = self.decode(image_embedding)
+
+                if mask is not None:
+                    self.signals.s_preview.emit(PreviewResult(
+                        image_guid=self.request.image_guid,
+                        sequence=self.sequence,
+                        mask=Image.fromarray(mask),
+                        x=self.request.x,
+                        y=self.request.y
+                    ))
+
+        except BaseException as e:
+            logging.error(f"Failed to decode preview for {self.request.file_path}: {e}")
+
+        self.signals.s_finished.emit()
+
+
+class PreviewScheduler(QObject):
+    """
+    Coalesces the position updates of a drag into decoder runs: a request only replaces the pending one, at most one
+    preview is decoded at a time and the newest pending request is started as soon as the previous run returns.
+    Requests that were replaced before being started are never decoded and results older than the last shown
+    one are dropped.
+    """
+    s_preview = Signal(PreviewResult)
+
+    def __init__(self, encoder_path: str = ENCODER_PATH, decoder_path: str = DECODER_PATH, delay: int = 15, parent=None):
+        super(PreviewScheduler, self).__init__(parent)
+        self.encoder_path = encoder_path
+        self.decoder_path = decoder_path
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(1)
+
+        # collects the burst of updates a single mouse move produces before the first dispatch
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self._dispatch)
+
+        self._pending: PreviewRequest | None = None
+        self._sequence = 0
+        self._latest = 0
+        self._busy = False
+
+    def request(self, request: PreviewRequest) -> None:
+        self._sequence += 1
+        self._pending = request
+
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def cancel(self) -> None:
+        self._pending = None
+        self.timer.stop()
+        self._latest = self._sequence  # a run that is still in flight is not shown anymore
+
+    def _dispatch(self) -> None:
+        if self._busy or self._pending is None:
+            return
+
+        runner = PreviewRunner(self._sequence, self._pending, self.encoder_path, self.decoder_path)
+        runner.signals.s_preview.connect(self.handle_preview)
+        runner.signals.s_finished.connect(self.handle_finished)
+        self._pending = None
+        self._busy = True
+        self.pool.start(runner)
+
+    def handle_preview(self, result: PreviewResult) -> None:
+        if result.sequence > self._latest:
+            self._latest = result.sequence
+            self.s_preview.emit(result)
+
+    def handle_finished(self) -> None:
+        self._busy = False
+        self._dispatch()
+
+
+class ThumbnailRunner(QRunnable):
+    def __init__(self, image_guid: UUID, file_path: str):
+        super(ThumbnailRunner, self).__init__()
+        self.image_guid = image_guid
+        self.file_path = file_path
+        self.signals = ThumbnailSignals()
+
+    def run(self):
+        try:
+            thumbnail = get_thumbnail_cache().get(self.file_path)
+            self.signals.s_thumbnail.emit(ThumbnailResult(self.image_guid, thumbnail))
+
+        except BaseException as e:
+            logging.error(f"Failed to create thumbnail for {self.file_path}: {e}")
+
+        self.signals.s_finished.emit(self.image_guid)
+
+
+class ThumbnailScheduler(QObject):
+    """
+    Loads the thumbnails of the rows the image list paints. The newest request is started first, so rows that were
+    just scrolled into view load before the ones that were scrolled past. Once more than max_pending requests are
+    waiting the oldest ones are dropped, their rows request them again when they are painted the next time.
+    """
+    s_thumbnail = Signal(ThumbnailResult)
+    s_dropped = Signal(UUID)
+
+    def __init__(self, max_threads: int = 2, max_pending: int = 128, parent=None):
+        super(ThumbnailScheduler, self).__init__(parent)
+        self.max_pending = max_pending
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(max_threads)
+        self.pool.setThreadPriority(QThread.Priority.LowPriority)
+
+        self._pending: OrderedDict[UUID, str] = OrderedDict()
+        self._running: Dict[UUID, ThumbnailRunner] = {}
+
+    def request(self, image_guid: UUID, file_path: str) -> None:
+        if image_guid in self._running:
+            return
+
+        self._pending[image_guid] = file_path
+        self._pending.move_to_end(image_guid)
+
+        while len(self._pending) > self.max_pending:
+            guid, _ = self._pending.popitem(last=False)
+            self.s_dropped.emit(guid)
+
+        self._dispatch()
+
+    def cancel(self) -> None:
+        self._pending.clear()
+
+    def _dispatch(self) -> None:
+        while len(self._pending) > 0 and len(self._running) < self.pool.maxThreadCount():
+            guid, file_path = self._pending.popitem(last=True)
+            runner = ThumbnailRunner(guid, file_path)
+            runner.signals.s_thumbnail.connect(self.handle_thumbnail)
+            runner.signals.s_finished.connect(self.handle_finished)
+            self._running[guid] = runner
+            self.pool.start(runner)
+
+    def handle_thumbnail(self, result: ThumbnailResult) -> None:
+        self.s_thumbnail.emit(result)
+
+    def handle_finished(self, image_guid: UUID) -> None:
+        self._running.pop(image_guid, None)
+        self._dispatch()
+
+
+class YoloImportRunner(QRunnable):
+    def __init__(self, index: int, images: List[str], labels: List[str], classes: List[str]):
+        super(YoloImportRunner, self).__init__()
+        self.index = index
+        self.images = images
+        self.labels = labels
+        self.classes = classes
+        self.signals = ImportSignals()
+
+    def run(self):
+        data = {}
+        failed = []
+
+        for image_path, label_path in zip(self.images, self.labels):
+            try:
+                width, height = get_image_size_cache().get(image_path)
+                bboxes = read_yolo_labels(label_path, self.classes, width, height)
+
+            except (OSError, ValueError, IndexError) as e:
+                logging.error(f"Failed to import {image_path}: {e}")
+                failed.append(image_path)
+                continue
+
+            guid = generate_uuid()
+            data[guid] = SegmentationData(
+                guid=guid,
+                file_path=image_path,
+                file_name=get_filename(image_path),
+                x=0,
+                y=0,
+                anchors=[],
+                bboxes=bboxes,
+                mask=Mask(
+                    guid=generate_uuid(),
+                    x=0,
+                    y=0,
+                    packed=None
+                ),
+                zoom=1.0,
+                width=width,
+                height=height
+            )
+
+        self.signals.s_chunk.emit(ImportChunk(self.index, data, failed))
+
+
+class YoloImportScheduler(QObject):
+    """
+    Imports a YOLO dataset in chunks on a thread pool, only the image headers are read for the sizes the labels are
+    scaled to. A chunk is handed out as soon as all chunks before it are done, so the images are added in dataset
+    order while the rest of the dataset is still being read. Chunk indexes keep counting across imports, which is how
+    the chunks of a cancelled import are recognized and dropped.
+    """
+    s_chunk = Signal(ImportChunk)
+    s_progress = Signal(int, int)  # done, total
+    s_finished = Signal(list)  # files that could not be read
+
+    def __init__(self, chunk_size: int = 256, max_threads: int = 4, parent=None):
+        super(YoloImportScheduler, self).__init__(parent)
+        self.chunk_size = chunk_size
+        self.classes: List[str] = []
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(max_threads)
+        self.pool.setThreadPriority(QThread.Priority.LowPriority)
+
+        self._pending: List[Tuple[int, List[str], List[str]]] = []
+        self._running: Dict[int, YoloImportRunner] = {}
+        self._ready: Dict[int, ImportChunk] = {}
+        self._failed: List[str] = []
+        self._index = 0  # index of the next chunk to create
+        self._first = 0  # index of the first chunk of the current import
+        self._next = 0  # index of the next chunk to hand out
+        self._done = 0
+        self._total = 0
+
+    def start(self, images: List[str], labels: List[str], classes: List[str]) -> None:
+        self.cancel()
+        self.classes = classes
+        count = min(len(images), len(labels))
+
+        for start in range(0, count, self.chunk_size):
+            end = min(start + self.chunk_size, count)
+            self._pending.append((self._index, images[start:end], labels[start:end]))
+            self._index += 1
+
+        self._total = count
+        self.s_progress.emit(self._done, self._total)
+        self._dispatch()
+
+    def cancel(self) -> None:
+        self._first = self._index
+        self._next = self._index
+        self._pending.clear()
+        self._ready.clear()
+        self._failed = []
+        self._done = 0
+        self._total = 0
+        self.s_progress.emit(0, 0)
+
+    def _dispatch(self) -> None:
+        while len(self._pending) > 0 and len(self._running) < self.pool.maxThreadCount():
+            index, images, labels = self._pending.pop(0)
+            runner = YoloImportRunner(index, images, labels, self.classes)
+            runner.signals.s_chunk.connect(self.handle_chunk)
+            self._running[index] = runner
+            self.pool.start(runner)
+
+    def handle_chunk(self, chunk: ImportChunk) -> None:
+        self._running.pop(chunk.index, None)
+
+        if chunk.index >= self._first:
+            self._ready[chunk.index] = chunk
+            self._done += len(chunk.data) + len(chunk.failed)
+
+            while self._next in self._ready:
+                ready = self._ready.pop(self._next)
+                self._failed.extend(ready.failed)
+                self._next += 1
+                self.s_chunk.emit(ready)
+
+        self._dispatch()
+
+        if self._total > 0 and self._done >= self._total and len(self._ready) == 0:
+            failed = self._failed
+            self._failed = []
+            self._done = 0
+            self._total = 0
+            self.s_progress.emit(0, 0)
+            self.s_finished.emit(failed)
+        elif self._total > 0:
+            self.s_progress.emit(self._done, self._total)
+
+
+class PyramidRunner(QRunnable):
+    def __init__(self, file_path: str, tile_size: int):
+        super(PyramidRunner, self).__init__()
+        self.file_path = file_path
+        self.tile_size = tile_size
+        self.signals = TileSignals()
+
+    def run(self):
+        try:
+            pyramid = ImagePyramid(self.file_path, self.tile_size)
+            pyramid.build()
+            self.signals.s_pyramid.emit(pyramid)
+
+        except BaseException as e:
+            logging.error(f"Failed to build the tile pyramid for {self.file_path}: {e}")
+
+
+class TileRunner(QRunnable):
+    def __init__(self, pyramid: ImagePyramid, level: int, column: int, row: int):
+        super(TileRunner, self).__init__()
+        self.pyramid = pyramid
+        self.level = level
+        self.column = column
+        self.row = row
+        self.signals = TileSignals()
+
+    def run(self):
+        # QImage, unlike QPixmap, can be created outside the UI thread
+        tile = QImage(self.pyramid.tile_path(self.level, self.column, self.row))
+
+        if tile.isNull():
+            logging.error(f"Failed to read tile {self.level}/{self.column}_{self.row} of {self.pyramid.file_path}")
+
+        self.signals.s_tile.emit(self.level, self.column, self.row, tile)
+
+
+class TileLoader(QObject):
+    """
+    Builds the tile pyramid of an image in the background and loads the tiles a TiledImage paints. Each request
+    replaces the tiles that are still waiting, so tiles that were scrolled or zoomed past are never read. Loaded
+    tiles are kept in an LRU, the single tile of the coarsest level is kept for as long as the loader lives and is
+    drawn wherever a sharper tile isn't loaded yet.
+    """
+    s_ready = Signal()
+    s_tile = Signal(int, int, int)  # level, column, row
+
+    def __init__(self, file_path: str, tile_size: int = 512, max_tiles: int = 96, max_threads: int = 2, parent=None):
+        super(TileLoader, self).__init__(parent)
+        self.file_path = file_path
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.pyramid: ImagePyramid | None = None
+        self.overview: QImage | None = None
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(max_threads)
+
+        self._tiles: OrderedDict[Tuple[int, int, int], QImage] = OrderedDict()
+        self._pending: List[Tuple[int, int, int]] = []
+        self._running: Dict[Tuple[int, int, int], TileRunner] = {}
+        self._failed: Set[Tuple[int, int, int]] = set()
+        self._builder: PyramidRunner | None = None
+
+    def start(self) -> None:
+        self._builder = PyramidRunner(self.file_path, self.tile_size)
+        self._builder.signals.s_pyramid.connect(self.handle_pyramid)
+        self.pool.start(self._builder)
+
+    def cancel(self) -> None:
+        self._pending.clear()
+
+    def get_tile(self, level: int, column: int, row: int) -> QImage | None:
+        key = (level, column, row)
+
+        if self.pyramid is not None and level == self.pyramid.levels - 1:
+            return self.overview
+
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+            return self._tiles[key]
+
+        return None
+
+    def request(self, tiles: List[Tuple[int, int, int]]) -> None:
+        if self.pyramid is None:
+            return
+
+        self._pending = [x for x in tiles if x not in self._running and x not in self._failed and x not in self._tiles]
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while len(self._pending) > 0 and len(self._running) < self.pool.maxThreadCount():
+            key = self._pending.pop(0)
+            runner = TileRunner(self.pyramid, *key)
+            runner.signals.s_tile.connect(self.handle_tile)
+            self._running[key] = runner
+            self.pool.start(runner)
+
+    def handle_pyramid(self, pyramid: ImagePyramid) -> None:
+        self._builder = None
+        self.pyramid = pyramid
+        self.request([(pyramid.levels - 1, 0, 0)])
+
+    def handle_tile(self, level: int, column: int, row: int, tile: QImage) -> None:
+        key = (level, column, row)
+        self._running.pop(key, None)
+
+        if tile.isNull():
+            self._failed.add(key)
+
+        elif level == self.pyramid.levels - 1:
+            self.overview = tile
+            self.s_ready.emit()
+
+        else:
+            self._tiles[key] = tile
+
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+
+            self.s_tile.emit(level, column, row)
+
+        self._dispatch()
+
+
+class ImageLoadRunner(QRunnable):
+    def __init__(self, image_guid: UUID, file_path: str, max_pixels: int):
+        super(ImageLoadRunner, self).__init__()
+        self.image_guid = image_guid
+        self.file_path = file_path
+        self.max_pixels = max_pixels
+        self.signals = ImageSignals()
+
+    def run(self):
+        try:
+            cache = get_decoded_image_cache()
+            key = DecodedImageCache.get_key(self.file_path)
+            image = cache.get(key)
+
+            if image is None:
+                reader = QImageReader(self.file_path)
+                size = reader.size()
+
+                # images above the tiling threshold are shown by a TiledImage and never decoded as a whole
+                if size.width() * size.height() > self.max_pixels:
+                    return
+
+                image = reader.read()
+
+                if image.isNull():
+                    raise OSError(reader.errorString())
+
+                cache.put(key, image, image.sizeInBytes())
+
+            self.signals.s_loaded.emit(self.image_guid, image)
+
+        except BaseException as e:
+            logging.error(f"Failed to load image {self.file_path}: {e}")
+
+        finally:
+            self.signals.s_finished.emit(self.file_path)
+
+
+class ImageLoader(QObject):
+    """
+    Decodes the selected image off the UI thread and prefetches its neighbours into the decoded image cache.
+    The selected image is always started before any prefetch and every call to prefetch() replaces the prefetches
+    that are still waiting, so paging quickly through a dataset only decodes the images around the current one.
+    """
+    s_loaded = Signal(UUID, QImage)
+
+    def __init__(self, max_pixels: int, max_threads: int = 2, parent=None):
+        super(ImageLoader, self).__init__(parent)
+        self.max_pixels = max_pixels
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(max_threads)
+
+        self._requested: UUID | None = None
+        self._load: Tuple[UUID, str] | None = None
+        self._prefetch: List[Tuple[UUID, str]] = []
+        self._running: Dict[str, ImageLoadRunner] = {}
+
+    def get(self, file_path: str) -> QImage | None:
+        try:
+            return get_decoded_image_cache().get(DecodedImageCache.get_key(file_path))
+        except OSError:
+            return None
+
+    def load(self, image_guid: UUID, file_path: str) -> None:
+        self._requested = image_guid
+
+        # a prefetch of the same file that is already running delivers the image
+        if file_path not in self._running:
+            self._load = (image_guid, file_path)
+            self._dispatch()
+
+    def prefetch(self, images: List[Tuple[UUID, str]]) -> None:
+        cache = get_decoded_image_cache()
+        self._prefetch = []
+
+        for image_guid, file_path in images:
+            try:
+                if file_path in self._running or cache.contains(DecodedImageCache.get_key(file_path)):
+                    continue
+            except OSError:
+                continue
+
+            self._prefetch.append((image_guid, file_path))
+
+        self._dispatch()
+
+    def cancel(self) -> None:
+        self._requested = None
+        self._load = None
+        self._prefetch.clear()
+
+    def _dispatch(self) -> None:
+        while len(self._running) < self.pool.maxThreadCount():
+            if self._load is not None:
+                image_guid, file_path = self._load
+                self._load = None
+            elif len(self._prefetch) > 0:
+                image_guid, file_path = self._prefetch.pop(0)
+            else:
+                return
+
+            runner = ImageLoadRunner(image_guid, file_path, self.max_pixels)
+            runner.signals.s_loaded.connect(self.handle_loaded)
+            runner.signals.s_finished.connect(self.handle_finished)
+            self._running[file_path] = runner
+            self.pool.start(runner)
+
+    def handle_loaded(self, image_guid: UUID, image: QImage) -> None:
+        if image_guid == self._requested:
+            self.s_loaded.emit(image_guid, image)
+
+    def handle_finished(self, file_path: str) -> None:
+        self._running.pop(file_path, None)
+        self._dispatch()
@@ -156,6 +156,11 @@ DARK_STYLE = """
                 
             }
 
+            QListView#ImageList {
+                background-color: #24272c;
+                border: 0px;
+            }
+
             QListWidget#HierarchyEntry {
                 width: 400px;
                 height: 120px;
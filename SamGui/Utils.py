@@ -1,15 +1,31 @@
 import os
 import cv2
+import math
 import uuid
 import logging
 import numpy as np
 import numpy.typing as npt
-from PySide6.QtWidgets import QApplication
 
-from SamGui.Data import BBox, ScreenData
+from SamGui.Data import BBox, PackedMask, ScreenData
 from datetime import datetime
-from PIL import Image, ImageOps
-from typing import List
+from PIL import Image
+from typing import List, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # only needed for annotations, which keeps this module importable without Qt (see SamGui.batch)
+    from PySide6.QtWidgets import QApplication
+
+
+# scans and orthophotos are far above Pillow's default decompression bomb limit of ~89 megapixels
+MAX_IMAGE_PIXELS = 1024 ** 3
+
+
+def allow_large_images(max_pixels: int = MAX_IMAGE_PIXELS) -> None:
+    """
+    Raises Pillow's process-wide decompression bomb limit, so that images which are shown tiled (see ImagePyramid)
+    can be opened. Only called by the GUI and on request of the batch CLI, importing this module leaves it alone.
+    """
+    Image.MAX_IMAGE_PIXELS = max_pixels
 
 
 def has_data(a: dict | list) -> bool:
@@ -18,7 +34,7 @@ def has_data(a: dict | list) -> bool:
     else:
         return False
 
-def get_screen_center(app: QApplication, start_size_ratio: float = 0.8) -> ScreenData:
+def get_screen_center(app: "QApplication", start_size_ratio: float = 0.8) -> ScreenData:
     screen = app.primaryScreen()
     rect = screen.availableGeometry()
     max_width = rect.width()
@@ -97,6 +113,18 @@ def mask_region(image: Image.Image) -> Image.Image:
     return pil_image
 
 
+def create_thumbnail(file_path: str, size: int = 64) -> Image.Image:
+    """
+    Decodes an image only at the resolution needed for a thumbnail, JPEGs are decoded at a reduced scale in draft mode
+    """
+    with Image.open(file_path) as image:
+        image.draft("RGB", (size, size))
+        image = image.convert("RGB")
+
+    image.thumbnail((size, size), Image.Resampling.BILINEAR, reducing_gap=2.0)
+    return image
+
+
 def convert_sam_to_mask(sam_mask: Image.Image, area_threshold: int = 4) -> npt.NDArray:
     mask = np.array(sam_mask)
     mask = np.where(mask == 0, 1.0, 0.0)
@@ -113,22 +141,6 @@ def convert_sam_to_mask(sam_mask: Image.Image, area_threshold: int = 4) -> npt.N
     return mask_img
 
 
-def generate_alpha_mask(input_mask: Image.Image) -> Image.Image:
-
-    grayscale_mask = input_mask.convert("L")
-    alpha_mask = ImageOps.colorize(grayscale_mask, black="black", white="red")
-    alpha_mask = alpha_mask.convert("RGBA")
-
-    array = np.array(alpha_mask, dtype=np.uint8)
-    is_black = (array[:, :, :3] == (0, 0, 0)).all(axis=2)
-    alpha = np.where(is_black, 0, 255)
-    array[:, :, -1] = alpha
-
-    alpha_mask = Image.fromarray(array, "RGBA")
-    alpha_mask.putalpha(128)
-
-    return alpha_mask
-
 def create_crop_image(image: Image.Image, bbox: BBox, x_pos: int, y_pos: int):
     x_delta = bbox.x + (x_pos * -1)
     y_delta = bbox.y + (y_pos * -1)
@@ -137,9 +149,211 @@ def create_crop_image(image: Image.Image, bbox: BBox, x_pos: int, y_pos: int):
     return crop_img
 
 
+def crop_mask(mask: npt.NDArray) -> Tuple[int, int, npt.NDArray]:
+    """
+    Returns x, y and the crop of a mask to the bounds of its set pixels, the crop of an empty mask is 0x0
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+
+    if len(rows) == 0:
+        return 0, 0, mask[:0, :0]
+
+    y, x = int(rows[0]), int(cols[0])
+
+    return x, y, mask[y:rows[-1] + 1, x:cols[-1] + 1]
+
+
+class MaskCompositor:
+    """
+    ORs masks into one preallocated uint8 buffer as they are decoded, so a union over any number of prompts holds no
+    more than the buffer and the mask that is being added. With clip_to_roi a mask is only written inside the region
+    it was prompted with, which drops the pixels SAM leaks outside of a box.
+    """
+    def __init__(self, width: int, height: int, clip_to_roi: bool = False):
+        self.width = width
+        self.height = height
+        self.clip_to_roi = clip_to_roi
+        self.buffer = np.zeros((height, width), dtype=np.uint8)
+
+    def add(self, mask: npt.NDArray, roi: Tuple[float, float, float, float] | None = None) -> None:
+        """
+        Adds a full resolution mask, roi is the x, y, w, h of the box it was decoded for
+        """
+        self.add_crop(0, 0, mask, roi)
+
+    def add_crop(self, x: int, y: int, crop: npt.NDArray, roi: Tuple[float, float, float, float] | None = None) -> None:
+        """
+        Adds a mask that was cropped at x, y
+        """
+        x0, y0 = x, y
+        x1, y1 = x + crop.shape[1], y + crop.shape[0]
+
+        if self.clip_to_roi and roi is not None:
+            roi_x, roi_y, roi_w, roi_h = roi
+            x0, y0 = max(x0, math.floor(roi_x)), max(y0, math.floor(roi_y))
+            x1, y1 = min(x1, math.ceil(roi_x + roi_w)), min(y1, math.ceil(roi_y + roi_h))
+
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.width), min(y1, self.height)
+
+        if x1 <= x0 or y1 <= y0:
+            return
+
+        target = self.buffer[y0:y1, x0:x1]
+        np.bitwise_or(target, crop[y0 - y:y1 - y, x0 - x:x1 - x], out=target)
+
+    def pack(self) -> PackedMask:
+        return pack_mask(self.buffer)
+
+
+def pack_mask(mask: npt.NDArray | Image.Image) -> PackedMask:
+    """
+    Bit-packs the set pixels of a mask, cropped to their bounds
+    """
+    mask = np.asarray(mask) > 0
+    height, width = mask.shape
+    x, y, crop = crop_mask(mask)
+
+    return PackedMask(width, height, x, y, crop.shape[1], crop.shape[0], np.packbits(crop).tobytes())
+
+
+def unpack_mask(packed: PackedMask) -> npt.NDArray:
+    """
+    Restores the full uint8 mask (0 or 255) of a packed mask
+    """
+    mask = np.zeros((packed.height, packed.width), dtype=np.uint8)
+
+    if packed.crop_width > 0 and packed.crop_height > 0:
+        crop = np.unpackbits(np.frombuffer(packed.bits, dtype=np.uint8), count=packed.crop_width * packed.crop_height)
+        crop = crop.reshape(packed.crop_height, packed.crop_width)
+        np.multiply(crop, 255, out=mask[packed.y:packed.y + packed.crop_height, packed.x:packed.x + packed.crop_width])
+
+    return mask
+
+
+def unpack_mask_image(packed: PackedMask) -> Image.Image:
+    return Image.fromarray(unpack_mask(packed), "L")
+
+
 def read_class_file(file_path: str) -> List[str]:
     with open(file_path, "r") as f:
         classes = f.readlines()
         classes = [x.replace("\n", "") for x in classes]
 
-        return classes
\ No newline at end of file
+        return classes
+
+
+def read_image_size(file_path: str) -> Tuple[int, int]:
+    """
+    Returns the width and height of an image, Pillow only parses the header until the pixel data is accessed
+    """
+    with Image.open(file_path) as image:
+        return image.size
+
+
+def read_yolo_labels(label_path: str, classes: List[str], width: int, height: int) -> List[BBox]:
+    """
+    Reads a YOLO label file and converts the normalized center/size annotations to BBoxes in pixel coordinates
+    """
+    bboxes = []
+
+    with open(label_path, "r") as f:
+        for _lbl in f.readlines():
+            if _lbl.strip() == "":
+                continue
+
+            class_idx, yolo_center_x, yolo_center_y, yolo_bbox_w, yolo_bbox_h = _lbl.split()
+
+            if len(classes) == 0:
+                class_name = "BBox"
+
+            elif class_idx == "999":
+                class_name = "BBox"
+
+            else:
+                class_name = classes[int(class_idx)]
+
+            bbox_width = float(yolo_bbox_w) * width
+            bbox_height = float(yolo_bbox_h) * height
+            x_center = float(yolo_center_x) * width
+            y_center = float(yolo_center_y) * height
+
+            x = x_center - (bbox_width / 2)
+            y = y_center - (bbox_height / 2)
+
+            bbox = BBox(
+                guid=generate_uuid(),
+                name=class_name,
+                active=True,
+                x=x,
+                y=y,
+                w=bbox_width,
+                h=bbox_height,
+            )
+
+            bboxes.append(bbox)
+
+    return bboxes
+
+
+def get_largest_region(mask: npt.NDArray) -> Tuple[int, int, int, int] | None:
+    """
+    Returns x, y, w, h of the largest 8-connected region of a binary uint8 mask, None if the mask is empty
+    """
+    count, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+
+    if count < 2:
+        return None
+
+    largest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))  # label 0 is the background
+    x, y, w, h = stats[largest, :4]
+
+    return int(x), int(y), int(w), int(h)
+
+
+def pad_roi(
+        roi: Tuple[float, float, float, float],
+        width: int,
+        height: int,
+        padding: float = 0.25) -> Tuple[int, int, int, int]:
+    """
+    Grows the x, y, w, h of a box by padding times its size, at least 8 pixels, and returns the pixel bounds x0, y0,
+    x1, y1 of the result inside an image of width and height
+    """
+    x, y, w, h = roi
+    pad_x = max(8.0, w * padding)
+    pad_y = max(8.0, h * padding)
+    x0, y0 = max(0, math.floor(x - pad_x)), max(0, math.floor(y - pad_y))
+    x1, y1 = min(width, math.ceil(x + w + pad_x)), min(height, math.ceil(y + h + pad_y))
+
+    return x0, y0, x1, y1
+
+
+def get_mask_bbox(
+        mask: npt.NDArray,
+        roi: Tuple[float, float, float, float] | None = None,
+        padding: float = 0.25) -> Tuple[int, int, int, int] | None:
+    """
+    Returns x, y, w, h of the largest region in a binary uint8 mask, None if the mask is empty.
+    With roi, the x, y, w, h of the box the mask was prompted with, only the box grown by padding times its size is
+    labelled. The whole mask is only labelled if the region found there reaches an edge of the grown box, since it may
+    continue outside of it, or if nothing was found there.
+    """
+    height, width = mask.shape
+
+    if roi is not None:
+        x0, y0, x1, y1 = pad_roi(roi, width, height, padding)
+
+        if x1 > x0 and y1 > y0:
+            region = get_largest_region(mask[y0:y1, x0:x1])
+
+            if region is not None:
+                rx, ry, rw, rh = region
+                clipped = (rx == 0 and x0 > 0) or (ry == 0 and y0 > 0) or \
+                    (rx + rw == x1 - x0 and x1 < width) or (ry + rh == y1 - y0 and y1 < height)
+
+                if not clipped:
+                    return rx + x0, ry + y0, rw, rh
+
+    return get_largest_region(mask)
@@ -7,6 +7,7 @@ from SamGui.Widgets.Buttons import DialogButton
 from SamGui.Utils import get_file_extension, get_filename, read_class_file
 from SamGui.Data import SAMMode, SegmentationData, SamResult, BatchSamResult, ErrorMessage
 from SamGui.Runners import SAMRunner
+from SamGui.Inference import ENCODER_PATH, DECODER_PATH
 from PySide6.QtCore import Qt, Signal, QThreadPool
 from PySide6.QtWidgets import (QDialog, QHBoxLayout, QMessageBox, QVBoxLayout, QRadioButton, QLabel, QDialogButtonBox,
                                QFileDialog, QPushButton, QCheckBox, QInputDialog, QLineEdit,
@@ -115,12 +116,14 @@ class TexInputDialog(QDialog):
 
 
 class SettingsWindow(QDialog):
-    def __init__(self, current_mode: SAMMode, adjust_bbox: bool):
+    def __init__(self, current_mode: SAMMode, adjust_bbox: bool, live_preview: bool = False, low_res: bool = False):
         super().__init__()
         self.setWindowTitle("Sam Settings")
         self.current_mode = current_mode
         self.adjust_bbox = adjust_bbox
-        self.setFixedHeight(300)
+        self.live_preview = live_preview
+        self.low_res = low_res
+        self.setFixedHeight(330)
         self.setFixedWidth(600)
         self.setWindowModality(Qt.WindowModality.ApplicationModal)
         self.label = QLabel("Sam Settings")
@@ -131,11 +134,20 @@ class SettingsWindow(QDialog):
         self.btn_bbox_mode = QRadioButton("BBox Mode")
         self.btn_adjust_bbox = QCheckBox("Adjust BBox by SAM")
         self.btn_adjust_bbox.setChecked(self.adjust_bbox)
+        self.btn_live_preview = QCheckBox("Live Preview while moving BBoxes and Anchors")
+        self.btn_live_preview.setChecked(self.live_preview)
+        self.btn_low_res = QCheckBox("Low Resolution Masks (faster, upsampled around the BBoxes)")
+        self.btn_low_res.setChecked(self.low_res)
+        self.btn_low_res.setToolTip(
+            "Masks are upsampled around their BBox only, masks that reach past it are upsampled for the whole image"
+        )
 
         # bind signals
         self.btn_anchor_mode.clicked.connect(self.set_anchor_mode)
         self.btn_bbox_mode.clicked.connect(self.set_bbox_mode)
         self.btn_adjust_bbox.clicked.connect(self.toggle_bbox_check)
+        self.btn_live_preview.clicked.connect(self.toggle_live_preview)
+        self.btn_low_res.clicked.connect(self.toggle_low_res)
 
         # define layout
         self.v_layout = QVBoxLayout()
@@ -144,6 +156,8 @@ class SettingsWindow(QDialog):
         self.v_layout.addWidget(self.btn_bbox_mode)
         self.v_layout.addWidget(self.spacer)
         self.v_layout.addWidget(self.btn_adjust_bbox)
+        self.v_layout.addWidget(self.btn_live_preview)
+        self.v_layout.addWidget(self.btn_low_res)
 
         self.h_layout = QHBoxLayout()
         self.default_buttons = QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel
@@ -194,6 +208,14 @@ class SettingsWindow(QDialog):
             color: #ffffff;
         """)
 
+        self.btn_live_preview.setStyleSheet("""
+            color: #ffffff;
+        """)
+
+        self.btn_low_res.setStyleSheet("""
+            color: #ffffff;
+        """)
+
         self.buttonBox.accepted.connect(self.accept)
         self.buttonBox.rejected.connect(self.reject)
         self.h_layout.addWidget(self.buttonBox)
@@ -223,6 +245,12 @@ class SettingsWindow(QDialog):
         print(f"Toogle BBox Check: {self.btn_adjust_bbox.isChecked()}")
         self.adjust_bbox = self.btn_adjust_bbox.isChecked()
 
+    def toggle_live_preview(self):
+        self.live_preview = self.btn_live_preview.isChecked()
+
+    def toggle_low_res(self):
+        self.low_res = self.btn_low_res.isChecked()
+
 
 class IODialog(QFileDialog):
     def __init__(self, view_mode: QFileDialog.ViewMode, file_mode: QFileDialog.FileMode, parent=None):
@@ -410,20 +438,28 @@ class SamDialog(QDialog):
     sign_batch_result = Signal(BatchSamResult)
     s_error = Signal(ErrorMessage)
 
-    def __init__(self, data: SegmentationData, mode: SAMMode, adjust_bbox: bool, pool: QThreadPool, parent=None):
+    def __init__(
+            self,
+            data: SegmentationData,
+            mode: SAMMode,
+            adjust_bbox: bool,
+            pool: QThreadPool,
+            low_res: bool = False,
+            parent=None):
         super(SamDialog, self).__init__(parent)
         self.setObjectName("SamDialog")
         self.setFixedWidth(360)
         self.setFixedHeight(140)
         self.setWindowTitle("SAM Mask Generation")
         self.setWindowModality(Qt.WindowModality.ApplicationModal)
-        self.encoder_path: str = "SamGui/Models/sam_vit_b_encoder.onnx"
-        self.decoder_path: str = "SamGui/Models/sam_vit_b_decoder.onnx"
+        self.encoder_path: str = ENCODER_PATH
+        self.decoder_path: str = DECODER_PATH
 
         self.data = data
         self.mode = mode
         self.pool = pool
         self.adjust_bbox = adjust_bbox
+        self.low_res = low_res
         self.label = QLabel("Running Mask Generation....")
 
         self.progress_bar = QProgressBar()
@@ -460,13 +496,16 @@ class SamDialog(QDialog):
             self.close()
             return
         
-        if not os.path.isfile(self.encoder_path):
-            error_msg = ErrorMessage("Decoder not Found", "The model encoder was not found. Make sure you have sam_vit_b_decoder.onnx in your SamGui/Models directory.")
+        if not os.path.isfile(self.decoder_path):
+            error_msg = ErrorMessage("Decoder not Found", "The model decoder was not found. Make sure you have sam_vit_b_decoder.onnx in your SamGui/Models directory.")
             self.s_error.emit(error_msg)
             self.close()
             return
 
-        worker = SAMRunner(self.data, self.mode, self.adjust_bbox, encoder_path=self.encoder_path, decoder_path=self.decoder_path)
+        worker = SAMRunner(
+            self.data, self.mode, self.adjust_bbox,
+            encoder_path=self.encoder_path, decoder_path=self.decoder_path, low_res=self.low_res
+        )
         worker.signals.s_sam_result.connect(self.handle_sam_result)
         worker.signals.s_sam_batch_result.connect(self.handle_sam_batch_result)
         worker.signals.s_finished.connect(self.thread_complete)
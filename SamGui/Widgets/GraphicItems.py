@@ -1,12 +1,16 @@
 import uuid
+import numpy as np
+import numpy.typing as npt
+
 from PIL import Image
 from uuid import UUID
 from typing import Optional
 from PySide6.QtWidgets import QGraphicsItem, QStyleOptionGraphicsItem, QWidget
 from SamGui.Controller import CanvasController
-from SamGui.Data import Edge, Label, BBoxPosition, AnchorPosition
+from SamGui.Runners import TileLoader
+from SamGui.Data import Edge, Label, BBoxPosition, AnchorPosition, PackedMask
 from PySide6.QtCore import Qt, Signal, QPoint, QPointF, QRectF
-from PySide6.QtGui import QBrush, QColor, QPen, QPainterPath, QPixmap, QPainter
+from PySide6.QtGui import QBrush, QColor, QPen, QPainterPath, QPixmap, QPainter, QImage, qRgba
 from PySide6.QtWidgets import QGraphicsEllipseItem, QGraphicsPixmapItem
 
 
@@ -24,13 +28,17 @@ class AnnotationItem:
 
 
 class PixmapImage(QGraphicsPixmapItem):
-    def __init__(self, guid: UUID, image_path: str, controller: CanvasController):
+    """
+    The image is decoded in the background and handed over with set_image(), a placeholder of the same size
+    is painted until then
+    """
+    def __init__(self, guid: UUID, image_path: str, controller: CanvasController, width: int = 0, height: int = 0):
         super().__init__()
         self.guid = guid
         self.image_path = image_path
+        self.width = width
+        self.height = height
         self.current_position = self.scenePos()
-        self.pixmap = QPixmap(self.image_path)
-        self.setPixmap(self.pixmap)
         self.controller = controller
         #self.setFlags(QGraphicsItem.GraphicsItemFlag.ItemIsMovable | QGraphicsItem.GraphicsItemFlag.ItemIsSelectable)
 
@@ -38,9 +46,164 @@ class PixmapImage(QGraphicsPixmapItem):
         self.setPos(x, y)
         self.current_position = self.scenePos()
 
+    def is_loaded(self) -> bool:
+        return not self.pixmap().isNull()
+
+    def set_image(self, image: QImage):
+        self.prepareGeometryChange()
+        self.setPixmap(QPixmap.fromImage(image))
+
+    def boundingRect(self) -> QRectF:
+        if self.is_loaded():
+            return super().boundingRect()
+
+        return QRectF(0, 0, self.width, self.height)
+
+    def paint(self, painter: QPainter, option: QStyleOptionGraphicsItem, widget: QWidget = None) -> None:
+        if self.is_loaded():
+            super().paint(painter, option, widget)
+        else:
+            painter.fillRect(self.boundingRect(), QColor("#2f2f2f"))
+
+
+class TiledImage(QGraphicsItem):
+    """
+    Drop-in replacement of PixmapImage for very large images. Only the tiles that intersect the exposed area are
+    painted, from the pyramid level that matches the current zoom, so painting costs depend on the size of the view
+    and not on the size of the image. Until a tile is loaded the matching area of a coarser tile is drawn instead.
+    """
+    def __init__(self, guid: UUID, image_path: str, width: int, height: int, controller: CanvasController):
+        super().__init__()
+        self.guid = guid
+        self.image_path = image_path
+        self.width = width
+        self.height = height
+        self.controller = controller
+        self.current_position = self.scenePos()
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)  # provides exposedRect in paint()
+
+        self.loader = TileLoader(image_path)
+        self.loader.s_ready.connect(self.update)
+        self.loader.s_tile.connect(self.handle_tile)
+        self.loader.start()
+
+    def update_position(self, x: int, y: int):
+        self.setPos(x, y)
+        self.current_position = self.scenePos()
+
+    def boundingRect(self) -> QRectF:
+        return QRectF(0, 0, self.width, self.height)
+
+    def tile_rect(self, level: int, column: int, row: int) -> QRectF:
+        """
+        Area of a tile in item coordinates
+        """
+        pyramid = self.loader.pyramid
+        level_width, level_height = pyramid.level_size(level)
+        scale_x = self.width / level_width
+        scale_y = self.height / level_height
+        x = column * pyramid.tile_size
+        y = row * pyramid.tile_size
+
+        return QRectF(
+            x * scale_x,
+            y * scale_y,
+            (min(x + pyramid.tile_size, level_width) - x) * scale_x,
+            (min(y + pyramid.tile_size, level_height) - y) * scale_y
+        )
+
+    def handle_tile(self, level: int, column: int, row: int):
+        self.update(self.tile_rect(level, column, row))
+
+    def paint_fallback(self, painter: QPainter, level: int, target: QRectF) -> None:
+        pyramid = self.loader.pyramid
+        tile_size = pyramid.tile_size
+
+        for coarse_level in range(level + 1, pyramid.levels):
+            level_width, level_height = pyramid.level_size(coarse_level)
+            scale_x = self.width / level_width
+            scale_y = self.height / level_height
+            column = int(target.center().x() / scale_x) // tile_size
+            row = int(target.center().y() / scale_y) // tile_size
+            tile = self.loader.get_tile(coarse_level, column, row)
+
+            if tile is not None:
+                source = QRectF(
+                    target.x() / scale_x - column * tile_size,
+                    target.y() / scale_y - row * tile_size,
+                    target.width() / scale_x,
+                    target.height() / scale_y
+                )
+                painter.drawImage(target, tile, source)
+                return
+
+    def paint(self, painter: QPainter, option: QStyleOptionGraphicsItem, widget: QWidget = None) -> None:
+        pyramid = self.loader.pyramid
+
+        if pyramid is None or self.loader.overview is None:
+            painter.fillRect(self.boundingRect(), QColor("#2f2f2f"))
+            return
+
+        scale = option.levelOfDetailFromTransform(painter.worldTransform())
+        level = pyramid.level_for_scale(scale)
+        exposed = option.exposedRect.intersected(self.boundingRect())
+
+        if exposed.isEmpty():
+            return
+
+        level_width, level_height = pyramid.level_size(level)
+        tile_width = pyramid.tile_size * self.width / level_width
+        tile_height = pyramid.tile_size * self.height / level_height
+        columns, rows = pyramid.tile_count(level)
+        first_column = max(0, int(exposed.left() / tile_width))
+        last_column = min(columns - 1, int(exposed.right() / tile_width))
+        first_row = max(0, int(exposed.top() / tile_height))
+        last_row = min(rows - 1, int(exposed.bottom() / tile_height))
+        missing = []
+
+        painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                target = self.tile_rect(level, column, row)
+                tile = self.loader.get_tile(level, column, row)
+
+                if tile is None:
+                    self.paint_fallback(painter, level, target)
+                    missing.append((level, column, row))
+                else:
+                    painter.drawImage(target, tile)
+
+        self.loader.request(missing)
+
+    def release(self):
+        self.loader.cancel()
+
+
+# value v of a mask becomes (v, 0, 0) at half opacity, which dims the background and tints the mask red
+MASK_COLOR_TABLE = [qRgba(v, 0, 0, 128) for v in range(256)]
+
+
+def create_mask_pixmap(mask: Image.Image | npt.NDArray) -> QPixmap:
+    """
+    Builds the overlay pixmap of a single channel uint8 mask. The mask buffer is wrapped as an indexed QImage
+    with MASK_COLOR_TABLE, so the only full frame copy is the conversion into the pixmap.
+    """
+    array = np.asarray(mask, dtype=np.uint8)
+
+    if not array.flags.c_contiguous:
+        array = np.ascontiguousarray(array)
+
+    height, width = array.shape
+    image = QImage(array.data, width, height, array.strides[0], QImage.Format.Format_Indexed8)
+    image.setColorTable(MASK_COLOR_TABLE)
+
+    # the QImage only borrows the buffer of array, which stays alive until the pixmap holds its own copy
+    return QPixmap.fromImage(image)
+
 
 class MaskPreview(AnnotationItem, QGraphicsPixmapItem):
-    def __init__(self, guid: UUID, image: Image, pixmap: QPixmap, controller: CanvasController, parent: Optional[QGraphicsItem] = None):
+    def __init__(self, guid: UUID, image: Image.Image | npt.NDArray | PackedMask, pixmap: QPixmap, controller: CanvasController, parent: Optional[QGraphicsItem] = None):
         super().__init__()
         self.parent = parent
         self.setParentItem(self.parent)
@@ -76,6 +239,7 @@ class AnchorPoint(AnnotationItem, QGraphicsEllipseItem):
         self.label = label
         self.class_id = class_id
         self.parent_item = parent
+        self.emit_moves = True  # only moves made by the user are reported, see set_position
         self.setParentItem(self.parent_item)
         self.setPos(self.x_pos, self.y_pos)
         self.current_position = self.scenePos()
@@ -100,12 +264,28 @@ class AnchorPoint(AnnotationItem, QGraphicsEllipseItem):
 
     def itemChange(self, change, value):
         if change == QGraphicsItem.GraphicsItemChange.ItemPositionHasChanged:
-            self.current_position = value
-            position = AnchorPosition(self.guid, self.x_pos, self.y_pos)
-            self.controller.s_update_anchor_position.emit(position)
+            # report where the anchor was dragged to, not where it was created
+            self.current_position = self.scenePos()
+            self.x_pos = self.current_position.x()
+            self.y_pos = self.current_position.y()
+
+            if self.emit_moves:
+                position = AnchorPosition(self.guid, self.x_pos, self.y_pos)
+                self.controller.s_update_anchor_position.emit(position)
         else:
             return value
 
+    def set_position(self, x: float, y: float, emit: bool = True):
+        """
+        Moves the anchor, with emit=False the move isn't reported back, e.g. when it applies a change of the model
+        """
+        self.emit_moves = emit
+
+        try:
+            self.setPos(x, y)
+        finally:
+            self.emit_moves = True
+
     def set_class(self, class_id: Label):
         if class_id == Label.foreground:
             self.default_brush = QBrush(Qt.GlobalColor.green)
@@ -134,6 +314,7 @@ class BBoxRect(AnnotationItem, QGraphicsItem):
         self.height = end_point.y() - start_point.y()
         self.is_selected = False
         self.current_position = QPointF(self.start_point.x(), self.start_point.y())
+        self.emit_moves = True  # see update_stats
         self.setPos(self.start_point)
 
         self.edge_size = 10
@@ -158,15 +339,29 @@ class BBoxRect(AnnotationItem, QGraphicsItem):
         self.setAcceptDrops(True)
         self.setAcceptHoverEvents(True)
             
-    def update_stats(self, start_point: QPointF, end_point: QPointF):
+    def update_stats(self, start_point: QPointF, end_point: QPointF, emit: bool = True):
         self.start_point = start_point
         self.end_point = end_point
         self.width = end_point.x() - start_point.x()
         self.height = end_point.y() - start_point.y()
         self.current_position = QPointF(self.start_point.x(), self.start_point.y())
-        self.setPos(self.start_point)
-        position = BBoxPosition(self.guid, start_point.x(), start_point.y(), self.width, self.height)
-        self.controller.s_update_bbox_position.emit(position)
+
+        # the new geometry is reported once below (if at all), not again by itemChange
+        self.emit_moves = False
+
+        try:
+            self.setPos(self.start_point)
+        finally:
+            self.emit_moves = True
+
+        if emit:
+            position = BBoxPosition(self.guid, start_point.x(), start_point.y(), self.width, self.height)
+            self.controller.s_update_bbox_position.emit(position)
+
+    def set_geometry(self, x: float, y: float, w: float, h: float, emit: bool = True):
+        self.prepareGeometryChange()
+        self.update_stats(QPointF(x, y), QPointF(x + w, y + h), emit)
+        self.update()
 
     def check_for_edge(self, event):
         self.clicked_pos = event.pos()
@@ -306,7 +501,7 @@ class BBoxRect(AnnotationItem, QGraphicsItem):
             scene_pos = self.sceneBoundingRect()
             new_start = QPointF(scene_pos.x(), scene_pos.y())
             new_end = QPointF(scene_pos.x() + scene_pos.width(), scene_pos.y() + scene_pos.height())
-            self.update_stats(new_start, new_end)
+            self.update_stats(new_start, new_end, self.emit_moves)
 
         else:
             return value
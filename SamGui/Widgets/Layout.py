@@ -1,18 +1,23 @@
 import uuid
+import logging
 from uuid import UUID
-from PIL.ImageQt import ImageQt
+from typing import List
 from SamGui.Widgets.Buttons import MenuButton
 
-from SamGui.Widgets.GraphicItems import AnnotationItem, AnchorPoint, BBoxRect, PixmapImage, MaskPreview
+from SamGui.Widgets.GraphicItems import AnnotationItem, AnchorPoint, BBoxRect, PixmapImage, TiledImage, MaskPreview, \
+    create_mask_pixmap
 from SamGui.Controller import HeaderController, CanvasController
 from SamGui.Widgets.Dialogs import ConfirmationWindow, NotificationWindow
 from SamGui.Data import Tool, Label, Anchor, BBox, Mask, SegmentationData, AnchorState, BBoxLabel, \
-    ProjectData, ZoomLevel, BBoxPosition, AnchorPosition
-from SamGui.Widgets.ListWidgets import CanvasAnchorEntry, CanvasBBoxEntry, CanvasHierarchyEntry, ImageEntry
+    ZoomLevel, BBoxPosition, AnchorPosition, EmbeddingStatus, PreviewResult, AnnotationDelta, AnnotationKind
+from SamGui.Widgets.ListWidgets import CanvasAnchorEntry, CanvasBBoxEntry, CanvasHierarchyEntry, ImageListModel, \
+    ImageEntryDelegate
 from SamGui.MVVM.viewmodel import SamViewModel
-from SamGui.Utils import generate_alpha_mask, has_data
+from SamGui.Runners import ThumbnailScheduler, ImageLoader
+from SamGui.Cache import get_image_size_cache
+from SamGui.Utils import unpack_mask
 from PySide6.QtGui import QIcon, QBrush, QColor, QPen, QPixmap, QResizeEvent, QPainter, QImage
-from PySide6.QtCore import Qt, Signal, QPoint, QPointF
+from PySide6.QtCore import Qt, Signal, QPoint, QPointF, QModelIndex
 from PySide6.QtWidgets import (
     QWidget,
     QFrame,
@@ -23,7 +28,11 @@ from PySide6.QtWidgets import (
     QGraphicsView,
     QGraphicsItem,
     QListWidget,
-    QListWidgetItem
+    QListWidgetItem,
+    QListView,
+    QAbstractItemView,
+    QProgressBar,
+    QPushButton
 )
 
 
@@ -44,6 +53,8 @@ class Header(QFrame):
         self.main_tools.btn_open.clicked.connect(self.load_image)
         self.main_tools.btn_import_project.clicked.connect(self.import_project)
         self.main_tools.btn_export_project.clicked.connect(self.export_project)
+        self.main_tools.btn_open_project.clicked.connect(self.import_annotations)
+        self.main_tools.btn_save_project.clicked.connect(self.save_annotations)
 
         self.canvas_tools.s_clear_canvas.connect(self.clear_canvas)
         self.canvas_tools.s_set_current_tool.connect(self.set_current_tool)
@@ -131,6 +142,22 @@ class MainTools(QFrame):
             toolip="Import Images"
         )
 
+        self.btn_open_project = MenuButton(
+            QIcon("SamGui/Assets/Textures/ImportAnnotations_light.png"),
+            QIcon("SamGui/Assets/Textures/ImportAnnotations_light_hover.png"),
+            width=self.button_size,
+            height=self.button_size,
+            toolip="Open Project"
+        )
+
+        self.btn_save_project = MenuButton(
+            QIcon("SamGui/Assets/Textures/save-disc.png"),
+            QIcon("SamGui/Assets/Textures/save-disc_highlight.png"),
+            width=self.button_size,
+            height=self.button_size,
+            toolip="Save Project"
+        )
+
         self.btn_import_project = MenuButton(
             QIcon("SamGui/Assets/Textures/import_project_light.png"),
             QIcon("SamGui/Assets/Textures/import_project_light_hover.png"),
@@ -150,6 +177,8 @@ class MainTools(QFrame):
         # build layout
         self.layout.addWidget(self.btn_new)
         self.layout.addWidget(self.btn_open)
+        self.layout.addWidget(self.btn_open_project)
+        self.layout.addWidget(self.btn_save_project)
         self.layout.addWidget(self.btn_import_project)
         self.layout.addWidget(self.btn_export_project)
 
@@ -440,23 +469,71 @@ class HierarchyHeader(QFrame):
 
 
 class ImportedImageList(QFrame):
+    s_cancel_embeddings = Signal()
+    s_cancel_import = Signal()
+
     def __init__(self, view_model: SamViewModel):
         super().__init__()
         self.setObjectName("SideBox")
         self.view_model = view_model
         self.header = HierarchyHeader(label_text="Imported Images")
-        self.widget_list = WidgetList()
+        self.image_model = ImageListModel()
+        self.image_delegate = ImageEntryDelegate()
+        self.image_view = ImageListView(self.image_model, self.image_delegate)
+        self.thumbnail_scheduler = ThumbnailScheduler()
+
+        self.embedding_progress = QProgressBar()
+        self.embedding_progress.setFormat("Encoding %v/%m")
+        self.btn_cancel_embeddings = QPushButton("Cancel")
+        self.btn_cancel_embeddings.setObjectName("DialogButton")
+        self.btn_cancel_embeddings.setToolTip("Stop precomputing SAM embeddings")
+
+        self.progress_frame = QFrame()
+        self.progress_layout = QHBoxLayout()
+        self.progress_layout.setContentsMargins(4, 4, 4, 4)
+        self.progress_layout.addWidget(self.embedding_progress)
+        self.progress_layout.addWidget(self.btn_cancel_embeddings)
+        self.progress_frame.setLayout(self.progress_layout)
+        self.progress_frame.setVisible(False)
+
+        self.import_progress = QProgressBar()
+        self.import_progress.setFormat("Importing %v/%m")
+        self.btn_cancel_import = QPushButton("Cancel")
+        self.btn_cancel_import.setObjectName("DialogButton")
+        self.btn_cancel_import.setToolTip("Stop importing the dataset")
+
+        self.import_frame = QFrame()
+        self.import_layout = QHBoxLayout()
+        self.import_layout.setContentsMargins(4, 4, 4, 4)
+        self.import_layout.addWidget(self.import_progress)
+        self.import_layout.addWidget(self.btn_cancel_import)
+        self.import_frame.setLayout(self.import_layout)
+        self.import_frame.setVisible(False)
 
         # connect signals
         self.header.sign_on_delete_hierarchy.connect(self.delete_images)
-        self.widget_list.s_on_item_selected.connect(self.handle_item_selection)
-        self.view_model.s_dataChanged.connect(self.update_data)
+        self.image_view.s_on_item_selected.connect(self.handle_item_selection)
+        self.image_delegate.s_on_export_annotations.connect(self.export_annotations)
+        self.image_delegate.s_on_mask_export.connect(self.export_mask)
+        self.image_delegate.s_on_mask_export_cropped.connect(self.export_cropped_mask)
+        self.image_delegate.s_on_annotation_delete.connect(self.delete_annotations)
+        self.view_model.s_imagesAdded.connect(self.image_model.add_images)
+        self.view_model.s_imagesRemoved.connect(self.image_model.remove_images)
+        self.view_model.s_dataCleared.connect(self.image_model.clear)
+        self.view_model.s_dataCleared.connect(self.thumbnail_scheduler.cancel)
+        self.image_model.s_thumbnail_requested.connect(self.thumbnail_scheduler.request)
+        self.thumbnail_scheduler.s_thumbnail.connect(self.image_model.set_thumbnail)
+        self.thumbnail_scheduler.s_dropped.connect(self.image_model.discard_thumbnail_request)
+        self.btn_cancel_embeddings.clicked.connect(self.cancel_embeddings)
+        self.btn_cancel_import.clicked.connect(self.s_cancel_import.emit)
 
         # build layout
         self.setMinimumWidth(260)
         self.v_layout = QVBoxLayout()
         self.v_layout.addWidget(self.header)
-        self.v_layout.addWidget(self.widget_list)
+        self.v_layout.addWidget(self.image_view)
+        self.v_layout.addWidget(self.import_frame)
+        self.v_layout.addWidget(self.progress_frame)
         self.v_layout.setContentsMargins(0, 0, 0, 0)
         self.v_layout.setSpacing(0)
         self.setLayout(self.v_layout)
@@ -470,45 +547,41 @@ class ImportedImageList(QFrame):
 
             if dialog.exec():
                 self.view_model.delete_images()
+                self.s_cancel_embeddings.emit()
 
     def handle_item_selection(self, guid: UUID):
         self.view_model.select_image_by_guid(guid)
 
-    def add_data(self, project_data: ProjectData):
-        self.widget_list.clear()
-
-        if has_data(project_data.data):
-            for k, data in project_data.data.items():
-                item = QListWidgetItem(self.widget_list)
-                entry = ImageEntry(data.guid, data.file_name)
-                entry.s_on_export_annotations.connect(self.export_annotations)
-                entry.s_on_mask_export_cropped.connect(self.export_cropped_mask)
-                entry.s_on_mask_export.connect(self.export_mask)
-                entry.s_on_selected.connect(self.select_item)
-                item.setSizeHint(entry.sizeHint())
-
-                self.widget_list.addItem(item)
-                self.widget_list.setItemWidget(item, entry)
-
-            for idx in range(self.widget_list.count()):
-                entry = self.widget_list.itemWidget(self.widget_list.item(idx))
-                if idx % 2 == 0:
-                    _qBrush = QBrush(QColor("#1e1a3d"))
-                    if isinstance(entry, ImageEntry):
-                        entry.set_dark_background()
-                        self.widget_list.item(idx).setBackground(_qBrush)
-                else:
-                    _qBrush = QBrush(QColor("#292951"))
-                    if isinstance(entry, ImageEntry):
-                        entry.set_light_background()
-                        self.widget_list.item(idx).setBackground(_qBrush)
+    def set_embedding_state(self, status: EmbeddingStatus):
+        self.image_model.set_embedding_state(status.image_guid, status.state)
+
+    def set_embedding_progress(self, done: int, total: int):
+        if total == 0 or done >= total:
+            self.progress_frame.setVisible(False)
+            return
+
+        self.embedding_progress.setMaximum(total)
+        self.embedding_progress.setValue(done)
+        self.progress_frame.setVisible(True)
+
+    def set_import_progress(self, done: int, total: int):
+        if total == 0:
+            self.import_frame.setVisible(False)
+            return
+
+        self.import_progress.setMaximum(total)
+        self.import_progress.setValue(done)
+        self.import_frame.setVisible(True)
 
-    def update_data(self, data: ProjectData):
-        self.widget_list.clear()
-        self.add_data(data)
+    def cancel_embeddings(self):
+        self.s_cancel_embeddings.emit()
+        self.image_model.clear_pending_states()
 
     def delete_annotations(self, image_guid: UUID):
-        self.view_model.delete_annotations(image_guid)
+        dialog = ConfirmationWindow("Deleting Annotations", "Delete all annotations of this image?")
+
+        if dialog.exec():
+            self.view_model.delete_annotations(image_guid)
 
     def export_annotations(self, image_guid: UUID):
         self.view_model.export_yolo_annotations(image_guid)
@@ -519,11 +592,6 @@ class ImportedImageList(QFrame):
     def export_cropped_mask(self, image_guid: UUID):
         self.view_model.export_masks_cropped(image_guid)
 
-    def select_item(self, image_guid: UUID):
-        """
-        TODO: Maybe some style overrides
-        """
-
 class MainHierarchy(QFrame):
     def __init__(self, view_model: SamViewModel):
         super(MainHierarchy, self).__init__()
@@ -540,6 +608,45 @@ class MainHierarchy(QFrame):
         self.setLayout(self.v_layout)
 
 
+SCROLLBAR_STYLE = """
+QScrollBar:vertical {
+    border: none;
+    background: rgb(45, 45, 68);
+    width: 25px;
+    margin: 10px 5px 15px 10px;
+    border-radius: 0px;
+ }
+
+QScrollBar::handle:vertical {
+    border: 2px solid #ffad00;
+    background-color: #ffad00;
+    min-height: 30px;
+    border-radius: 3px;
+}
+QScrollBar::handle:vertical:hover{	
+    background-color: #ffad00;
+}
+QScrollBar::handle:vertical:pressed {	
+    background-color: #ffad00;
+}
+
+QScrollBar::sub-line:vertical {
+    height: 0px;
+}
+
+QScrollBar::add-line:vertical {
+    height: 0px;
+}
+
+QScrollBar::up-arrow:vertical, QScrollBar::down-arrow:vertical {
+    background: none;
+}
+QScrollBar::add-page:vertical, QScrollBar::sub-page:vertical {
+    background: none;
+}
+"""
+
+
 class WidgetList(QListWidget):
     s_on_item_selected = Signal(UUID)
     s_on_item_entered = Signal()
@@ -557,46 +664,7 @@ class WidgetList(QListWidget):
 
         self.v_scrollbar = self.verticalScrollBar()
 
-        self.v_scrollbar.setStyleSheet(
-            """
-            QScrollBar:vertical {
-                border: none;
-                background: rgb(45, 45, 68);
-                width: 25px;
-                margin: 10px 5px 15px 10px;
-                border-radius: 0px;
-             }
-
-            QScrollBar::handle:vertical {
-                border: 2px solid #ffad00;
-                background-color: #ffad00;
-                min-height: 30px;
-                border-radius: 3px;
-            }
-            QScrollBar::handle:vertical:hover{	
-                background-color: #ffad00;
-            }
-            QScrollBar::handle:vertical:pressed {	
-                background-color: #ffad00;
-            }
-
-            QScrollBar::sub-line:vertical {
-                height: 0px;
-            }
-
-            QScrollBar::add-line:vertical {
-                height: 0px;
-            }
-
-            QScrollBar::up-arrow:vertical, QScrollBar::down-arrow:vertical {
-                background: none;
-            }
-            QScrollBar::add-page:vertical, QScrollBar::sub-page:vertical {
-                background: none;
-            }
-
-            """
-        )
+        self.v_scrollbar.setStyleSheet(SCROLLBAR_STYLE)
 
         self.setStyleSheet("""
             QListWidget::item:selected {
@@ -608,11 +676,7 @@ class WidgetList(QListWidget):
     def on_item_clicked(self, item: QListWidgetItem):
         _list_item_widget = self.itemWidget(item)
 
-        if isinstance(_list_item_widget, ImageEntry):
-            _qBrush = QBrush(QColor("#292951"))
-            #item.setBackground(_qBrush)
-
-        if isinstance(_list_item_widget, CanvasHierarchyEntry) or isinstance(_list_item_widget, ImageEntry):
+        if isinstance(_list_item_widget, CanvasHierarchyEntry):
             _guid = _list_item_widget.guid
             self.s_on_item_selected.emit(_guid)
 
@@ -623,6 +687,66 @@ class WidgetList(QListWidget):
         self.s_on_item_left.emit()
 
 
+class ImageListView(QListView):
+    s_on_item_selected = Signal(UUID)
+
+    def __init__(self, model: ImageListModel, delegate: ImageEntryDelegate, parent=None):
+        super().__init__(parent)
+        self.setObjectName("ImageList")
+        self.setMinimumWidth(240)
+        self.setMaximumWidth(460)
+        self.setContentsMargins(0, 0, 0, 0)
+        self.setModel(model)
+        self.setItemDelegate(delegate)
+        self.setUniformItemSizes(True)
+        self.setMouseTracking(True)
+        self.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        self.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.verticalScrollBar().setStyleSheet(SCROLLBAR_STYLE)
+        self.delegate = delegate
+        self.clicked.connect(self.on_item_clicked)
+
+    def on_item_clicked(self, index: QModelIndex):
+        self.s_on_item_selected.emit(index.data(ImageListModel.GuidRole))
+
+    def button_at(self, pos: QPoint) -> tuple:
+        index = self.indexAt(pos)
+
+        if not index.isValid():
+            return index, None
+
+        return index, self.delegate.button_at(self.visualRect(index), pos)
+
+    def mousePressEvent(self, event):
+        # clicks on the row buttons must not select the row
+        _, button = self.button_at(event.position().toPoint())
+
+        if button is None:
+            super().mousePressEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        index, button = self.button_at(event.position().toPoint())
+
+        if button is None:
+            super().mouseReleaseEvent(event)
+        elif event.button() == Qt.MouseButton.LeftButton:
+            button.signal.emit(index.data(ImageListModel.GuidRole))
+
+    def mouseMoveEvent(self, event):
+        super().mouseMoveEvent(event)
+        index, button = self.button_at(event.position().toPoint())
+
+        if self.delegate.set_hovered(index.row(), button):
+            self.viewport().update()
+
+    def leaveEvent(self, event):
+        super().leaveEvent(event)
+
+        if self.delegate.set_hovered(-1, None):
+            self.viewport().update()
+
+
 class CanvasHierarchy(QFrame):
     def __init__(self, controller: CanvasController):
         super().__init__()
@@ -679,6 +803,19 @@ class CanvasHierarchy(QFrame):
 
         self.update_hierarchy(entry)
 
+    def remove_entry(self, guid: UUID):
+        self.anchor_items = [x for x in self.anchor_items if x.guid != guid]
+        self.bbox_items = [x for x in self.bbox_items if x.guid != guid]
+
+        for idx in range(self.element_list.count()):
+            entry = self.element_list.itemWidget(self.element_list.item(idx))
+
+            if isinstance(entry, CanvasHierarchyEntry) and entry.guid == guid:
+                self.element_list.takeItem(idx)
+                break
+
+        self.update_backgrounds()
+
     def select_item(self, guid: UUID):
         self.controller.select_item(guid)
 
@@ -695,7 +832,9 @@ class CanvasHierarchy(QFrame):
         _list_widget.setSizeHint(entry.sizeHint())
         self.element_list.addItem(_list_widget)
         self.element_list.setItemWidget(_list_widget, entry)
+        self.update_backgrounds()
 
+    def update_backgrounds(self):
         for idx in range(self.element_list.count()):
             entry = self.element_list.itemWidget(self.element_list.item(idx))
             if idx % 2 == 0:
@@ -763,7 +902,6 @@ class Canvas(QFrame):
 
         self.controller.s_select_canvas_item.connect(self.select_item)
         self.controller.s_clear_data.connect(self.clear_canvas)
-        self.controller.s_delete_elements.connect(self.clear_canvas)
         self.controller.s_toggle_anchor_state.connect(self.toggle_anchor_state)
 
 
@@ -776,8 +914,12 @@ class Canvas(QFrame):
         when switching between images in the Image Hierarchy
         """
         self.current_image_guid = None
-        self.current_image = None  # QGraphicsPixmapItem
+        self.current_image = None  # PixmapImage or TiledImage
+        self.tiling_threshold = 4096 * 4096  # images above this pixel count are painted from a tile pyramid
+        self.image_loader = ImageLoader(self.tiling_threshold)
+        self.image_loader.s_loaded.connect(self.handle_image_loaded)
         self.current_mask = None  # Mask item
+        self.preview_item = None  # live preview overlay, reused while dragging
         self.hidden_items = []
 
         self.show()
@@ -885,6 +1027,10 @@ class Canvas(QFrame):
 
     def clear_canvas(self):
         self.hidden_items.clear()
+        self.preview_item = None
+
+        if isinstance(self.current_image, TiledImage):
+            self.current_image.release()
 
         for item in self.canvas_objects:
             self.gr_scene.remove_item(item)
@@ -901,29 +1047,132 @@ class Canvas(QFrame):
         self.clear_canvas()
         self.view.reset_scale()
 
-        _pixmap_image = PixmapImage(data.guid, data.file_path, self.controller)
+        try:
+            width, height = get_image_size_cache().get(data.file_path)
+        except OSError as e:
+            logging.error(f"Failed to open image {data.file_path}: {e}")
+            width, height = 0, 0
+
+        if width * height > self.tiling_threshold:
+            _pixmap_image = TiledImage(data.guid, data.file_path, width, height, self.controller)
+        else:
+            _pixmap_image = PixmapImage(data.guid, data.file_path, self.controller, width, height)
+            image = self.image_loader.get(data.file_path)
+
+            if image is not None:
+                _pixmap_image.set_image(image)
+            else:
+                self.image_loader.load(data.guid, data.file_path)
+
         self.current_image = _pixmap_image
         self.current_image_guid = data.guid
         self.current_mask = data.mask
 
+        self.gr_scene.set_scene(max(width, self.gr_scene.scene_width), max(height, self.gr_scene.scene_height))
         _pixmap_image.update_position(data.x, data.y)
         self.gr_scene.add_item(_pixmap_image, z_order=0)
         self.view.reset_scrollbars()
         self.view.scale_view(data.zoom)
 
 
+    def handle_image_loaded(self, image_guid: UUID, image: QImage):
+        if image_guid == self.current_image_guid and isinstance(self.current_image, PixmapImage):
+            self.current_image.set_image(image)
+
+    def prefetch(self, images: List[SegmentationData]):
+        self.image_loader.prefetch([(x.guid, x.file_path) for x in images])
+
     def show_mask(self, mask: Mask):
-        alpha_image = generate_alpha_mask(mask.image)
-        qt_image = ImageQt(alpha_image)
-        q_image = QImage(qt_image)
-        pixmap = QPixmap.fromImage(q_image)
-        mask_item = MaskPreview(mask.guid, mask.image, pixmap, self.controller)
+        pixmap = create_mask_pixmap(unpack_mask(mask.packed))
+        mask_item = MaskPreview(mask.guid, mask.packed, pixmap, self.controller)
         mask_item.update_position(mask.x, mask.y)
 
         self.gr_scene.add_item(mask_item, z_order=2)
         self.current_mask = mask_item
 
+    def show_preview(self, result: PreviewResult):
+        if result.image_guid != self.current_image_guid:
+            return
+
+        pixmap = create_mask_pixmap(result.mask)
+
+        if self.preview_item is None:
+            self.preview_item = MaskPreview(uuid.uuid1(), result.mask, pixmap, self.controller)
+            self.gr_scene.add_item(self.preview_item, z_order=3)
+        else:
+            self.preview_item.image = result.mask
+            self.preview_item.setPixmap(pixmap)
+
+        self.preview_item.update_position(result.x, result.y)
+
+        # the preview replaces the last SAM result until the next run
+        if isinstance(self.current_mask, MaskPreview):
+            self.current_mask.setVisible(False)
+
+    def update_mask(self, data: SegmentationData):
+        """
+        Replaces the shown mask and the preview with the mask of a new SAM result
+        """
+        for item in [self.current_mask, self.preview_item]:
+            if isinstance(item, MaskPreview):
+                self.gr_scene.remove_item(item)
+
+        self.current_mask = data.mask
+        self.preview_item = None
+
+        if self.current_image is not None:
+            self.current_image.update_position(data.x, data.y)
+
+        if data.mask is not None and data.mask.packed is not None:
+            self.show_mask(data.mask)
+
+    def find_item(self, guid: UUID) -> AnchorPoint | BBoxRect | None:
+        for item in self.canvas_objects:
+            if item.guid == guid:
+                return item
+
+        for item in self.hidden_items:
+            if item.guid == guid:
+                return item
+
+        return None
+
+    def move_anchor(self, anchor: Anchor):
+        item = self.find_item(anchor.guid)
+
+        if isinstance(item, AnchorPoint) and (item.x_pos != anchor.x or item.y_pos != anchor.y):
+            # applies a change of the model, reporting it would only echo it back and trigger a live preview
+            item.set_position(anchor.x, anchor.y, emit=False)
+
+    def move_bbox(self, bbox: BBox):
+        item = self.find_item(bbox.guid)
+
+        if isinstance(item, BBoxRect) and (
+                item.start_point.x() != bbox.x or item.start_point.y() != bbox.y or
+                item.width != bbox.w or item.height != bbox.h):
+            item.set_geometry(bbox.x, bbox.y, bbox.w, bbox.h, emit=False)
+
+    def remove_annotation(self, guid: UUID):
+        item = self.find_item(guid)
+
+        if item is None:
+            return
+
+        if item in self.hidden_items:
+            self.hidden_items.remove(item)
+        else:
+            self.canvas_objects.remove(item)
+            self.gr_scene.remove_item(item)
+
+    def remove_annotation_items(self):
+        for item in self.canvas_objects:
+            self.gr_scene.remove_item(item)
+
+        self.canvas_objects.clear()
+        self.hidden_items.clear()
+
     def clear_annotations(self):
+        self.preview_item = None
         _canvas_items = self.gr_scene.items(order=Qt.SortOrder.AscendingOrder)
         for _item in _canvas_items:
             if isinstance(_item, AnnotationItem):
@@ -1014,10 +1263,17 @@ class CanvasPanel(QWidget):
         self.setObjectName("CanvasPanel")
         self.canvas = Canvas(self.canvas_controller)
         self.canvas_elements = CanvasElements(self.canvas_controller, self)
+        self.prefetch_count = 2  # images before and after the selected one that are decoded ahead
 
         # bind actions
         self.view_model.s_dataSelected.connect(self.select_image)
-        self.view_model.s_dataChanged.connect(self.change_data)
+        self.view_model.s_dataCleared.connect(self.clear_image)
+        self.view_model.s_imagesRemoved.connect(self.handle_images_removed)
+        self.view_model.s_annotationAdded.connect(self.handle_annotation_added)
+        self.view_model.s_annotationMoved.connect(self.handle_annotation_moved)
+        self.view_model.s_annotationRemoved.connect(self.handle_annotation_removed)
+        self.view_model.s_annotationsCleared.connect(self.handle_annotations_cleared)
+        self.view_model.s_maskUpdated.connect(self.handle_mask_updated)
 
         self.canvas_controller.s_add_anchor.connect(self.add_anchor)
         self.canvas_controller.s_add_bbox.connect(self.add_bbox)
@@ -1045,6 +1301,7 @@ class CanvasPanel(QWidget):
         self.canvas_controller.clear_data()
         self.canvas.set_image(data)
         self.current_image_guid = data.guid
+        self.canvas.prefetch(self.view_model.get_neighbours(data.guid, self.prefetch_count))
 
         for anchor in data.anchors:
             self.canvas.populate_anchor(anchor)
@@ -1054,18 +1311,60 @@ class CanvasPanel(QWidget):
             self.canvas.populate_bbox(bbox)
             self.canvas_elements.canvas_hierarchy.add_bbox(bbox)
 
-        if data.mask is not None and data.mask.image is not None:
+        if data.mask is not None and data.mask.packed is not None:
             self.canvas.show_mask(data.mask)
 
 
-    def change_data(self, project: ProjectData):
-        if len(project.data) == 0:
-            self.canvas.clear_canvas()
-            self.canvas_elements.clear()
+    def clear_image(self):
+        self.canvas.clear_canvas()
+        self.canvas_elements.clear()
+        self.canvas.current_image_guid = None
+        self.current_image_guid = None
+
+    def handle_images_removed(self, guids: List[UUID]):
+        if self.current_image_guid in guids:
+            self.clear_image()
+
+    def handle_annotation_added(self, delta: AnnotationDelta):
+        # annotations drawn on the canvas already have their item, only ones added elsewhere are populated
+        if delta.image_guid != self.current_image_guid or self.canvas.find_item(delta.guid) is not None:
+            return
 
-        for _guid, _data in project.data.items():
-            if _guid == self.current_image_guid:
-                self.select_image(_data)
+        if delta.kind == AnnotationKind.Anchor:
+            anchor = self.view_model.get_anchor(delta.image_guid, delta.guid)
+            self.canvas.populate_anchor(anchor)
+            self.canvas_elements.canvas_hierarchy.add_anchor(anchor)
+        else:
+            bbox = self.view_model.get_bbox(delta.image_guid, delta.guid)
+            self.canvas.populate_bbox(bbox)
+            self.canvas_elements.canvas_hierarchy.add_bbox(bbox)
+
+    def handle_annotation_moved(self, delta: AnnotationDelta):
+        if delta.image_guid != self.current_image_guid:
+            return
+
+        if delta.kind == AnnotationKind.Anchor:
+            anchor = self.view_model.get_anchor(delta.image_guid, delta.guid)
+            if anchor is not None:
+                self.canvas.move_anchor(anchor)
+        else:
+            bbox = self.view_model.get_bbox(delta.image_guid, delta.guid)
+            if bbox is not None:
+                self.canvas.move_bbox(bbox)
+
+    def handle_annotation_removed(self, delta: AnnotationDelta):
+        if delta.image_guid == self.current_image_guid:
+            self.canvas.remove_annotation(delta.guid)
+            self.canvas_elements.canvas_hierarchy.remove_entry(delta.guid)
+
+    def handle_annotations_cleared(self, image_guid: UUID):
+        if image_guid == self.current_image_guid:
+            self.canvas.remove_annotation_items()
+            self.canvas_elements.canvas_hierarchy.clear()
+
+    def handle_mask_updated(self, image_guid: UUID):
+        if image_guid == self.current_image_guid:
+            self.canvas.update_mask(self.view_model.get_data_by_guid(image_guid))
 
     def set_tool(self, tool: Tool):
         self.canvas.set_current_tool(tool)
@@ -1,191 +1,346 @@
 from uuid import UUID
-from PySide6.QtGui import QIcon
-from PySide6.QtCore import Signal
+from PIL.ImageQt import ImageQt
+from typing import Dict, List, Set
+from collections import OrderedDict
+from PySide6.QtGui import QIcon, QPainter, QColor, QImage
+from PySide6.QtCore import Qt, Signal, QAbstractListModel, QModelIndex, QEvent, QPoint, QRect, QSize
 from SamGui.Controller import CanvasController
 from SamGui.Widgets.Buttons import MenuButton
 from SamGui.Widgets.Dialogs import TexInputDialog
-from SamGui.Data import Label
-from PySide6.QtWidgets import QWidget, QHBoxLayout, QLabel, QRadioButton
+from SamGui.Data import Label, EmbeddingState, SegmentationData, ThumbnailResult
+from PySide6.QtWidgets import QWidget, QHBoxLayout, QLabel, QRadioButton, QStyledItemDelegate, QStyle, QToolTip
 
 
-class ImageEntry(QWidget):
-    s_on_mask_export = Signal(UUID)
-    s_on_mask_export_cropped = Signal(UUID)
-    s_on_export_annotations = Signal(UUID)
-    s_on_annotation_delete = Signal(UUID)
-    s_on_selected = Signal(UUID)
-
-    def __init__(self, guid: UUID, name: str, parent=None):
-        super().__init__(parent)
-        self.guid = guid
-        self.name = name
-        self.parent = parent
-        self.is_dark = True
-        self.label = QLabel(self.name)
+EMBEDDING_STATE_COLORS = {
+    EmbeddingState.Pending: "#6c6c8a",
+    EmbeddingState.Encoding: "#ffad00",
+    EmbeddingState.Ready: "#00d26a",
+    EmbeddingState.Failed: "#ff3b3b"
+}
 
-        self.export_annotation_icon = QIcon("SamGui/Assets/Textures/save-disc.png")
-        self.export_annotation_icon_hover = QIcon("SamGui/Assets/Textures/save-disc_highlight.png")
 
-        self.export_icon = QIcon("SamGui/Assets/Textures/export_masks_btn.png")
-        self.export_icon_hover = QIcon("SamGui/Assets/Textures/export_masks_btn_hover.png")
+class ImageListModel(QAbstractListModel):
+    """
+    Holds the imported images as a flat list of guids. Rows are handed to the view in batches via
+    canFetchMore/fetchMore, so importing a large dataset doesn't lay out every row at once.
 
-        self.export_cropped_icon = QIcon("SamGui/Assets/Textures/export_bboxes_btn.png")
-        self.export_cropped_icon_hover = QIcon("SamGui/Assets/Textures/export_bboxes_btn_hover.png")
+    Thumbnails are requested through s_thumbnail_requested the first time a row asks for one, which only happens
+    when the delegate paints it. The most recently used ones are kept as QImages.
+    """
+    GuidRole = Qt.ItemDataRole.UserRole + 1
+    EmbeddingStateRole = Qt.ItemDataRole.UserRole + 2
+    ThumbnailRole = Qt.ItemDataRole.UserRole + 3
 
-        self.delete_icon = QIcon("SamGui/Assets/Textures/delete_icon_light.png")
-        self.delete_hover_icon = QIcon("SamGui/Assets/Textures/delete_icon_light_hover.png")
-
-        self.btn_export_annotations = MenuButton(
-            self.export_annotation_icon,
-            self.export_annotation_icon_hover,
-            width=24,
-            height=24,
-            object_name="listButton",
-            toolip="Export YOLO annotation"
-        )
-
-        self.btn_export = MenuButton(
-            self.export_icon,
-            self.export_icon_hover,
-            width=24,
-            height=24,
-            object_name="listButton",
-            toolip="Export entire mask"
-        )
-
-        self.btn_export_cropped = MenuButton(
-            self.export_cropped_icon,
-            self.export_cropped_icon_hover,
-            width=24,
-            height=24,
-            object_name="listButton",
-            toolip="Export cropped areas based on BBoxes"
-        )
+    s_thumbnail_requested = Signal(UUID, str)
 
-        self.delete_btn = MenuButton(
-            self.delete_icon,
-            self.delete_hover_icon,
-            width=24,
-            height=24,
-            object_name="listButton",
-            toolip="Delete Annotations"
-        )
+    def __init__(self, batch_size: int = 256, max_thumbnails: int = 512, parent=None):
+        super().__init__(parent)
+        self.batch_size = batch_size
+        self.max_thumbnails = max_thumbnails
+        self._guids: List[UUID] = []
+        self._rows: Dict[UUID, int] = {}
+        self._names: Dict[UUID, str] = {}
+        self._paths: Dict[UUID, str] = {}
+        self._states: Dict[UUID, EmbeddingState] = {}
+        self._thumbnails: OrderedDict[UUID, QImage] = OrderedDict()
+        self._requested: Set[UUID] = set()
+        self._fetched = 0
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else self._fetched
 
-        # bind signals
-        self.btn_export_annotations.clicked.connect(self.export_yolo_annotations)
-        self.btn_export.clicked.connect(self.export_mask)
-        self.btn_export_cropped.clicked.connect(self.export_cropped_mask)
-        self.delete_btn.clicked.connect(self.delete_annotations)
+    def canFetchMore(self, parent) -> bool:
+        return not parent.isValid() and self._fetched < len(self._guids)
 
-        # build layout
-        self.h_layout = QHBoxLayout()
-        self.h_layout.addWidget(self.label)
-        self.h_layout.addWidget(self.btn_export_annotations)
-        self.h_layout.addWidget(self.btn_export)
-        self.h_layout.addWidget(self.btn_export_cropped)
-        self.h_layout.addWidget(self.delete_btn)
+    def fetchMore(self, parent) -> None:
+        if parent.isValid():
+            return
 
-        self.setLayout(self.h_layout)
+        count = min(self.batch_size, len(self._guids) - self._fetched)
 
-        self.setStyleSheet("""
-                    background-color: #1e1a3d;
-                    color: #ffffff;
+        if count > 0:
+            self.beginInsertRows(QModelIndex(), self._fetched, self._fetched + count - 1)
+            self._fetched += count
+            self.endInsertRows()
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= self._fetched:
+            return None
+
+        guid = self._guids[index.row()]
+
+        if role == Qt.ItemDataRole.DisplayRole or role == Qt.ItemDataRole.ToolTipRole:
+            return self._names[guid]
+        elif role == self.GuidRole:
+            return guid
+        elif role == self.EmbeddingStateRole:
+            return self._states.get(guid)
+        elif role == self.ThumbnailRole:
+            return self.get_thumbnail(guid)
+
+        return None
+
+    def get_thumbnail(self, image_guid: UUID) -> QImage | None:
+        if image_guid in self._thumbnails:
+            self._thumbnails.move_to_end(image_guid)
+            return self._thumbnails[image_guid]
+
+        if image_guid not in self._requested:
+            self._requested.add(image_guid)
+            self.s_thumbnail_requested.emit(image_guid, self._paths[image_guid])
+
+        return None
+
+    def set_thumbnail(self, result: ThumbnailResult) -> None:
+        if result.image_guid not in self._rows:
+            return
+
+        self._thumbnails[result.image_guid] = ImageQt(result.image).copy()
+
+        # evicted rows request their thumbnail again, which is a disk cache hit
+        while len(self._thumbnails) > self.max_thumbnails:
+            guid, _ = self._thumbnails.popitem(last=False)
+            self._requested.discard(guid)
+
+        row = self._rows[result.image_guid]
+
+        if row < self._fetched:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [self.ThumbnailRole])
+
+    def discard_thumbnail_request(self, image_guid: UUID) -> None:
+        self._requested.discard(image_guid)
+
+    def add_images(self, images: List[SegmentationData]) -> None:
+        for data in images:
+            if data.guid in self._rows:
+                continue
+
+            self._rows[data.guid] = len(self._guids)
+            self._guids.append(data.guid)
+            self._names[data.guid] = data.file_name
+            self._paths[data.guid] = data.file_path
+
+        # the view only asks for more rows when scrolled to the end, so the first batch is exposed here. Later rows are
+        # left to the view, as exposing every chunk of a streamed import would lay out the whole list once per chunk
+        if self._fetched < self.batch_size:
+            self.fetchMore(QModelIndex())
+
+    def remove_images(self, guids: List[UUID]) -> None:
+        rows = sorted((self._rows.pop(x) for x in guids if x in self._rows), reverse=True)
+
+        if len(rows) == 0:
+            return
+
+        for guid in guids:
+            self._names.pop(guid, None)
+            self._paths.pop(guid, None)
+            self._states.pop(guid, None)
+            self._thumbnails.pop(guid, None)
+            self._requested.discard(guid)
 
-                    QToolTip { 
-                       background-color: #1e1a3d; 
-                       color: #000000; 
-                       border: white solid 1px
-                            }
-                """)
+        # remove contiguous runs bottom-up so that the remaining row numbers stay valid
+        first = last = rows[0]
 
-    def export_yolo_annotations(self):
-        self.s_on_export_annotations.emit(self.guid)
+        for row in rows[1:] + [None]:
+            if row is not None and row == first - 1:
+                first = row
+                continue
 
-    def export_mask(self):
-        self.s_on_mask_export.emit(self.guid)
+            self._remove_rows(first, last)
 
-    def export_cropped_mask(self):
-        self.s_on_mask_export_cropped.emit(self.guid)
+            if row is not None:
+                first = last = row
 
-    def delete_annotations(self):
-        self.s_on_annotation_delete.emit(self.guid)
+        for row in range(rows[-1], len(self._guids)):
+            self._rows[self._guids[row]] = row
 
+    def _remove_rows(self, first: int, last: int) -> None:
+        fetched_last = min(last, self._fetched - 1)
 
-    def set_dark_background(self):
-        self.is_dark = True
+        if first <= fetched_last:
+            self.beginRemoveRows(QModelIndex(), first, fetched_last)
+            del self._guids[first:last + 1]
+            self._fetched -= fetched_last - first + 1
+            self.endRemoveRows()
+        else:
+            del self._guids[first:last + 1]
+
+    def clear(self) -> None:
+        self.beginResetModel()
+        self._guids.clear()
+        self._rows.clear()
+        self._names.clear()
+        self._paths.clear()
+        self._states.clear()
+        self._thumbnails.clear()
+        self._requested.clear()
+        self._fetched = 0
+        self.endResetModel()
+
+    def set_embedding_state(self, image_guid: UUID, state: EmbeddingState | None) -> None:
+        if image_guid not in self._rows:
+            return
+
+        if state is None:
+            self._states.pop(image_guid, None)
+        else:
+            self._states[image_guid] = state
 
-        self.setStyleSheet("""
-            background-color: #1e1a3d;
-        """)
+        row = self._rows[image_guid]
 
-        self.label.setStyleSheet("""
-            background-color: #1e1a3d;
-        """)
+        if row < self._fetched:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [self.EmbeddingStateRole])
 
-        self.btn_export_annotations.setStyleSheet("""
-            background-color: #1e1a3d;
-        """)
+    def clear_pending_states(self) -> None:
+        for guid in [x for x, state in self._states.items() if state == EmbeddingState.Pending]:
+            self._states.pop(guid)
 
-        self.btn_export.setStyleSheet("""
-            background-color: #1e1a3d;
-        """)
+        if self._fetched > 0:
+            self.dataChanged.emit(self.index(0), self.index(self._fetched - 1), [self.EmbeddingStateRole])
 
-        self.btn_export_cropped.setStyleSheet("""
-            background-color: #1e1a3d;
-        """)
 
-        self.delete_btn.setStyleSheet("""
-            background-color: #1e1a3d;
-        """)
+class ImageEntryButton:
+    def __init__(self, icon: QIcon, hover_icon: QIcon, tooltip: str, signal):
+        self.icon = icon
+        self.hover_icon = hover_icon
+        self.tooltip = tooltip
+        self.signal = signal
 
-    def set_light_background(self):
-        self.is_dark = False
-        self.setStyleSheet("""
-                    background-color: #292951;
-        """)
-        self.label.setStyleSheet("""
-                    background-color: #292951;
-                        """)
 
-        self.btn_export_annotations.setStyleSheet("""
-                    background-color: #292951;
-                """)
+class ImageEntryDelegate(QStyledItemDelegate):
+    """
+    Paints the rows of the ImageListModel, Qt only calls paint() for rows inside the viewport. The per-row buttons
+    are drawn as icons, the view resolves clicks on them with button_at() and emits the button's signal.
+    """
+    s_on_mask_export = Signal(UUID)
+    s_on_mask_export_cropped = Signal(UUID)
+    s_on_export_annotations = Signal(UUID)
+    s_on_annotation_delete = Signal(UUID)
 
-        self.btn_export.setStyleSheet("""
-                    background-color: #292951;
-                """)
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.row_height = 40
+        self.icon_size = 24
+        self.thumbnail_size = 32
+        self.spacing = 6
+        self.hovered_row = -1
+        self.hovered_button = None
+
+        self.buttons = [
+            ImageEntryButton(
+                QIcon("SamGui/Assets/Textures/save-disc.png"),
+                QIcon("SamGui/Assets/Textures/save-disc_highlight.png"),
+                "Export YOLO annotation",
+                self.s_on_export_annotations
+            ),
+            ImageEntryButton(
+                QIcon("SamGui/Assets/Textures/export_masks_btn.png"),
+                QIcon("SamGui/Assets/Textures/export_masks_btn_hover.png"),
+                "Export entire mask",
+                self.s_on_mask_export
+            ),
+            ImageEntryButton(
+                QIcon("SamGui/Assets/Textures/export_bboxes_btn.png"),
+                QIcon("SamGui/Assets/Textures/export_bboxes_btn_hover.png"),
+                "Export cropped areas based on BBoxes",
+                self.s_on_mask_export_cropped
+            ),
+            ImageEntryButton(
+                QIcon("SamGui/Assets/Textures/delete_icon_light.png"),
+                QIcon("SamGui/Assets/Textures/delete_icon_light_hover.png"),
+                "Delete Annotations",
+                self.s_on_annotation_delete
+            )
+        ]
+
+    def sizeHint(self, option, index) -> QSize:
+        return QSize(option.rect.width(), self.row_height)
+
+    def button_rects(self, rect: QRect) -> List[QRect]:
+        x = rect.right() - self.spacing - len(self.buttons) * (self.icon_size + self.spacing) + self.spacing
+        y = rect.top() + (rect.height() - self.icon_size) // 2
+
+        return [
+            QRect(x + idx * (self.icon_size + self.spacing), y, self.icon_size, self.icon_size)
+            for idx in range(len(self.buttons))
+        ]
+
+    def button_at(self, rect: QRect, pos: QPoint) -> ImageEntryButton | None:
+        for button, button_rect in zip(self.buttons, self.button_rects(rect)):
+            if button_rect.contains(pos):
+                return button
+
+        return None
+
+    def set_hovered(self, row: int, button: ImageEntryButton | None) -> bool:
+        """
+        Returns True if the hovered row or button changed and the view needs a repaint
+        """
+        if row == self.hovered_row and button is self.hovered_button:
+            return False
+
+        self.hovered_row = row
+        self.hovered_button = button
+        return True
+
+    def paint(self, painter: QPainter, option, index) -> None:
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        rect = option.rect
+        row = index.row()
+
+        if option.state & QStyle.StateFlag.State_Selected or row == self.hovered_row:
+            background = "#253363"
+        elif row % 2 == 0:
+            background = "#1e1a3d"
+        else:
+            background = "#292951"
 
-        self.btn_export_cropped.setStyleSheet("""
-                    background-color: #292951;
-                """)
+        painter.fillRect(rect, QColor(background))
 
-        self.delete_btn.setStyleSheet("""
-                    background-color: #292951;
-                """)
+        state = index.data(ImageListModel.EmbeddingStateRole)
 
-    def enterEvent(self, event):
-        super().enterEvent(event)
-        self.setStyleSheet("""
-            background-color: #253363;
-        """)
-        self.label.setStyleSheet("""
-            background-color: #253363;
-        """)
+        if state is not None:
+            painter.setPen(Qt.PenStyle.NoPen)
+            painter.setBrush(QColor(EMBEDDING_STATE_COLORS[state]))
+            painter.drawEllipse(QRect(rect.left() + 10, rect.center().y() - 4, 8, 8))
 
+        thumbnail_rect = QRect(rect.left() + 24, rect.top() + 4, self.thumbnail_size, self.thumbnail_size)
+        thumbnail = index.data(ImageListModel.ThumbnailRole)
 
-    def leaveEvent(self, event):
-        if self.is_dark:
-            self.set_dark_background()
+        if thumbnail is None:
+            painter.fillRect(thumbnail_rect, QColor("#343942"))
         else:
-            self.set_light_background()
-
-    def mousePressEvent(self, event):
-        super().mousePressEvent(event)
-        self.label.setStyleSheet("""
-                    background-color: #253363;
-                """)
-
-        self.s_on_selected.emit(self.guid)
+            size = thumbnail.size().scaled(thumbnail_rect.size(), Qt.AspectRatioMode.KeepAspectRatio)
+            target = QRect(QPoint(0, 0), size)
+            target.moveCenter(thumbnail_rect.center())
+            painter.drawImage(target, thumbnail)
+
+        button_rects = self.button_rects(rect)
+        text_left = thumbnail_rect.right() + 10
+        text_rect = QRect(text_left, rect.top(), button_rects[0].left() - text_left - 6, rect.height())
+        text = option.fontMetrics.elidedText(index.data(Qt.ItemDataRole.DisplayRole), Qt.TextElideMode.ElideRight, text_rect.width())
+        painter.setPen(QColor("#ffffff"))
+        painter.drawText(text_rect, Qt.AlignmentFlag.AlignVCenter | Qt.AlignmentFlag.AlignLeft, text)
+
+        for button, button_rect in zip(self.buttons, button_rects):
+            is_hovered = row == self.hovered_row and button is self.hovered_button
+            icon = button.hover_icon if is_hovered else button.icon
+            icon.paint(painter, button_rect)
+
+        painter.restore()
+
+    def helpEvent(self, event, view, option, index) -> bool:
+        if event.type() == QEvent.Type.ToolTip:
+            button = self.button_at(option.rect, event.pos())
+
+            if button is not None:
+                QToolTip.showText(event.globalPos(), button.tooltip, view)
+                return True
+
+        return super().helpEvent(event, view, option, index)
 
 
 class CanvasHierarchyEntry(QWidget):
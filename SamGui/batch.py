@@ -0,0 +1,339 @@
+"""
+Headless batch segmentation of a YOLO dataset, runs box-prompted SAM on every image without the GUI.
+
+    python -m SamGui.batch <dataset_dir> <output_dir> [--classes classes.txt] [--workers 4] [--processes 4]
+
+The dataset uses the same layout as the project import: <dataset_dir>/images and <dataset_dir>/annotations with one
+YOLO label file per image. For every image the union mask is written to <output_dir>/masks and the (adjusted) boxes
+to <output_dir>/annotations. Finished images are recorded in <output_dir>/manifest.jsonl, so a restarted job skips
+everything that was already written.
+
+With --processes the encoder runs in that many worker processes pinned to separate cores (see EncoderPool),
+the decoder and the output writing stay in the worker threads of this process.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+from PIL import Image
+from glob import glob
+from collections import Counter
+from typing import Dict, List, Set
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from SamGui.Data import BBox, SessionConfig
+from SamGui.EncoderPool import EncoderPool
+from SamGui.Inference import ENCODER_PATH, DECODER_PATH, SessionManager, encode_image, iter_decode_bboxes, \
+    upsample_box_logits
+from SamGui.Utils import MaskCompositor, get_filename, read_class_file, read_yolo_labels, get_mask_bbox, \
+    allow_large_images
+
+
+MANIFEST_FILE = "manifest.jsonl"
+
+
+class Manifest:
+    """
+    Append-only record of processed images, one json object per line. Outputs are written before the image is
+    recorded, so an entry is only present for images whose results are complete on disk.
+    """
+    def __init__(self, file_path: str, sync_every: int = 32):
+        self.file_path = file_path
+        self.sync_every = sync_every
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._file = open(self.file_path, "a", encoding="utf-8")
+
+    @staticmethod
+    def read_done(file_path: str) -> Set[str]:
+        done = set()
+
+        if not os.path.isfile(file_path):
+            return done
+
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a line cut off by a killed job
+
+                if entry.get("status") == "done":
+                    done.add(entry["image"])
+                else:
+                    done.discard(entry["image"])
+
+        return done
+
+    def add(self, entry: Dict) -> None:
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._pending += 1
+
+            if self._pending >= self.sync_every:
+                self._sync()
+
+    def _sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+
+def collect_dataset(dataset_dir: str) -> List[tuple]:
+    """
+    Pairs every image with the label file of the same name. The outputs are named after the image without its
+    extension, so images that only differ in their extension (a.jpg, a.png) are skipped instead of overwriting
+    each other's results.
+    """
+    labels = {get_filename(x): x for x in glob(os.path.join(dataset_dir, "annotations", "*.txt"))}
+    image_paths = sorted(glob(os.path.join(dataset_dir, "images", "*")))
+    name_counts = Counter(get_filename(x) for x in image_paths)
+    pairs = []
+
+    for image_path in image_paths:
+        name = get_filename(image_path)
+
+        if name_counts[name] > 1:
+            print(f"WARNING: {name_counts[name]} images are named {name}, skipping {image_path}")
+
+        elif name in labels:
+            pairs.append((image_path, labels[name]))
+        else:
+            print(f"WARNING: no annotation file for {image_path}, skipping")
+
+    return pairs
+
+
+def write_atomic(file_path: str, write_fn) -> None:
+    tmp_path = f"{file_path}.tmp"
+    write_fn(tmp_path)
+    os.replace(tmp_path, file_path)
+
+
+class BatchSegmenter:
+    def __init__(self,
+                 output_dir: str,
+                 classes: List[str],
+                 session_manager: SessionManager,
+                 encoder_path: str,
+                 decoder_path: str,
+                 adjust_bbox: bool = True,
+                 decoder_batch_size: int = 8,
+                 clip_masks: bool = False,
+                 low_res: bool = False,
+                 encoder_pool: EncoderPool | None = None):
+        self.output_dir = output_dir
+        self.masks_dir = os.path.join(output_dir, "masks")
+        self.annotations_dir = os.path.join(output_dir, "annotations")
+        self.classes = classes
+        self.session_manager = session_manager
+        self.encoder_path = encoder_path
+        self.decoder_path = decoder_path
+        self.adjust_bbox = adjust_bbox
+        self.decoder_batch_size = decoder_batch_size
+        self.clip_masks = clip_masks
+        self.low_res = low_res
+        self.encoder_pool = encoder_pool
+
+        os.makedirs(self.masks_dir, exist_ok=True)
+        os.makedirs(self.annotations_dir, exist_ok=True)
+
+    def segment(self, image_path: str, label_path: str) -> int:
+        if self.encoder_pool is not None:
+            image_embedding = self.encoder_pool.encode(image_path, key=image_path)
+        else:
+            image_embedding = encode_image(self.session_manager.get_session(self.encoder_path), image_path, key=image_path)
+
+        decoder = self.session_manager.get_session(self.decoder_path)
+        width = image_embedding.orig_width
+        height = image_embedding.orig_height
+
+        bboxes = read_yolo_labels(label_path, self.classes, width, height)
+        masks = iter_decode_bboxes(
+            decoder, image_embedding, bboxes, batch_size=self.decoder_batch_size, low_res=self.low_res
+        )
+        compositor = MaskCompositor(width, height, clip_to_roi=self.clip_masks)
+        result_boxes = []
+
+        for bbox, mask in zip(bboxes, masks):
+            roi = (bbox.x, bbox.y, bbox.w, bbox.h)
+            x0, y0 = 0, 0
+
+            if self.low_res:
+                # usually only the padded box is upsampled, the mask is that region of the image
+                x0, y0, mask = upsample_box_logits(mask, image_embedding, roi)
+
+            compositor.add_crop(x0, y0, mask, roi)
+
+            if self.adjust_bbox:
+                region = get_mask_bbox(mask, (bbox.x - x0, bbox.y - y0, bbox.w, bbox.h))
+
+                if region is not None:
+                    x, y, w, h = region
+                    bbox = BBox(bbox.guid, bbox.name, bbox.active, x0 + x, y0 + y, w, h)
+
+            result_boxes.append(bbox)
+
+        name = get_filename(image_path)
+        write_atomic(
+            os.path.join(self.masks_dir, f"{name}_mask.png"),
+            lambda x: Image.fromarray(compositor.buffer, "L").save(x, format="PNG")
+        )
+        write_atomic(
+            os.path.join(self.annotations_dir, f"{name}.txt"),
+            lambda x: self.write_yolo_labels(x, result_boxes, width, height)
+        )
+
+        return len(result_boxes)
+
+    def write_yolo_labels(self, file_path: str, bboxes: List[BBox], width: int, height: int) -> None:
+        with open(file_path, "w", encoding="utf-8") as f:
+            for bbox in bboxes:
+                class_id = self.classes.index(bbox.name) if bbox.name in self.classes else 999
+                x_center = (bbox.x + bbox.w / 2) / width
+                y_center = (bbox.y + bbox.h / 2) / height
+                f.write(f"{class_id} {x_center} {y_center} {bbox.w / width} {bbox.h / height}\n")
+
+
+def run_batch(args) -> int:
+    dataset_dir = args.dataset_dir
+    output_dir = args.output_dir
+    classes_file = args.classes if args.classes is not None else os.path.join(dataset_dir, "classes.txt")
+
+    for model_path in [args.encoder, args.decoder]:
+        if not os.path.isfile(model_path):
+            print(f"Model not found: {model_path}")
+            return 1
+
+    if not os.path.isfile(classes_file):
+        print(f"Classes file not found: {classes_file}")
+        return 1
+
+    if not os.path.isdir(os.path.join(dataset_dir, "images")) or not os.path.isdir(os.path.join(dataset_dir, "annotations")):
+        print(f"Invalid dataset directory: {dataset_dir} needs an images and an annotations directory")
+        return 1
+
+    os.makedirs(output_dir, exist_ok=True)
+    classes = read_class_file(classes_file)
+
+    with open(os.path.join(output_dir, "classes.txt"), "w", encoding="utf-8") as f:
+        for class_name in classes:
+            f.write(f"{class_name}\n")
+
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    done = Manifest.read_done(manifest_path)
+    pairs = [x for x in collect_dataset(dataset_dir) if os.path.basename(x[0]) not in done]
+    total = len(pairs) + len(done)
+    print(f"{len(done)} of {total} images already processed, {len(pairs)} remaining")
+
+    # the workers share one encoder and decoder session, so the cores are split between them
+    cpu_count = os.cpu_count() or 1
+    workers = max(args.workers, args.processes)  # one thread per encoder process keeps all of them busy
+    session_manager = SessionManager(SessionConfig(
+        intra_op_threads=args.threads if args.threads > 0 else max(1, cpu_count // workers),
+        optimized_model_dir=None
+    ))
+    encoder_pool = None
+
+    if args.processes > 0:
+        encoder_pool = EncoderPool(args.encoder, args.processes, SessionConfig(intra_op_threads=args.threads))
+
+    segmenter = BatchSegmenter(
+        output_dir, classes, session_manager, args.encoder, args.decoder,
+        adjust_bbox=not args.no_adjust_bbox,
+        decoder_batch_size=args.decoder_batch_size,
+        clip_masks=args.clip_masks,
+        low_res=args.low_res,
+        encoder_pool=encoder_pool
+    )
+    manifest = Manifest(manifest_path)
+    processed = len(done)
+    failed = 0
+    start_time = time.time()
+
+    def process(pair):
+        image_path, label_path = pair
+        box_count = segmenter.segment(image_path, label_path)
+        return {"image": os.path.basename(image_path), "status": "done", "boxes": box_count}
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            pair_iter = iter(pairs)
+
+            # keep a bounded number of images in flight instead of submitting the whole dataset at once
+            while True:
+                while len(pending) < workers * 2:
+                    pair = next(pair_iter, None)
+                    if pair is None:
+                        break
+                    pending[executor.submit(process, pair)] = pair
+
+                if len(pending) == 0:
+                    break
+
+                completed, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+
+                for future in completed:
+                    image_path, _ = pending.pop(future)
+
+                    try:
+                        manifest.add(future.result())
+                        processed += 1
+                    except BaseException as e:
+                        failed += 1
+                        print(f"Failed to process {image_path}: {e}")
+                        manifest.add({"image": os.path.basename(image_path), "status": "failed", "error": str(e)})
+
+                    if (processed + failed) % 50 == 0:
+                        elapsed = time.time() - start_time
+                        print(f"{processed}/{total} done, {failed} failed, {elapsed:.1f}s elapsed")
+    finally:
+        manifest.close()
+
+        if encoder_pool is not None:
+            encoder_pool.close(wait=True)
+
+    print(f"Finished: {processed}/{total} images processed, {failed} failed")
+    return 0 if failed == 0 else 2
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m SamGui.batch", description="Box-prompted SAM over a YOLO dataset")
+    parser.add_argument("dataset_dir", help="directory containing images/ and annotations/")
+    parser.add_argument("output_dir", help="directory for masks/, annotations/ and the manifest")
+    parser.add_argument("--classes", default=None, help="classes file, defaults to <dataset_dir>/classes.txt")
+    parser.add_argument("--workers", type=int, default=max(1, min(4, os.cpu_count() or 1)), help="number of images processed concurrently")
+    parser.add_argument("--processes", type=int, default=0, help="number of encoder worker processes, 0 encodes in the worker threads")
+    parser.add_argument("--threads", type=int, default=0, help="onnxruntime threads per session, 0 splits the cores between the workers or processes")
+    parser.add_argument("--encoder", default=ENCODER_PATH)
+    parser.add_argument("--decoder", default=DECODER_PATH)
+    parser.add_argument("--decoder-batch-size", type=int, default=8, help="max. number of box prompts per decoder call")
+    parser.add_argument("--no-adjust-bbox", action="store_true", help="keep the input boxes instead of fitting them to the masks")
+    parser.add_argument("--clip-masks", action="store_true", help="drop the mask pixels outside of the box they were prompted with")
+    parser.add_argument("--low-res", action="store_true", help="upsample the low resolution masks around each box, or the whole image for masks that reach past it")
+    parser.add_argument("--allow-large-images", action="store_true", help="lift Pillow's decompression bomb limit of ~89 megapixels")
+    args = parser.parse_args(argv)
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    if args.processes < 0:
+        parser.error("--processes must not be negative")
+
+    if args.allow_large_images:
+        allow_large_images()
+
+    return run_batch(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+Compares the peak memory and time of building the union mask of many box prompts: the previous chain (PIL round trip,
+np.dstack and np.sum), collecting all masks and OR-reducing them, and streaming them into a MaskCompositor as they
+are decoded, with and without clipping to the box ROI. The decoder is replaced by a generator of full resolution
+masks, so only the union itself is measured.
+
+    python benchmarks/compositor.py [--max-gb 2]
+
+Methods whose estimated peak exceeds --max-gb are skipped.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SamGui.Utils import MaskCompositor
+
+
+def create_boxes(width: int, height: int, count: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    w = rng.integers(width // 40, width // 8, count)
+    h = rng.integers(height // 40, height // 8, count)
+    x = rng.integers(0, width - w)
+    y = rng.integers(0, height - h)
+
+    return [(int(a), int(b), int(c), int(d)) for a, b, c, d in zip(x, y, w, h)]
+
+
+def decoded_masks(width: int, height: int, boxes):
+    """
+    Yields a full resolution uint8 mask per box, like the decoder does, with a few pixels leaking out of the box
+    """
+    for x, y, w, h in boxes:
+        mask = np.zeros((height, width), dtype=np.uint8)
+        mask[y:y + h, x:x + w] = 255
+        mask[max(0, y - 2):y, x:x + w] = 255
+        yield mask
+
+
+def legacy_union(width: int, height: int, boxes) -> np.ndarray:
+    masks = [Image.fromarray(x) for x in decoded_masks(width, height, boxes)]
+    masks = [np.array(x) for x in masks]
+    stack = np.dstack(masks)
+    union = np.sum(stack, axis=-1)
+
+    return (union > 0).astype("uint8") * 255
+
+
+def reduce_union(width: int, height: int, boxes) -> np.ndarray:
+    masks = list(decoded_masks(width, height, boxes))
+    return np.logical_or.reduce(masks).astype(np.uint8) * 255
+
+
+def compositor_union(width: int, height: int, boxes, clip_to_roi: bool = False) -> np.ndarray:
+    compositor = MaskCompositor(width, height, clip_to_roi)
+
+    for box, mask in zip(boxes, decoded_masks(width, height, boxes)):
+        compositor.add(mask, box)
+
+    return compositor.buffer
+
+
+def estimate_bytes(method: str, width: int, height: int, count: int) -> int:
+    pixels = width * height
+
+    if method == "legacy":
+        return pixels * count * 3 + pixels * 8  # masks, their PIL copies, the stack and the widened sum
+    if method == "reduce":
+        return pixels * count + pixels * 2
+
+    return pixels * 3
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-gb", type=float, default=2.0, help="skip methods whose estimated peak is larger")
+    args = parser.parse_args()
+
+    methods = [
+        ("legacy", lambda w, h, b: legacy_union(w, h, b)),
+        ("reduce", lambda w, h, b: reduce_union(w, h, b)),
+        ("compositor", lambda w, h, b: compositor_union(w, h, b)),
+        ("compositor roi", lambda w, h, b: compositor_union(w, h, b, True)),
+    ]
+
+    print(f"{'image':<12}{'boxes':>6}  {'method':<16}{'peak MB':>10}{'time s':>9}  {'same union':<10}")
+
+    for width, height, count in [(2000, 1500, 10), (2000, 1500, 100), (6000, 4000, 10), (6000, 4000, 100)]:
+        boxes = create_boxes(width, height, count)
+        reference = None
+
+        for name, fn in methods:
+            if estimate_bytes(name.split()[0], width, height, count) > args.max_gb * 1024 ** 3:
+                print(f"{f'{width}x{height}':<12}{count:>6}  {name:<16}{'skipped':>10}")
+                continue
+
+            union, elapsed, peak = measure(fn, width, height, boxes)
+
+            if name == "compositor roi":
+                same = "clipped"
+            elif reference is None:
+                reference = union
+                same = "-"
+            else:
+                same = str(bool(np.array_equal(reference, union)))
+
+            print(f"{f'{width}x{height}':<12}{count:>6}  {name:<16}{peak / 1024 ** 2:>10.1f}{elapsed:>9.2f}  {same:<10}")
+            del union
+
+
+if __name__ == "__main__":
+    main()
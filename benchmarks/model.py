@@ -0,0 +1,79 @@
+"""
+Times the bulk DataModel operations on a large synthetic project.
+
+    python benchmarks/model.py [image_count]
+"""
+
+import io
+import os
+import sys
+import time
+import random
+
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SamGui.MVVM.model import DataModel
+from SamGui.Utils import generate_uuid
+from SamGui.Data import SegmentationData, Anchor, BBox, Mask, Label, BBoxPosition, AnchorPosition, ZoomLevel
+
+
+def create_data(count: int):
+    data = {}
+
+    for idx in range(count):
+        guid = generate_uuid()
+        data[guid] = SegmentationData(
+            guid=guid,
+            file_path=f"/data/images/{idx:07d}.jpg",
+            file_name=f"{idx:07d}",
+            x=0,
+            y=0,
+            anchors=[Anchor(generate_uuid(), Label.foreground, True, 10, 10)],
+            bboxes=[BBox(generate_uuid(), "BBox", True, 10, 10, 50, 50) for _ in range(2)],
+            mask=Mask(generate_uuid(), 0, 0, None),
+            zoom=1.0
+        )
+
+    return data
+
+
+def timed(label: str, fn, count: int):
+    start = time.perf_counter()
+
+    with redirect_stdout(io.StringIO()):  # update_zoom_level logs every call
+        fn()
+
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32}{elapsed * 1000:>10.1f} ms{elapsed / count * 1e6:>12.2f} us/op")
+
+
+def main(image_count: int = 100_000, op_count: int = 10_000):
+    random.seed(0)
+    data = create_data(image_count)
+    model = DataModel()
+
+    timed(f"add {image_count} images", lambda: model.add(data), image_count)
+    timed(f"re-add {image_count} (duplicates)", lambda: model.add(data), image_count)
+
+    images = random.sample(list(data.values()), op_count)
+
+    timed("get_data_by_guid", lambda: [model.get_data_by_guid(x.guid) for x in images], op_count)
+    timed("get_mask_data", lambda: [model.get_mask_data(x.guid) for x in images], op_count)
+    timed("add_bbox", lambda: [
+        model.add_bbox(x.guid, BBox(generate_uuid(), "BBox", True, 0, 0, 5, 5)) for x in images
+    ], op_count)
+    timed("update_bbox_position", lambda: [
+        model.update_bbox_position(x.guid, BBoxPosition(x.bboxes[0].guid, 1, 1, 20, 20)) for x in images
+    ], op_count)
+    timed("update_anchor_position", lambda: [
+        model.update_anchor_position(x.guid, AnchorPosition(x.anchors[0].guid, 3, 3)) for x in images
+    ], op_count)
+    timed("update_zoom_level", lambda: [model.update_zoom_level(ZoomLevel(x.guid, 1.5)) for x in images], op_count)
+    timed("delete_item (bbox)", lambda: [model.delete_item(x.bboxes[-1].guid) for x in images], op_count)
+    timed("delete_item (image)", lambda: [model.delete_item(x.guid) for x in images], op_count)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
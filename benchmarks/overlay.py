@@ -0,0 +1,90 @@
+"""
+Compares building the canvas mask overlay pixmap against the previous PIL -> ImageQt -> QImage -> QPixmap chain,
+per-mask time and whether both overlays composite to the same pixels.
+
+    python benchmarks/overlay.py
+
+Runs on the offscreen platform unless QT_QPA_PLATFORM is already set.
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+from PIL import Image, ImageOps
+from PIL.ImageQt import ImageQt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PySide6.QtGui import QGuiApplication, QImage, QPixmap, QPainter, QColor
+from SamGui.Widgets.GraphicItems import create_mask_pixmap
+
+
+def legacy_alpha_mask(input_mask: Image.Image) -> Image.Image:
+    grayscale_mask = input_mask.convert("L")
+    alpha_mask = ImageOps.colorize(grayscale_mask, black="black", white="red")
+    alpha_mask = alpha_mask.convert("RGBA")
+
+    array = np.array(alpha_mask, dtype=np.uint8)
+    is_black = (array[:, :, :3] == (0, 0, 0)).all(axis=2)
+    alpha = np.where(is_black, 0, 255)
+    array[:, :, -1] = alpha
+
+    alpha_mask = Image.fromarray(array, "RGBA")
+    alpha_mask.putalpha(128)
+
+    return alpha_mask
+
+
+def legacy_mask_pixmap(mask: Image.Image) -> QPixmap:
+    return QPixmap.fromImage(QImage(ImageQt(legacy_alpha_mask(mask))))
+
+
+def create_mask(width: int, height: int) -> Image.Image:
+    y, x = np.ogrid[:height, :width]
+    inside = (x - width / 2) ** 2 / (width / 3) ** 2 + (y - height / 2) ** 2 / (height / 3) ** 2 < 1
+    return Image.fromarray(inside.astype(np.uint8) * 255)
+
+
+def composite(pixmap: QPixmap) -> np.ndarray:
+    target = QImage(pixmap.width(), pixmap.height(), QImage.Format.Format_RGB32)
+    target.fill(QColor(200, 200, 200))
+    painter = QPainter(target)
+    painter.drawPixmap(0, 0, pixmap)
+    painter.end()
+
+    return np.frombuffer(target.constBits(), np.uint8).reshape(pixmap.height(), target.bytesPerLine()).copy()
+
+
+def measure(fn, mask: Image.Image, repeats: int):
+    fn(mask)
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(mask)
+
+    return (time.perf_counter() - start) / repeats
+
+
+def main(repeats: int = 5):
+    app = QGuiApplication.instance() or QGuiApplication(sys.argv)
+
+    print(f"{'mask':<14}{'legacy ms':>12}{'new ms':>10}{'max diff':>11}")
+
+    for width, height in [(1024, 1024), (4000, 3000), (8000, 6000)]:
+        mask = create_mask(width, height)
+        legacy_time = measure(legacy_mask_pixmap, mask, repeats)
+        new_time = measure(create_mask_pixmap, mask, repeats)
+        max_diff = np.abs(
+            composite(legacy_mask_pixmap(mask)).astype(np.int16) - composite(create_mask_pixmap(mask))
+        ).max()
+
+        print(f"{f'{width}x{height}':<14}{legacy_time * 1000:>12.1f}{new_time * 1000:>10.1f}{max_diff:>11}")
+
+    del app
+
+
+if __name__ == "__main__":
+    main()
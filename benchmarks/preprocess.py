@@ -0,0 +1,97 @@
+"""
+Compares the encoder preprocessing against the previous float64 pipeline, per-image time and peak memory
+(as seen by tracemalloc, i.e. numpy buffers but not the decoded PIL image).
+
+    python benchmarks/preprocess.py [image ...]
+
+Without arguments a few synthetic JPEGs of typical scan sizes are generated in a temporary directory.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SamGui.Inference import ImagePreprocessor, get_resized_shape
+
+
+def legacy_preprocess(file_path: str):
+    img = Image.open(file_path).convert("RGB")
+    orig_width, orig_height = img.size
+    resized_width, resized_height = get_resized_shape(orig_width, orig_height)
+
+    img = img.resize((resized_width, resized_height), Image.Resampling.BILINEAR)
+
+    input_tensor = np.array(img)
+    mean = np.array([123.675, 116.28, 103.53])
+    std = np.array([[58.395, 57.12, 57.375]])
+    input_tensor = (input_tensor - mean) / std
+    input_tensor = input_tensor.transpose(2, 0, 1)[None, :, :, :].astype(np.float32)
+
+    if resized_height < resized_width:
+        input_tensor = np.pad(input_tensor, ((0, 0), (0, 0), (0, 1024 - resized_height), (0, 0)))
+    else:
+        input_tensor = np.pad(input_tensor, ((0, 0), (0, 0), (0, 0), (0, 1024 - resized_width)))
+
+    return input_tensor, orig_width, orig_height, resized_width, resized_height
+
+
+def create_images(target_dir: str):
+    rng = np.random.default_rng(0)
+    paths = []
+
+    for width, height in [(1600, 1200), (4000, 3000), (6000, 2000)]:
+        # smooth noise compresses like a photographed page rather than like white noise
+        small = rng.integers(0, 255, (height // 16, width // 16, 3), dtype=np.uint8)
+        img = Image.fromarray(small).resize((width, height), Image.Resampling.BILINEAR)
+        path = os.path.join(target_dir, f"synthetic_{width}x{height}.jpg")
+        img.save(path, quality=90)
+        paths.append(path)
+
+    return paths
+
+
+def measure(fn, file_path: str, repeats: int):
+    fn(file_path)  # warm up, the preprocessor allocates its buffer on the first call
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(file_path)
+    elapsed = (time.perf_counter() - start) / repeats
+
+    tracemalloc.start()
+    fn(file_path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+
+def main(paths, repeats: int = 5):
+    preprocessor = ImagePreprocessor()
+
+    print(f"{'image':<28}{'legacy ms':>12}{'new ms':>10}{'legacy MB':>12}{'new MB':>10}{'max diff':>11}")
+
+    for path in paths:
+        legacy_time, legacy_peak = measure(legacy_preprocess, path, repeats)
+        new_time, new_peak = measure(preprocessor, path, repeats)
+        max_diff = np.abs(legacy_preprocess(path)[0] - preprocessor(path)[0]).max()
+
+        print(
+            f"{os.path.basename(path)[:27]:<28}{legacy_time * 1000:>12.1f}{new_time * 1000:>10.1f}"
+            f"{legacy_peak / 1024 ** 2:>12.1f}{new_peak / 1024 ** 2:>10.1f}{max_diff:>11.3f}"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            main(create_images(tmp_dir))
@@ -6,6 +6,7 @@ windows-debug: --standalone --plugin-enable=pyside6 --windows-icon-from-ico=logo
 """
 
 import sys
+import multiprocessing
 from SamGui.MVVM.view import AppView
 from SamGui.MVVM.model import DataModel
 from SamGui.MVVM.viewmodel import SamViewModel
@@ -13,10 +14,12 @@ from PySide6.QtCore import QPoint
 from PySide6 import QtGui
 
 from PySide6.QtWidgets import QApplication
-from SamGui.Utils import get_screen_center
+from SamGui.Utils import allow_large_images, get_screen_center
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # the encoder pool spawns worker processes from the frozen executable
+    allow_large_images()  # very large images are opened on purpose and shown tiled
     app = QApplication()
     app.setWindowIcon(QtGui.QIcon('logo.png'))
     model = DataModel()